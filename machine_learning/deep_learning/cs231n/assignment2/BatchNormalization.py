@@ -2,7 +2,9 @@ import numpy as np
 import time
 
 from cs231n.classifiers.fc_net import FullyConnectedNet
-from cs231n.classifiers.layers import batchnorm_forward, batchnorm_backward, batchnorm_backward_alt
+from cs231n.classifiers.layers import batchnorm_forward, batchnorm_backward, batchnorm_backward_alt,\
+    batchnorm_forward_fused, batchnorm_backward_fused, spatial_batchnorm_forward,\
+    spatial_batchnorm_backward, spatial_batchnorm_forward_fused, spatial_batchnorm_backward_fused
 from cs231n.classifiers.solver import Solver
 from cs231n.datasets.cifar10 import get_CIFAR10_data
 from cs231n.gradient_check import eval_numerical_gradient, eval_numerical_gradient_array
@@ -113,6 +115,75 @@ def batchnorm_backward_alt_test():
     print("dbeta difference: {}".format(rel_error(dbeta1, dbeta2)))
     print("speedup: {}".format((t2-t1)/(t3-t2)))
 
+def fused_batchnorm_test(num_reps=20):
+    """
+    Check the fused batchnorm and spatial batchnorm layers against the
+    originals and time them: the backward passes against batchnorm_backward
+    and batchnorm_backward_alt, the spatial layers in both layouts.
+    """
+    def best_time(f):
+        f()
+        best = float('inf')
+        for _ in range(num_reps):
+            t0 = time.time()
+            f()
+            best = min(best, time.time() - t0)
+        return best
+
+    N, D = 500, 1024
+    x = (5 * np.random.randn(N, D) + 12).astype(np.float32)
+    gamma = np.random.randn(D).astype(np.float32)
+    beta = np.random.randn(D).astype(np.float32)
+    dout = np.random.randn(N, D).astype(np.float32)
+
+    # float32 results of both implementations against the float64 originals
+    ref_out, ref_cache = batchnorm_forward(x.astype(np.float64), gamma.astype(np.float64),
+                                           beta.astype(np.float64), {'mode': 'train'})
+    ref_grads = batchnorm_backward_alt(dout.astype(np.float64), ref_cache)
+    out, cache = batchnorm_forward(x, gamma, beta, {'mode': 'train'})
+    out_fused, cache_fused = batchnorm_forward_fused(x, gamma, beta, {'mode': 'train'})
+    grads = batchnorm_backward_alt(dout, cache)
+    grads_fused = batchnorm_backward_fused(dout, cache_fused)
+    print('batchnorm on (%d, %d) float32, max abs error against float64:' % (N, D))
+    for name, ref, a, b in zip(['out', 'dx', 'dgamma', 'dbeta'], (ref_out,) + ref_grads,
+                               (out,) + grads, (out_fused,) + grads_fused):
+        print('%s: %.2e, fused %.2e' % (name, np.max(np.abs(a - ref)), np.max(np.abs(b - ref))))
+
+    forward = best_time(lambda: batchnorm_forward(x, gamma, beta, {'mode': 'train'}))
+    forward_fused = best_time(lambda: batchnorm_forward_fused(x, gamma, beta, {'mode': 'train'}))
+    print('forward: %.2fms, fused %.2fms (%.1fx)' % (forward * 1e3, forward_fused * 1e3, forward / forward_fused))
+    backward_fused = best_time(lambda: batchnorm_backward_fused(dout, cache_fused))
+    for name, f in [('batchnorm_backward', batchnorm_backward), ('batchnorm_backward_alt', batchnorm_backward_alt)]:
+        t = best_time(lambda: f(dout, cache))
+        print('%s: %.2fms, fused %.2fms (%.1fx)' % (name, t * 1e3, backward_fused * 1e3, t / backward_fused))
+
+    N, C, H, W = 50, 32, 32, 32
+    for layout in ['NCHW', 'NHWC']:
+        shape = (N, C, H, W) if layout == 'NCHW' else (N, H, W, C)
+        x = (5 * np.random.randn(*shape) + 12).astype(np.float32)
+        dout = np.random.randn(*shape).astype(np.float32)
+        gamma = np.random.randn(C).astype(np.float32)
+        beta = np.random.randn(C).astype(np.float32)
+        bn_param = {'mode': 'train', 'layout': layout}
+
+        ref_out, ref_cache = spatial_batchnorm_forward(x.astype(np.float64), gamma.astype(np.float64),
+                                                       beta.astype(np.float64), dict(bn_param))
+        ref_dx = spatial_batchnorm_backward(dout.astype(np.float64), ref_cache)[0]
+        out, cache = spatial_batchnorm_forward(x, gamma, beta, dict(bn_param))
+        out_fused, cache_fused = spatial_batchnorm_forward_fused(x, gamma, beta, dict(bn_param))
+        dx = spatial_batchnorm_backward(dout, cache)[0]
+        dx_fused = spatial_batchnorm_backward_fused(dout, cache_fused)[0]
+        print('\nspatial batchnorm on %s %s float32, max abs error against float64:' % (layout, shape))
+        print('out: %.2e, fused %.2e' % (np.max(np.abs(out - ref_out)), np.max(np.abs(out_fused - ref_out))))
+        print('dx: %.2e, fused %.2e' % (np.max(np.abs(dx - ref_dx)), np.max(np.abs(dx_fused - ref_dx))))
+
+        forward = best_time(lambda: spatial_batchnorm_forward(x, gamma, beta, dict(bn_param)))
+        forward_fused = best_time(lambda: spatial_batchnorm_forward_fused(x, gamma, beta, dict(bn_param)))
+        backward = best_time(lambda: spatial_batchnorm_backward(dout, cache))
+        backward_fused = best_time(lambda: spatial_batchnorm_backward_fused(dout, cache_fused))
+        print('forward: %.2fms, fused %.2fms (%.1fx)' % (forward * 1e3, forward_fused * 1e3, forward / forward_fused))
+        print('backward: %.2fms, fused %.2fms (%.1fx)' % (backward * 1e3, backward_fused * 1e3, backward / backward_fused))
+
 def fully_connected_nets_with_batch_normalization():
     N, D, H1, H2, C = 2, 15, 20, 30, 10
     X = np.random.randn(N, D)
@@ -164,6 +235,44 @@ def batchnorm_for_deep_networks():
                     verbose=True, print_every=200)
     solver.train()
 
+def compile_for_inference_test(num_reps=200):
+    """
+    Compile batchnorm + dropout FullyConnectedNets for inference, check that
+    their scores match the test-time loss(X) and time both for single samples
+    and for batches. The wide net is dominated by its matrix products; in the
+    narrow, deep one the per-layer overhead that compiling removes dominates.
+    """
+    for hidden_dims, input_dim in [([500] * 4, 3 * 32 * 32), ([64] * 10, 256)]:
+        np.random.seed(0)
+        model = FullyConnectedNet(hidden_dims, input_dim=input_dim, dropout=0.25,
+                                  use_batchnorm=True, weight_scale=5e-2, dtype=np.float32)
+        # A few training-mode passes so the running statistics are not trivial
+        for _ in range(20):
+            X = (3 * np.random.randn(100, input_dim) + 1).astype(np.float32)
+            model.loss(X, np.random.randint(10, size=100))
+        compiled = model.compile_for_inference()
+
+        X = (3 * np.random.randn(1000, input_dim) + 1).astype(np.float32)
+        scores = model.loss(X)
+        print('%d hidden layers of %d:' % (len(hidden_dims), hidden_dims[0]))
+        print('max abs difference: ', np.max(np.abs(scores - compiled.loss(X))))
+        print('same predictions: ', np.array_equal(np.argmax(scores, axis=1), compiled.predict(X)))
+
+        for batch_size in [1, 100]:
+            x = X[:batch_size]
+            timings = {}
+            for name, f in [('loss(X)', lambda: model.loss(x)),
+                            ('predict', lambda: model.predict(x, batch_size=batch_size, return_scores=True)),
+                            ('compiled', lambda: compiled.predict(x, batch_size=batch_size, return_scores=True))]:
+                f()
+                t0 = time.time()
+                for _ in range(num_reps):
+                    f()
+                timings[name] = (time.time() - t0) / num_reps
+            print('batch of %d: ' % batch_size + ', '.join(
+                  '%s %.0fus' % (name, t * 1e6) for name, t in timings.items())
+                  + ', compiled at %.2f of loss(X)' % (timings['compiled'] / timings['loss(X)']))
+
 def main():
     """
     One way to make deep networks easier to train is more sophisticated
@@ -178,9 +287,15 @@ def main():
 
     # batchnorm_backward_alt_test()
 
+    # Fused batchnorm and spatial batchnorm
+    # fused_batchnorm_test()
+
     # Fully connected Nets with Batch Normalization
     # fully_connected_nets_with_batch_normalization()
 
+    # Batchnorm folded into the affine layers for inference
+    # compile_for_inference_test()
+
     batchnorm_for_deep_networks()
 
 if __name__ == '__main__':
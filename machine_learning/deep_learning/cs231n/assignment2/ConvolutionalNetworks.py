@@ -1,3 +1,5 @@
+import os
+import tracemalloc
 from time import time
 
 import numpy as np
@@ -5,15 +7,29 @@ import matplotlib.pyplot as plt
 from scipy.misc import imread, imresize
 
 from cs231n.classifiers.fast_layers import conv_forward_fast, conv_backward_fast,\
-    max_pool_forward_fast, max_pool_backward_fast
+    max_pool_forward_fast, max_pool_backward_fast, conv_forward_strides, conv_backward_strides,\
+    max_pool_forward_reshape, max_pool_backward_reshape, max_pool_forward_strides,\
+    max_pool_backward_strides, avg_pool_forward_fast, avg_pool_backward_fast,\
+    conv_forward_planned, conv_backward_planned, conv_forward_winograd, conv_backward_winograd,\
+    conv_forward_fft, conv_backward_fft, conv_forward_tiled, conv_backward_tiled,\
+    conv_forward_nhwc, conv_backward_nhwc, max_pool_forward_im2col, max_pool_backward_im2col,\
+    clear_conv_plans
+from cs231n.im2col_cython import im2col_cython, col2im_6d_cython, im2col_cython_parallel,\
+    col2im_6d_cython_parallel
 from cs231n.classifiers.layers import conv_forward_naive, conv_backward_naive,\
-    max_pool_forward_naive, max_pool_backward_naive
+    max_pool_forward_naive, max_pool_backward_naive, relu_forward, relu_backward,\
+    spatial_batchnorm_forward, spatial_batchnorm_backward
+from cs231n.classifiers.conv_backends import tune_conv
 from cs231n.classifiers.layer_utils import conv_relu_pool_forward, conv_relu_pool_backward,\
-    conv_relu_forward, conv_relu_backward
-from cs231n.gradient_check import eval_numerical_gradient, eval_numerical_gradient_array
+    conv_relu_forward, conv_relu_backward, conv_relu_pool_forward_fused, conv_relu_pool_backward_fused
+from cs231n.gradient_check import eval_numerical_gradient, eval_numerical_gradient_array,\
+    grad_check_sampled, format_grad_check
 from cs231n.classifiers.cnn import ThreeLayerConvNet
 from cs231n.datasets.cifar10 import get_CIFAR10_data
 from cs231n.classifiers.solver import Solver
+from cs231n.classifiers.augmentation import BatchAugmenter
+from cs231n.benchmark import run_benchmarks, format_results, save_results, load_results,\
+    compare_to_baseline, format_regressions
 
 def rel_error(x, y):
     """ returns relative error """
@@ -237,6 +253,390 @@ def fast_layers_test():
     print('speedup: %fx' % ((t1 - t0) / (t2 - t1)))
     print('dx difference: ', rel_error(dx_naive, dx_fast))
 
+def strided_pooling_test():
+    """
+    Check the strided window pooling engine against the naive max pooling and
+    numeric gradients, with overlapping 3x3 stride 2 windows as used by
+    AlexNet-style nets, check the strided and im2col engines on a rectangular
+    2x3 window, then time them against the reshape path.
+    """
+    x = np.random.randn(3, 2, 9, 11)
+    dout = np.random.randn(3, 2, 4, 5)
+    pool_param = {'pool_height': 3, 'pool_width': 3, 'stride': 2}
+
+    out_naive, cache_naive = max_pool_forward_naive(x, pool_param)
+    out, cache = max_pool_forward_fast(x, pool_param)
+    dx = max_pool_backward_fast(dout, cache)
+    dx_num = eval_numerical_gradient_array(lambda x: max_pool_forward_fast(x, pool_param)[0], x, dout)
+    print('Testing max_pool_forward_strides:')
+    print('difference: ', rel_error(out_naive, out))
+    print('dx difference (naive): ', rel_error(max_pool_backward_naive(dout, cache_naive), dx))
+    print('dx error: ', rel_error(dx_num, dx))
+
+    out, cache = avg_pool_forward_fast(x, pool_param)
+    dx = avg_pool_backward_fast(dout, cache)
+    dx_num = eval_numerical_gradient_array(lambda x: avg_pool_forward_fast(x, pool_param)[0], x, dout)
+    out_loop = np.array([[[[x[n, c, 2 * i:2 * i + 3, 2 * j:2 * j + 3].mean() for j in range(5)]
+                           for i in range(4)] for c in range(2)] for n in range(3)])
+    print('\nTesting avg_pool_forward_fast:')
+    print('difference: ', rel_error(out_loop, out))
+    print('dx error: ', rel_error(dx_num, dx))
+
+    x = np.random.randn(3, 2, 7, 8)
+    dout = np.random.randn(3, 2, 6, 6)
+    pool_param = {'pool_height': 2, 'pool_width': 3, 'stride': 1}
+    out_naive, cache_naive = max_pool_forward_naive(x, pool_param)
+    dx_naive = max_pool_backward_naive(dout, cache_naive)
+    print('\nTesting 2x3 pooling on a 7x8 input:')
+    for name, forward, backward in [('strides', max_pool_forward_strides, max_pool_backward_strides),
+                                    ('im2col', max_pool_forward_im2col, max_pool_backward_im2col)]:
+        out, cache = forward(x, pool_param)
+        print('%s difference: %e, dx difference: %e' % (
+              name, rel_error(out_naive, out), rel_error(dx_naive, backward(dout, cache))))
+
+    def best_time(f, *args):
+        elapsed = float('inf')
+        for _ in range(5):
+            t0 = time()
+            result = f(*args)
+            elapsed = min(elapsed, time() - t0)
+        return elapsed, result
+
+    x = np.random.randn(100, 32, 32, 32)
+    print('\nTiming on 100x32x32x32 input:')
+    for name, forward, backward, pool_param in [
+            ('max 2x2/2 reshape', max_pool_forward_reshape, max_pool_backward_reshape,
+             {'pool_height': 2, 'pool_width': 2, 'stride': 2}),
+            ('max 2x2/2 strides', max_pool_forward_strides, max_pool_backward_strides,
+             {'pool_height': 2, 'pool_width': 2, 'stride': 2}),
+            ('max 3x3/2 strides', max_pool_forward_strides, max_pool_backward_strides,
+             {'pool_height': 3, 'pool_width': 3, 'stride': 2}),
+            ('avg 3x3/2 strides', avg_pool_forward_fast, avg_pool_backward_fast,
+             {'pool_height': 3, 'pool_width': 3, 'stride': 2}),
+            ('max 3x3/2 naive', max_pool_forward_naive, max_pool_backward_naive,
+             {'pool_height': 3, 'pool_width': 3, 'stride': 2})]:
+        forward_t, (out, cache) = best_time(forward, x, pool_param)
+        backward_t, _ = best_time(backward, np.random.randn(*out.shape), cache)
+        print('%s: forward %fs, backward %fs' % (name, forward_t, backward_t))
+
+def nhwc_layout_test():
+    """
+    Check the channels-last conv, pool and spatial batchnorm layers against
+    their NCHW counterparts and numeric gradients, then measure what the NHWC
+    layout saves: conv_forward_strides computes its GEMM as (F, N * out_h * out_w)
+    and has to transpose and copy it into (N, F, out_h, out_w), while the NHWC
+    GEMM result already is the activation.
+    """
+    def to_nhwc(a):
+        return np.ascontiguousarray(a.transpose(0, 2, 3, 1))
+
+    x = np.random.randn(4, 3, 9, 9)
+    w = np.random.randn(5, 3, 3, 3)
+    b = np.random.randn(5,)
+    dout = np.random.randn(4, 5, 5, 5)
+    conv_param = {'stride': 2, 'pad': 1}
+    out, cache = conv_forward_strides(x, w, b, conv_param)
+    dx, dw, db = conv_backward_strides(dout, cache)
+    conv_param['layout'] = 'NHWC'
+    out_nhwc, cache_nhwc = conv_forward_nhwc(to_nhwc(x), w, b, conv_param)
+    dx_nhwc, dw_nhwc, db_nhwc = conv_backward_nhwc(to_nhwc(dout), cache_nhwc)
+    print('Testing conv_forward_nhwc:')
+    print('difference: ', rel_error(to_nhwc(out), out_nhwc))
+    print('dx difference: ', rel_error(to_nhwc(dx), dx_nhwc))
+    print('dw difference: ', rel_error(dw, dw_nhwc))
+    print('db difference: ', rel_error(db, db_nhwc))
+
+    x = np.random.randn(3, 2, 9, 11)
+    dout = np.random.randn(3, 2, 4, 5)
+    pool_param = {'pool_height': 3, 'pool_width': 3, 'stride': 2}
+    out, cache = max_pool_forward_fast(x, pool_param)
+    dx = max_pool_backward_fast(dout, cache)
+    pool_param['layout'] = 'NHWC'
+    out_nhwc, cache_nhwc = max_pool_forward_fast(to_nhwc(x), pool_param)
+    dx_nhwc = max_pool_backward_fast(to_nhwc(dout), cache_nhwc)
+    print('\nTesting max pooling with NHWC:')
+    print('difference: ', rel_error(to_nhwc(out), out_nhwc))
+    print('dx difference: ', rel_error(to_nhwc(dx), dx_nhwc))
+
+    x = 4 * np.random.randn(2, 4, 5, 3) + 10
+    gamma = np.random.randn(3)
+    beta = np.random.randn(3)
+    dout = np.random.randn(2, 4, 5, 3)
+    bn_param = {'mode': 'train', 'layout': 'NHWC'}
+    out, cache = spatial_batchnorm_forward(x, gamma, beta, bn_param)
+    dx, dgamma, dbeta = spatial_batchnorm_backward(dout, cache)
+    fx = lambda x: spatial_batchnorm_forward(x, gamma, beta, bn_param)[0]
+    fg = lambda g: spatial_batchnorm_forward(x, g, beta, bn_param)[0]
+    fb = lambda b: spatial_batchnorm_forward(x, gamma, b, bn_param)[0]
+    print('\nTesting spatial_batchnorm with NHWC:')
+    print('dx error: ', rel_error(eval_numerical_gradient_array(fx, x, dout), dx))
+    print('dgamma error: ', rel_error(eval_numerical_gradient_array(fg, gamma.copy(), dout), dgamma))
+    print('dbeta error: ', rel_error(eval_numerical_gradient_array(fb, beta.copy(), dout), dbeta))
+
+    def best_time(f, num_iters=5):
+        elapsed = float('inf')
+        for _ in range(num_iters):
+            t0 = time()
+            f()
+            elapsed = min(elapsed, time() - t0)
+        return elapsed
+
+    x = np.random.randn(50, 32, 32, 32).astype(np.float32)
+    w = np.random.randn(32, 32, 3, 3).astype(np.float32)
+    b = np.random.randn(32,).astype(np.float32)
+    gamma = np.ones(32, dtype=np.float32)
+    beta = np.zeros(32, dtype=np.float32)
+    res = np.random.randn(32, 50, 32, 32).astype(np.float32)
+    copy_t = best_time(lambda: np.ascontiguousarray(res.transpose(1, 0, 2, 3)))
+    print('\nTiming conv - batchnorm - relu - pool on 50x32x32x32 (float32):')
+    print('NCHW output transpose + copy alone: %fs' % copy_t)
+
+    for layout, x_layout in [('NCHW', x), ('NHWC', to_nhwc(x))]:
+        conv_param = {'stride': 1, 'pad': 1, 'layout': layout}
+        bn_param = {'mode': 'train', 'layout': layout}
+        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2, 'layout': layout}
+        conv_forward = conv_forward_nhwc if layout == 'NHWC' else conv_forward_strides
+        conv_backward = conv_backward_nhwc if layout == 'NHWC' else conv_backward_strides
+
+        def step():
+            a, conv_cache = conv_forward(x_layout, w, b, conv_param)
+            n, bn_cache = spatial_batchnorm_forward(a, gamma, beta, bn_param)
+            r, relu_cache = relu_forward(n)
+            out, pool_cache = max_pool_forward_fast(r, pool_param)
+            dr = max_pool_backward_fast(np.ones_like(out), pool_cache)
+            dn = relu_backward(dr, relu_cache)
+            da, _, _ = spatial_batchnorm_backward(dn, bn_cache)
+            conv_backward(da, conv_cache)
+
+        conv_t = best_time(lambda: conv_forward(x_layout, w, b, conv_param))
+        print('%s: conv forward %fs, forward + backward of the stack %fs' % (layout, conv_t, best_time(step)))
+
+def conv_plan_benchmark():
+    """
+    Steady-state cost of a Solver-like loop: the same shapes are convolved over
+    and over. conv_forward_strides pads and allocates its columns and output on
+    every call, conv_forward_planned reuses the buffers of a cached ConvPlan.
+    """
+    num_iters = 20
+    x = np.random.randn(50, 3, 32, 32).astype(np.float32)
+    w = np.random.randn(32, 3, 7, 7).astype(np.float32)
+    b = np.random.randn(32,).astype(np.float32)
+    dout = np.random.randn(50, 32, 32, 32).astype(np.float32)
+    conv_param = {'stride': 1, 'pad': 3}
+
+    impls = [('strides', conv_forward_strides, conv_backward_strides),
+             ('planned', conv_forward_planned, conv_backward_planned)]
+    times = {}
+    for name, forward, backward in impls:
+        # Warm up once so the plan is built outside the timed loop
+        out, cache = forward(x, w, b, conv_param)
+        backward(dout, cache)
+
+        # Keep the best of num_iters runs, the mean is too noisy on a busy box
+        forward_t, backward_t = float('inf'), float('inf')
+        for _ in range(num_iters):
+            t0 = time()
+            out, cache = forward(x, w, b, conv_param)
+            t1 = time()
+            backward(dout, cache)
+            t2 = time()
+            forward_t = min(forward_t, t1 - t0)
+            backward_t = min(backward_t, t2 - t1)
+        times[name] = (forward_t, backward_t)
+
+    out_strides, _ = conv_forward_strides(x, w, b, conv_param)
+    out_planned, _ = conv_forward_planned(x, w, b, conv_param)
+
+    print('Testing conv_forward_planned:')
+    for name, (forward_t, backward_t) in times.items():
+        print('%s: forward %fs, backward %fs' % (name, forward_t, backward_t))
+    print('Forward speedup: %fx' % (times['strides'][0] / times['planned'][0]))
+    print('Backward speedup: %fx' % (times['strides'][1] / times['planned'][1]))
+    print('Difference: ', rel_error(out_strides, out_planned))
+
+    # Two layers of the same shape share a plan: the backward pass of the first
+    # must not see the columns of the second
+    x2 = np.random.randn(*x.shape).astype(np.float32)
+    out1, cache1 = conv_forward_planned(x, w, b, conv_param)
+    out1_copy = out1.copy()
+    conv_forward_planned(x2, w, b, conv_param)
+    grads = conv_backward_planned(dout, cache1)
+    _, cache_strides = conv_forward_strides(x, w, b, conv_param)
+    grads_strides = conv_backward_strides(dout, cache_strides)
+    print('Two layers of one shape: out kept %s, difference dx %e, dw %e, db %e' % (
+        np.array_equal(out1, out1_copy), *(rel_error(g, gs) for g, gs in zip(grads, grads_strides))))
+
+def im2col_parallel_scaling():
+    """
+    Scaling of the nogil im2col / col2im_6d kernels from 1 to os.cpu_count()
+    threads, against the serial kernels they replace.
+    """
+    num_iters = 10
+    N, C, H, W = 50, 32, 32, 32
+    HH = WW = 3
+    pad, stride = 1, 1
+    out_h = (H + 2 * pad - HH) // stride + 1
+    out_w = (W + 2 * pad - WW) // stride + 1
+    x = np.random.randn(N, C, H, W).astype(np.float32)
+    cols = np.random.randn(C, HH, WW, N, out_h, out_w).astype(np.float32)
+
+    def best_of(f):
+        best = float('inf')
+        for _ in range(num_iters):
+            t0 = time()
+            f()
+            best = min(best, time() - t0)
+        return best
+
+    t_im2col = best_of(lambda: im2col_cython(x, HH, WW, pad, stride))
+    t_col2im = best_of(lambda: col2im_6d_cython(cols, N, C, H, W, HH, WW, pad, stride))
+    print('serial: im2col %fs, col2im_6d %fs' % (t_im2col, t_col2im))
+
+    for num_threads in range(1, (os.cpu_count() or 1) + 1):
+        t_im2col_p = best_of(lambda: im2col_cython_parallel(x, HH, WW, pad, stride,
+                                                            num_threads=num_threads))
+        t_col2im_p = best_of(lambda: col2im_6d_cython_parallel(cols, N, C, H, W, HH, WW, pad, stride,
+                                                               num_threads=num_threads))
+        print('%2d threads: im2col %fs (%.2fx), col2im_6d %fs (%.2fx)' % (
+              num_threads, t_im2col_p, t_im2col / t_im2col_p, t_col2im_p, t_col2im / t_col2im_p))
+
+    same_im2col = np.array_equal(im2col_cython(x, HH, WW, pad, stride),
+                                 im2col_cython_parallel(x, HH, WW, pad, stride))
+    same_col2im = np.array_equal(col2im_6d_cython(cols, N, C, H, W, HH, WW, pad, stride),
+                                 col2im_6d_cython_parallel(cols, N, C, H, W, HH, WW, pad, stride))
+    print('bit-identical: im2col {}, col2im_6d {}'.format(same_im2col, same_col2im))
+
+def conv_autotune_test():
+    """
+    Run the convolution auto-tuner on a few layer shapes and show what every
+    backend costs. The winners are written to the tuning file (see
+    conv_backends.py), so conv_relu_pool_forward in ThreeLayerConvNet picks
+    them up without re-tuning.
+    """
+    configs = [
+        ((50, 3, 32, 32), (32, 3, 7, 7), {'stride': 1, 'pad': 3}),
+        ((50, 32, 16, 16), (32, 32, 3, 3), {'stride': 1, 'pad': 1}),
+        ((50, 64, 8, 8), (32, 64, 1, 1), {'stride': 1, 'pad': 0}),
+    ]
+    for x_shape, w_shape, conv_param in configs:
+        x = np.random.randn(*x_shape).astype(np.float32)
+        w = np.random.randn(*w_shape).astype(np.float32)
+        b = np.random.randn(w_shape[0]).astype(np.float32)
+        choice = tune_conv(x, w, b, conv_param)
+
+        print('x {} w {} {}: {}'.format(x_shape, w_shape, conv_param, choice['backend']))
+        for name, t in sorted(choice['times'].items()):
+            print('    %-14s %s' % (name, 'pruned' if t is None else '%fs' % t))
+
+def winograd_fft_test():
+    """
+    Check the Winograd F(2x2, 3x3) and the FFT convolutions against
+    conv_forward_naive / conv_backward_naive and against numeric gradients.
+    """
+    configs = [
+        ('winograd', conv_forward_winograd, conv_backward_winograd, (3, 3, 3)),
+        ('fft', conv_forward_fft, conv_backward_fft, (3, 3, 3)),
+        ('fft', conv_forward_fft, conv_backward_fft, (3, 5, 5)),
+    ]
+    for name, forward, backward, (F, HH, WW) in configs:
+        # An odd spatial size checks the partial tiles at the border
+        x = np.random.randn(2, 3, 7, 7)
+        w = np.random.randn(F, 3, HH, WW)
+        b = np.random.randn(F,)
+        conv_param = {'stride': 1, 'pad': (HH - 1) // 2}
+
+        out_naive, cache_naive = conv_forward_naive(x, w, b, conv_param)
+        out, cache = forward(x, w, b, conv_param)
+        dout = np.random.randn(*out.shape)
+        dx_naive, dw_naive, db_naive = conv_backward_naive(dout, cache_naive)
+        dx, dw, db = backward(dout, cache)
+
+        dx_num = eval_numerical_gradient_array(lambda x: forward(x, w, b, conv_param)[0], x, dout)
+        dw_num = eval_numerical_gradient_array(lambda w: forward(x, w, b, conv_param)[0], w, dout)
+        db_num = eval_numerical_gradient_array(lambda b: forward(x, w, b, conv_param)[0], b, dout)
+
+        # All errors should be around 1e-9 or smaller
+        print('Testing conv_forward_%s with %dx%d filters' % (name, HH, WW))
+        print('difference from naive: ', rel_error(out_naive, out))
+        print('dx difference from naive: ', rel_error(dx_naive, dx))
+        print('dw difference from naive: ', rel_error(dw_naive, dw))
+        print('db difference from naive: ', rel_error(db_naive, db))
+        print('dx error: ', rel_error(dx_num, dx))
+        print('dw error: ', rel_error(dw_num, dw))
+        print('db error: ', rel_error(db_num, db))
+
+def winograd_fft_benchmark():
+    """
+    Forward + backward time of the stride 1 convolution paths for 3x3, 5x5
+    and 7x7 filters on CIFAR-sized float32 batches.
+    """
+    num_iters = 5
+    impls = [('planned', conv_forward_planned, conv_backward_planned),
+             ('winograd', conv_forward_winograd, conv_backward_winograd),
+             ('fft', conv_forward_fft, conv_backward_fft)]
+
+    print('%-22s %-10s %12s %12s' % ('shape', 'impl', 'forward', 'backward'))
+    for C, F, size, HH in [(3, 32, 32, 3), (32, 32, 16, 3), (3, 32, 32, 5), (3, 32, 32, 7), (32, 64, 16, 7)]:
+        x = np.random.randn(50, C, size, size).astype(np.float32)
+        w = np.random.randn(F, C, HH, HH).astype(np.float32)
+        b = np.random.randn(F,).astype(np.float32)
+        conv_param = {'stride': 1, 'pad': (HH - 1) // 2}
+        dout = np.random.randn(50, F, size, size).astype(np.float32)
+
+        for name, forward, backward in impls:
+            if name == 'winograd' and HH != 3:
+                continue
+            out, cache = forward(x, w, b, conv_param)
+            backward(dout, cache)
+
+            forward_t, backward_t = float('inf'), float('inf')
+            for _ in range(num_iters):
+                t0 = time()
+                out, cache = forward(x, w, b, conv_param)
+                t1 = time()
+                backward(dout, cache)
+                t2 = time()
+                forward_t = min(forward_t, t1 - t0)
+                backward_t = min(backward_t, t2 - t1)
+
+            shape = 'C=%d F=%d %dx%d k=%d' % (C, F, size, size, HH)
+            print('%-22s %-10s %11.4fs %11.4fs' % (shape, name, forward_t, backward_t))
+
+def tiled_conv_benchmark(batch_sizes=(64, 128, 256, 512)):
+    """
+    Peak memory and time of forward + backward for conv_forward_strides and
+    conv_forward_tiled on the ThreeLayerConvNet default layer (32 7x7 filters),
+    for growing batch sizes. NumPy reports its buffers to tracemalloc, so the
+    peak covers every temporary of the two passes.
+    """
+    w = np.random.randn(32, 3, 7, 7).astype(np.float32)
+    b = np.random.randn(32,).astype(np.float32)
+    impls = [('strides', conv_forward_strides, conv_backward_strides, {}),
+             ('tiled', conv_forward_tiled, conv_backward_tiled, {'tile_bytes': 32 * 1024 * 1024})]
+
+    print('%6s %-8s %12s %10s' % ('N', 'impl', 'peak MB', 'time'))
+    for N in batch_sizes:
+        x = np.random.randn(N, 3, 32, 32).astype(np.float32)
+        dout = np.random.randn(N, 32, 32, 32).astype(np.float32)
+        results = {}
+        for name, forward, backward, extra in impls:
+            conv_param = dict({'stride': 1, 'pad': 3}, **extra)
+
+            tracemalloc.start()
+            t0 = time()
+            out, cache = forward(x, w, b, conv_param)
+            dx, dw, db = backward(dout, cache)
+            elapsed = time() - t0
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            results[name] = (out, dx, dw)
+            del cache
+            print('%6d %-8s %12.1f %9.3fs' % (N, name, peak / 1024.0 ** 2, elapsed))
+
+        print('       difference: out %e, dx %e, dw %e' % tuple(
+              rel_error(a, b) for a, b in zip(results['strides'], results['tiled'])))
+
 def convolutional_sandwich_layers_test():
     x = np.random.randn(2, 3, 16, 16)
     w = np.random.randn(3, 3, 3, 3)
@@ -275,6 +675,70 @@ def convolutional_sandwich_layers_test():
     print('dw error: ', rel_error(dw_num, dw))
     print('db error: ', rel_error(db_num, db))
 
+def fused_conv_relu_pool_test():
+    """
+    Check conv_relu_pool_forward_fused against numeric gradients and the
+    unfused sandwich layer, then compare speed and cache size on the
+    ThreeLayerConvNet first layer.
+    """
+    x = np.random.randn(2, 3, 16, 16)
+    w = np.random.randn(3, 3, 3, 3)
+    b = np.random.randn(3,)
+    dout = np.random.randn(2, 3, 8, 8)
+    conv_param = {'stride': 1, 'pad': 1}
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+
+    out, cache = conv_relu_pool_forward_fused(x, w, b, conv_param, pool_param)
+    dx, dw, db = conv_relu_pool_backward_fused(dout, cache)
+
+    dx_num = eval_numerical_gradient_array(lambda x: conv_relu_pool_forward_fused(x, w, b, conv_param, pool_param)[0], x, dout)
+    dw_num = eval_numerical_gradient_array(lambda w: conv_relu_pool_forward_fused(x, w, b, conv_param, pool_param)[0], w, dout)
+    db_num = eval_numerical_gradient_array(lambda b: conv_relu_pool_forward_fused(x, w, b, conv_param, pool_param)[0], b, dout)
+
+    print('Testing conv_relu_pool_fused')
+    print('dx error: ', rel_error(dx_num, dx))
+    print('dw error: ', rel_error(dw_num, dw))
+    print('db error: ', rel_error(db_num, db))
+
+    def cache_bytes(cache):
+        # Bytes held by a cache on top of the layer inputs x, w and b
+        if isinstance(cache, np.ndarray):
+            return 0 if any(cache is a for a in (x, w, b)) else cache.nbytes
+        if isinstance(cache, (tuple, list)):
+            return sum(cache_bytes(c) for c in cache)
+        if hasattr(cache, 'x_cols'):
+            # A ConvPlan keeps its columns alive for the backward pass
+            return cache.x_cols.nbytes
+        return 0
+
+    num_iters = 5
+    x = np.random.randn(50, 3, 32, 32).astype(np.float32)
+    w = np.random.randn(32, 3, 7, 7).astype(np.float32)
+    b = np.random.randn(32,).astype(np.float32)
+    dout = np.random.randn(50, 32, 16, 16).astype(np.float32)
+    conv_param = {'stride': 1, 'pad': 3}
+
+    results = {}
+    for name, forward, backward in [('unfused', conv_relu_pool_forward, conv_relu_pool_backward),
+                                    ('fused', conv_relu_pool_forward_fused, conv_relu_pool_backward_fused)]:
+        out, cache = forward(x, w, b, conv_param, pool_param)
+        backward(dout, cache)
+        forward_t, backward_t = float('inf'), float('inf')
+        for _ in range(num_iters):
+            t0 = time()
+            out, cache = forward(x, w, b, conv_param, pool_param)
+            t1 = time()
+            grads = backward(dout, cache)
+            t2 = time()
+            forward_t = min(forward_t, t1 - t0)
+            backward_t = min(backward_t, t2 - t1)
+        results[name] = (out.copy(),) + grads
+        print('%s: forward %fs, backward %fs, cache %.1f MB' % (
+              name, forward_t, backward_t, cache_bytes(cache) / 1024.0 ** 2))
+
+    print('difference: out %e, dx %e, dw %e, db %e' % tuple(
+          rel_error(a, b) for a, b in zip(results['unfused'], results['fused'])))
+
 def three_layer_convnet_test():
     # model = ThreeLayerConvNet()
 
@@ -340,6 +804,207 @@ def three_layer_convnet_test():
     plt.ylabel('accuracy')
     plt.show()
 
+def sampled_grad_check_test(num_samples=10, num_processes=None):
+    """
+    Check grad_check_sampled against the exhaustive numerical gradients on a
+    conv layer and a small ThreeLayerConvNet, comparing the numerical values at
+    the sampled coordinates, then check a full-size ThreeLayerConvNet, which
+    the exhaustive check would take minutes on.
+    """
+    np.random.seed(231)
+    x = np.random.randn(4, 3, 5, 5)
+    w = np.random.randn(2, 3, 3, 3)
+    b = np.random.randn(2,)
+    dout = np.random.randn(4, 2, 5, 5)
+    conv_param = {'stride': 1, 'pad': 1}
+    out, cache = conv_forward_naive(x, w, b, conv_param)
+    dx, dw, db = conv_backward_naive(dout, cache)
+    exhaustive = {'x': eval_numerical_gradient_array(lambda x: conv_forward_naive(x, w, b, conv_param)[0], x, dout),
+                  'w': eval_numerical_gradient_array(lambda w: conv_forward_naive(x, w, b, conv_param)[0], w, dout),
+                  'b': eval_numerical_gradient_array(lambda b: conv_forward_naive(x, w, b, conv_param)[0], b, dout)}
+    results = grad_check_sampled(lambda: conv_forward_naive(x, w, b, conv_param)[0], {'x': x, 'w': w, 'b': b},
+                                 {'x': dx, 'w': dw, 'b': db}, df=dout, num_samples=num_samples,
+                                 num_processes=num_processes)
+    print('conv layer:')
+    print(format_grad_check(results))
+    print('difference to the exhaustive check: ' + ', '.join(
+        '{} {:.2e}'.format(name, np.max(np.abs(r['numeric'] - exhaustive[name][r['indices']])))
+        for name, r in results.items()))
+
+    X = np.random.randn(2, 3, 16, 16)
+    y = np.random.randint(10, size=2)
+    model = ThreeLayerConvNet(num_filters=3, filter_size=3, input_dim=(3, 16, 16), hidden_dim=7,
+                              dtype=np.float64)
+    loss, grads = model.loss(X, y)
+    f = lambda: model.loss(X, y)[0]
+    t0 = time()
+    exhaustive = {name: eval_numerical_gradient(lambda _: f(), model.params[name], verbose=False, h=1e-6)
+                  for name in sorted(grads)}
+    exhaustive_t = time() - t0
+    t0 = time()
+    results = grad_check_sampled(f, model.params, grads, num_samples=num_samples, h=1e-6,
+                                 num_processes=num_processes)
+    sampled_t = time() - t0
+    print('\nsmall ThreeLayerConvNet: exhaustive {:.2f}s, sampled {:.2f}s'.format(exhaustive_t, sampled_t))
+    print(format_grad_check(results))
+    print('difference to the exhaustive check: ' + ', '.join(
+        '{} {:.2e}'.format(name, np.max(np.abs(r['numeric'] - exhaustive[name][r['indices']])))
+        for name, r in results.items()))
+
+    model = ThreeLayerConvNet(dtype=np.float64)
+    X = np.random.randn(2, 3, 32, 32)
+    y = np.random.randint(10, size=2)
+    loss, grads = model.loss(X, y)
+    t0 = time()
+    results = grad_check_sampled(lambda: model.loss(X, y)[0], model.params, grads, num_samples=num_samples,
+                                 h=1e-6, num_processes=num_processes)
+    print('\nThreeLayerConvNet, {} parameters: sampled {:.2f}s'.format(
+        sum(v.size for v in model.params.values()), time() - t0))
+    print(format_grad_check(results))
+
+def augmentation_test():
+    """
+    Check BatchAugmenter against a loop that augments one image at a time with
+    the same random draws, time the two, and train a small ThreeLayerConvNet
+    with augmentation running on the Solver's prefetch thread.
+    """
+    def augment_loop(X, rng, pad, brightness, contrast):
+        N, C, H, W = X.shape
+        flipped = rng.rand(N) < 0.5
+        rows = rng.randint(2 * pad + 1, size=N)
+        cols = rng.randint(2 * pad + 1, size=N)
+        factors = rng.uniform(1 - contrast, 1 + contrast, size=N).astype(X.dtype)
+        offsets = rng.uniform(-brightness, brightness, size=N).astype(X.dtype)
+        out = np.empty_like(X)
+        for n in range(N):
+            image = X[n, :, :, ::-1] if flipped[n] else X[n]
+            image = np.pad(image, ((0, 0), (pad, pad), (pad, pad)), mode='constant')
+            image = image[:, rows[n]:rows[n] + H, cols[n]:cols[n] + W]
+            mean = image.mean()
+            out[n] = (image - mean) * factors[n] + mean + offsets[n]
+        return out
+
+    def to_nhwc(a):
+        return np.ascontiguousarray(a.transpose(0, 2, 3, 1))
+
+    x = np.random.randn(20, 3, 8, 8).astype(np.float32)
+    expected = augment_loop(x, np.random.RandomState(0), 2, 0.2, 0.3)
+    augmenter = BatchAugmenter(pad=2, brightness=0.2, contrast=0.3)
+    out = augmenter(x.copy(), np.random.RandomState(0))
+    print('Testing BatchAugmenter:')
+    print('difference: ', rel_error(expected, out))
+    augmenter = BatchAugmenter(pad=2, brightness=0.2, contrast=0.3, layout='NHWC')
+    out = augmenter(to_nhwc(x), np.random.RandomState(0))
+    print('NHWC difference: ', rel_error(to_nhwc(expected), out))
+
+    x = np.random.randn(128, 3, 32, 32).astype(np.float32)
+    augmenter = BatchAugmenter(pad=4, brightness=0.1, contrast=0.2)
+    batch = x.copy()
+    loop_t, batch_t = float('inf'), float('inf')
+    for _ in range(5):
+        t0 = time()
+        augment_loop(x, np.random.RandomState(0), 4, 0.1, 0.2)
+        t1 = time()
+        batch[...] = x
+        augmenter(batch, np.random.RandomState(0))
+        t2 = time()
+        loop_t = min(loop_t, t1 - t0)
+        batch_t = min(batch_t, t2 - t1)
+    print('\nAugmenting 128x3x32x32 (float32):')
+    print('per-image loop: %fs' % loop_t)
+    print('BatchAugmenter: %fs' % batch_t)
+    print('speedup: %fx' % (loop_t / batch_t))
+
+    num_train = 200
+    data = {
+        'X_train': np.random.randn(num_train, 3, 16, 16),
+        'y_train': np.random.randint(10, size=num_train),
+        'X_val': np.random.randn(50, 3, 16, 16),
+        'y_val': np.random.randint(10, size=50),
+    }
+    for augment in [None, BatchAugmenter(pad=2, brightness=0.1, contrast=0.1)]:
+        model = ThreeLayerConvNet(input_dim=(3, 16, 16), num_filters=8, hidden_dim=50)
+        solver = Solver(model, data, num_epochs=2, batch_size=50, update_rule='adam',
+                        optim_config={'learning_rate': 1e-3}, augment=augment, verbose=False)
+        t0 = time()
+        solver.train()
+        print('\nSolver, augment=%s: %fs, final loss %f' % (
+              type(augment).__name__, time() - t0, solver.loss_history[-1]))
+
+def convnet_predict_test(num_samples=1000, thread_counts=(1, 2, 4)):
+    """
+    Check ThreeLayerConvNet.predict against loss(X) for both layouts, and time
+    it against the chunked loss(X) loop.
+    """
+    X = np.random.randn(num_samples, 3, 32, 32).astype(np.float32)
+    for layout in ['NCHW', 'NHWC']:
+        model = ThreeLayerConvNet(weight_scale=1e-2, layout=layout)
+        # Tune the convolution for the chunk shape outside the timings
+        model.loss(X[:100])
+        model.predict(X[:100])
+
+        t0 = time()
+        scores = np.vstack([model.loss(X[start:start + 100]) for start in range(0, num_samples, 100)])
+        loss_t = time() - t0
+        print('%s: loss(X) in chunks of 100: %fs' % (layout, loss_t))
+        for num_threads in thread_counts:
+            # Best of 3, as the first call on new threads pays for fresh malloc arenas
+            predict_t = float('inf')
+            for _ in range(3):
+                t0 = time()
+                predicted = model.predict(X, batch_size=100, num_threads=num_threads, return_scores=True)
+                predict_t = min(predict_t, time() - t0)
+            print('%s: predict, %d threads: %fs (%.2fx), difference %e' % (
+                  layout, num_threads, predict_t, loss_t / predict_t, rel_error(scores, predicted)))
+
+def convnet_checkpoint_test(batch_size=100, num_iters=3):
+    """
+    Compare the gradients, memory and time of a ThreeLayerConvNet training
+    step with and without checkpointing its convolutional layer. Two memory
+    figures are reported: the peak_cache_bytes of the model, and the tracemalloc
+    peak of a step run after clear_conv_plans, so that the buffers of a
+    ConvPlan are counted too. A first step before it runs the tuner, if needed.
+    """
+    X = np.random.randn(batch_size, 3, 32, 32).astype(np.float32)
+    y = np.random.randint(10, size=batch_size)
+    for fused in [False, True]:
+        results = {}
+        for checkpoint in [False, True]:
+            np.random.seed(0)
+            model = ThreeLayerConvNet(weight_scale=1e-2, fused=fused, checkpoint=checkpoint)
+            model.loss(X, y)
+            clear_conv_plans()
+            tracemalloc.start()
+            loss, grads = model.loss(X, y)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            elapsed = float('inf')
+            for _ in range(num_iters):
+                t0 = time()
+                model.loss(X, y)
+                elapsed = min(elapsed, time() - t0)
+            results[checkpoint] = grads
+            print('fused=%s, checkpoint=%s: caches %.1f MB, peak %.1f MB, %fs per step' % (
+                  fused, checkpoint, model.peak_cache_bytes / 1024.0 ** 2, peak / 1024.0 ** 2, elapsed))
+        print('max grad difference: %e' % max(rel_error(results[False][k], results[True][k])
+                                               for k in results[False]))
+
+def layer_benchmark_suite(output='benchmark_results.json', baseline='benchmark_baseline.json',
+                          quick=True):
+    """
+    Run the layer benchmark suite, save the results to output and report the
+    regressions against the results saved in baseline. Without a baseline
+    file, the results are saved as the baseline for later runs.
+    """
+    results = run_benchmarks(quick=quick, verbose=False)
+    print(format_results(results))
+    save_results(results, output)
+    if os.path.exists(baseline):
+        print(format_regressions(compare_to_baseline(results, load_results(baseline))))
+    else:
+        save_results(results, baseline)
+        print('No baseline found; saved these results as %s' % baseline)
+
 def main():
     # Naive forward pass
     # naive_forward_pass()
@@ -363,8 +1028,37 @@ def main():
     """
     # fast_layers_test()
 
+    # strided_pooling_test()
+
+    # nhwc_layout_test()
+
+    # conv_plan_benchmark()
+
+    # im2col_parallel_scaling()
+
+    # conv_autotune_test()
+
+    # winograd_fft_test()
+
+    # winograd_fft_benchmark()
+
+    # tiled_conv_benchmark()
+
     # convolutional_sandwich_layers_test()
 
+    # fused_conv_relu_pool_test()
+
+    # Sampled gradient check in a process pool
+    # sampled_grad_check_test()
+
+    # augmentation_test()
+
+    # convnet_predict_test()
+
+    # convnet_checkpoint_test()
+
+    # layer_benchmark_suite()
+
     three_layer_convnet_test()
 
 if __name__ == '__main__':
@@ -1,11 +1,23 @@
+import os
+import tracemalloc
+from time import time
+
 import matplotlib.pyplot as plt
 import numpy as np
 
 from cs231n.classifiers.fc_net import TwoLayerNet, FullyConnectedNet
 from cs231n.classifiers.layers import affine_forward, affine_backward, relu_forward, relu_backward
 from cs231n.classifiers.layer_utils import affine_relu_forward, affine_relu_backward
+from cs231n.classifiers import optim
 from cs231n.classifiers.optim import sgd_momentum, rmsprop, adam
+from cs231n.classifiers.flat_params import FlatParams
+from cs231n.classifiers.batch_loader import BatchLoader
 from cs231n.classifiers.solver import Solver
+from cs231n.classifiers.search import HyperparameterSearch
+from cs231n.classifiers.dtype_policy import set_strict_dtypes
+from cs231n.classifiers.profiler import Profiler
+from cs231n.classifiers.checkpoint import save_checkpoint, load_checkpoint
+from cs231n.classifiers.quantization import quantize_fc_net
 from cs231n.datasets.cifar10 import get_CIFAR10_data
 from cs231n.gradient_check import eval_numerical_gradient, eval_numerical_gradient_array
 
@@ -562,6 +574,518 @@ def train_best_model():
     plt.ylabel('Clasification accuracy')
     plt.show() 
 
+def dtype_benchmark(num_train=4000, num_epochs=2):
+    """
+    Time full Solver epochs of a batchnorm + dropout FullyConnectedNet trained
+    with Adam in float64 and in float32. The data is cast to the model dtype
+    once up front. The float32 run uses strict dtype mode, so it fails if any
+    layer or update rule upcasts to float64 along the way.
+
+    Random CIFAR-10 shaped data is used so the benchmark runs without the
+    dataset; the timings do not depend on the values.
+    """
+    X_train = np.random.randn(num_train, 3, 32, 32)
+    y_train = np.random.randint(10, size=num_train)
+    X_val = np.random.randn(1000, 3, 32, 32)
+    y_val = np.random.randint(10, size=1000)
+
+    times = {}
+    for dtype in [np.float64, np.float32]:
+        data = {
+            'X_train': X_train.astype(dtype),
+            'y_train': y_train,
+            'X_val': X_val.astype(dtype),
+            'y_val': y_val,
+        }
+        np.random.seed(0)
+        model = FullyConnectedNet([500, 500, 500], dropout=0.25, use_batchnorm=True,
+                                  weight_scale=5e-2, dtype=dtype)
+        solver = Solver(model, data, num_epochs=num_epochs, batch_size=100,
+                        update_rule='adam', optim_config={'learning_rate': 1e-3},
+                        verbose=False)
+        previous = set_strict_dtypes(dtype == np.float32)
+        try:
+            t0 = time()
+            solver.train()
+            times[dtype] = (time() - t0) / num_epochs
+        finally:
+            set_strict_dtypes(previous)
+        print('{}: {:.2f}s per epoch, final loss {:.4f}'.format(np.dtype(dtype).name, times[dtype],
+                                                                solver.loss_history[-1]))
+
+    print('float32 speedup: {:.2f}x'.format(times[np.float64] / times[np.float32]))
+
+def flat_params_benchmark(num_steps=200):
+    """
+    Cost of the parameter update alone for deep FullyConnectedNets with
+    batchnorm, like the configurations used in hyperparameter sweeps: one
+    update rule call per parameter against one call over a FlatParams buffer.
+    The narrower and deeper the net, the more the per-parameter Python
+    overhead dominates. Also checks that both give the same parameters.
+    """
+    for hidden_dims, input_dim in [([100] * 10, 3 * 32 * 32), ([64] * 20, 256)]:
+        np.random.seed(0)
+        model = FullyConnectedNet(hidden_dims, input_dim=input_dim, use_batchnorm=True,
+                                  weight_scale=5e-2)
+        X = np.random.randn(100, input_dim)
+        y = np.random.randint(10, size=100)
+        _, grads = model.loss(X, y)
+        print('{} hidden layers of {}: {} parameter arrays, {} values'.format(
+            len(hidden_dims), hidden_dims[0], len(model.params),
+            sum(v.size for v in model.params.values())))
+
+        for update_rule in ['sgd_momentum', 'rmsprop', 'adam']:
+            rule = getattr(optim, update_rule)
+
+            params = {k: v.copy() for k, v in model.params.items()}
+            configs = {k: {'learning_rate': 1e-3} for k in params}
+            t0 = time()
+            for _ in range(num_steps):
+                for k in params:
+                    params[k], configs[k] = rule(params[k], grads[k], configs[k])
+            per_param_t = (time() - t0) / num_steps
+
+            flat = FlatParams(model.params)
+            config = {'learning_rate': 1e-3, 'inplace': True}
+            t0 = time()
+            for _ in range(num_steps):
+                flat.set_grads(grads)
+                rule(flat.data, flat.grad, config)
+            flat_t = (time() - t0) / num_steps
+
+            error = max(rel_error(params[k], flat.params[k]) for k in params)
+            print('  {}: per parameter {:.0f}us, flat {:.0f}us ({:.1f}x), max difference {:.2e}'.format(
+                update_rule, per_param_t * 1e6, flat_t * 1e6, per_param_t / flat_t, error))
+
+def batch_loader_test(num_train=20000, batch_size=200, num_steps=100):
+    """
+    Check that a BatchLoader visits every sample exactly once per epoch, then
+    compare the training loop of a FullyConnectedNet fed by the old
+    np.random.choice + fancy indexing on the training thread against the
+    loader without and with background prefetching.
+    """
+    ids = np.arange(1003)
+    with BatchLoader(ids, ids, batch_size=100, num_prefetch=2) as loader:
+        for epoch in range(3):
+            seen = []
+            for _ in range(loader.batches_per_epoch):
+                X_batch, y_batch = loader.next_batch()
+                assert np.array_equal(X_batch, y_batch)
+                seen.append(X_batch.copy())
+            seen = np.concatenate(seen)
+            print('epoch {}: {} batches, every sample exactly once: {}'.format(
+                epoch, loader.batches_per_epoch, np.array_equal(np.sort(seen), ids)))
+
+    X_train = np.random.randn(num_train, 3 * 32 * 32).astype(np.float32)
+    y_train = np.random.randint(10, size=num_train)
+    model = FullyConnectedNet([100, 100], weight_scale=5e-2)
+
+    t0 = time()
+    for _ in range(num_steps):
+        batch_mask = np.random.choice(num_train, batch_size)
+        X_train[batch_mask], y_train[batch_mask]
+    print('gather alone: {:.2f}ms per batch'.format((time() - t0) / num_steps * 1e3))
+
+    t0 = time()
+    for _ in range(num_steps):
+        batch_mask = np.random.choice(num_train, batch_size)
+        model.loss(X_train[batch_mask], y_train[batch_mask])
+    print('fancy indexing: {:.2f}ms per step'.format((time() - t0) / num_steps * 1e3))
+
+    for num_prefetch in [0, 2]:
+        with BatchLoader(X_train, y_train, batch_size, num_prefetch=num_prefetch) as loader:
+            loader.next_batch()
+            t0 = time()
+            for _ in range(num_steps):
+                model.loss(*loader.next_batch())
+            print('BatchLoader(num_prefetch={}): {:.2f}ms per step'.format(
+                num_prefetch, (time() - t0) / num_steps * 1e3))
+
+def data_parallel_test(num_train=4000, num_epochs=1, worker_counts=(1, 2, 4, 8, 16)):
+    """
+    Check that data-parallel training gives the same parameters as training in
+    one process, then time epochs of a FullyConnectedNet for a range of worker
+    counts and plot the speedup over one process. Worker counts above the
+    number of cores are still run, they just cannot scale.
+
+    Set OMP_NUM_THREADS=1 (or the variable of your BLAS) before starting
+    Python, so the workers do not compete with BLAS threads.
+    """
+    def make_solver(data, num_workers, **kwargs):
+        np.random.seed(0)
+        model = FullyConnectedNet([100, 100], weight_scale=5e-2, reg=0.1, dtype=np.float64)
+        solver = Solver(model, data, num_workers=num_workers, update_rule='adam',
+                        optim_config={'learning_rate': 1e-3}, verbose=False, **kwargs)
+        np.random.seed(1)
+        return solver
+
+    data = {
+        'X_train': np.random.randn(500, 3 * 32 * 32),
+        'y_train': np.random.randint(10, size=500),
+        'X_val': np.random.randn(100, 3 * 32 * 32),
+        'y_val': np.random.randint(10, size=100),
+    }
+    solvers = {}
+    for num_workers in [0, 3]:
+        solvers[num_workers] = make_solver(data, num_workers, num_epochs=2, batch_size=64)
+        solvers[num_workers].train()
+    print('num_workers=3 against one process:')
+    print('loss difference: ', rel_error(np.array(solvers[0].loss_history),
+                                         np.array(solvers[3].loss_history)))
+    for k in sorted(solvers[0].model.params):
+        print('%s difference: %e' % (k, rel_error(solvers[0].model.params[k], solvers[3].model.params[k])))
+
+    data = {
+        'X_train': np.random.randn(num_train, 3 * 32 * 32).astype(np.float32),
+        'y_train': np.random.randint(10, size=num_train),
+        'X_val': np.random.randn(100, 3 * 32 * 32).astype(np.float32),
+        'y_val': np.random.randint(10, size=100),
+    }
+    print('\n{} cores, {} training samples, batch size 256:'.format(os.cpu_count(), num_train))
+    times = {}
+    for num_workers in (0,) + tuple(worker_counts):
+        solver = make_solver(data, num_workers, num_epochs=num_epochs, batch_size=256)
+        t0 = time()
+        solver.train()
+        times[num_workers] = (time() - t0) / num_epochs
+        print('num_workers={}: {:.2f}s per epoch, {:.2f}x'.format(
+            num_workers, times[num_workers], times[0] / times[num_workers]))
+
+    plt.plot(worker_counts, [times[0] / times[k] for k in worker_counts], '-o')
+    plt.plot(worker_counts, worker_counts, '--')
+    plt.xlabel('worker processes')
+    plt.ylabel('speedup over one process')
+    plt.show()
+
+def async_validation_test(num_train=4000, num_val=10000, num_epochs=3):
+    """
+    Train the same FullyConnectedNet with the accuracy checks in the training
+    loop and in a side process, check that both record the same validation
+    accuracies and best parameters, and compare their wall-clock times. The
+    large validation set makes the checks a sizeable part of an epoch; the
+    side process can only hide them with a spare core.
+    """
+    data = {
+        'X_train': np.random.randn(num_train, 3 * 32 * 32).astype(np.float32),
+        'y_train': np.random.randint(10, size=num_train),
+        'X_val': np.random.randn(num_val, 3 * 32 * 32).astype(np.float32),
+        'y_val': np.random.randint(10, size=num_val),
+    }
+    print('{} cores'.format(os.cpu_count()))
+    for use_batchnorm in [False, True]:
+        solvers = {}
+        for async_validation in [False, True]:
+            np.random.seed(0)
+            model = FullyConnectedNet([200, 200], use_batchnorm=use_batchnorm, weight_scale=5e-2)
+            solver = Solver(model, data, num_epochs=num_epochs, batch_size=100, update_rule='adam',
+                            optim_config={'learning_rate': 1e-3}, async_validation=async_validation,
+                            verbose=False)
+            t0 = time()
+            solver.train()
+            print('use_batchnorm={}, async_validation={}: {:.2f}s'.format(
+                use_batchnorm, async_validation, time() - t0))
+            solvers[async_validation] = solver
+
+        print('same val_acc_history: ', solvers[False].val_acc_history == solvers[True].val_acc_history)
+        print('best params difference: ', max(rel_error(solvers[False].best_params[k], solvers[True].best_params[k])
+                                              for k in solvers[False].best_params))
+
+def predict_benchmark(num_samples=10000, thread_counts=(1, 2, 4)):
+    """
+    Score a batchnorm + dropout FullyConnectedNet with the chunked loss(X) loop
+    that check_accuracy used to run and with predict on 1 or more threads,
+    checking that they agree.
+    """
+    X = np.random.randn(num_samples, 3 * 32 * 32)
+    model = FullyConnectedNet([500, 500, 500], dropout=0.25, use_batchnorm=True, weight_scale=5e-2)
+    model.loss(X[:200], np.random.randint(10, size=200))
+
+    t0 = time()
+    scores = np.vstack([model.loss(X[start:start + 100]) for start in range(0, num_samples, 100)])
+    loss_t = time() - t0
+    print('{} cores, {} samples:'.format(os.cpu_count(), num_samples))
+    print('loss(X) in chunks of 100: {:.3f}s'.format(loss_t))
+    for num_threads in thread_counts:
+        # Best of 3, as the first call on new threads pays for fresh malloc arenas
+        predict_t = float('inf')
+        for _ in range(3):
+            t0 = time()
+            predicted = model.predict(X, batch_size=100, num_threads=num_threads, return_scores=True)
+            predict_t = min(predict_t, time() - t0)
+        print('predict, {} threads: {:.3f}s ({:.2f}x), difference {:.2e}'.format(
+            num_threads, predict_t, loss_t / predict_t, rel_error(scores, predicted)))
+
+def checkpointing_test(hidden_dims=[512] * 16, batch_size=500, num_iters=3):
+    """
+    Check that activation checkpointing leaves the loss, gradients and batchnorm
+    running averages of a batchnorm + dropout FullyConnectedNet unchanged, then
+    measure the bytes held in caches (peak_cache_bytes), the peak memory of a
+    training step and its time for a range of checkpoint_every values.
+    """
+    X = np.random.randn(20, 15)
+    y = np.random.randint(10, size=20)
+    results = {}
+    for checkpoint_every in [None, 1, 2, 3]:
+        np.random.seed(0)
+        model = FullyConnectedNet([8, 7, 6, 5, 4], input_dim=15, dropout=0.3, use_batchnorm=True,
+                                  dtype=np.float64, checkpoint_every=checkpoint_every)
+        loss, grads = model.loss(X, y)
+        results[checkpoint_every] = (loss, grads, model.bn_params)
+    loss, grads, bn_params = results[None]
+    for checkpoint_every in [1, 2, 3]:
+        other_loss, other_grads, other_bn_params = results[checkpoint_every]
+        print('checkpoint_every={}: loss difference {:.2e}, max grad difference {:.2e}, '
+              'max running_mean difference {:.2e}'.format(
+              checkpoint_every, abs(loss - other_loss),
+              max(rel_error(grads[k], other_grads[k]) for k in grads),
+              max(rel_error(a['running_mean'], b['running_mean']) for a, b in zip(bn_params, other_bn_params))))
+
+    X = np.random.randn(batch_size, 3 * 32 * 32).astype(np.float32)
+    y = np.random.randint(10, size=batch_size)
+    print('\n{} hidden layers of {}, batch size {}:'.format(len(hidden_dims), hidden_dims[0], batch_size))
+    baseline = None
+    for checkpoint_every in [None, 1, 2, 4, 8]:
+        model = FullyConnectedNet(hidden_dims, dropout=0.25, use_batchnorm=True, weight_scale=5e-2,
+                                  checkpoint_every=checkpoint_every)
+        model.loss(X, y)
+        elapsed = float('inf')
+        for _ in range(num_iters):
+            t0 = time()
+            model.loss(X, y)
+            elapsed = min(elapsed, time() - t0)
+        tracemalloc.start()
+        model.loss(X, y)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if baseline is None:
+            baseline = (peak, elapsed)
+        print('checkpoint_every={}: caches {:.1f} MB, peak {:.1f} MB (saves {:.1f} MB), '
+              '{:.3f}s per step ({:.2f}x)'.format(
+              checkpoint_every, model.peak_cache_bytes / 1024.0 ** 2, peak / 1024.0 ** 2,
+              (baseline[0] - peak) / 1024.0 ** 2, elapsed, elapsed / baseline[1]))
+
+def profiler_test(trace_dir='.', num_train=2000, num_epochs=2):
+    """
+    Profile the training of a batchnorm + dropout FullyConnectedNet, print the
+    summary table and write the trace as CSV, JSON and Chrome trace into
+    trace_dir. Also time the same training without the profiler, with it and
+    with it tracking memory, to show what the profiler itself costs.
+    """
+    data = {
+        'X_train': np.random.randn(num_train, 3 * 32 * 32).astype(np.float32),
+        'y_train': np.random.randint(10, size=num_train),
+        'X_val': np.random.randn(500, 3 * 32 * 32).astype(np.float32),
+        'y_val': np.random.randint(10, size=500),
+    }
+
+    def train(profiler):
+        np.random.seed(0)
+        model = FullyConnectedNet([256, 256, 256], weight_scale=5e-2, dropout=0.25, use_batchnorm=True)
+        solver = Solver(model, data, num_epochs=num_epochs, batch_size=100, update_rule='adam',
+                        optim_config={'learning_rate': 1e-3}, verbose=False, profiler=profiler)
+        t0 = time()
+        solver.train()
+        return time() - t0
+
+    train(None)
+    elapsed = train(None)
+    elapsed_time_only = train(Profiler(memory=False))
+    profiler = Profiler()
+    elapsed_memory = train(profiler)
+    print(profiler.summary())
+    print('\nTraining took {:.2f}s, {:.2f}s ({:.2f}x) with the profiler, {:.2f}s ({:.2f}x) '
+          'with memory tracking'.format(elapsed, elapsed_time_only, elapsed_time_only / elapsed,
+                                        elapsed_memory, elapsed_memory / elapsed))
+
+    for name, write in [('profile.csv', profiler.write_csv), ('profile.json', profiler.write_json),
+                        ('profile_trace.json', profiler.write_chrome_trace)]:
+        write(os.path.join(trace_dir, name))
+        print('Wrote', os.path.join(trace_dir, name))
+
+def solver_checkpoint_test(ckpt_dir='.', hidden_dims=[2048] * 8, num_train=2000, num_epochs=4):
+    """
+    Save a large model as a checkpoint and time opening it memory-mapped
+    against reading the same arrays from an .npz file. Then interrupt a
+    training run after half its epochs, resume it in a new Solver from the
+    checkpoint, and check the restored parameters and Adam state, with and
+    without flat_params. Last, time training with a checkpoint every epoch
+    against training without.
+    """
+    np.random.seed(0)
+    model = FullyConnectedNet(hidden_dims, weight_scale=1e-2)
+    path = os.path.join(ckpt_dir, 'model.ckpt')
+    npz_path = os.path.join(ckpt_dir, 'model.npz')
+    num_bytes = sum(v.nbytes for v in model.params.values())
+    t0 = time()
+    save_checkpoint(path, model.params)
+    save_t = time() - t0
+    np.savez(npz_path, **model.params)
+    t0 = time()
+    params, _ = load_checkpoint(path)
+    load_t = time() - t0
+    t0 = time()
+    with np.load(npz_path) as f:
+        npz_params = {k: f[k] for k in f.files}
+    npz_t = time() - t0
+    print('{:.1f} MB model: saved in {:.3f}s, opened in {:.2f} ms (.npz: {:.1f} ms), identical: {}'.format(
+        num_bytes / 2.0 ** 20, save_t, load_t * 1e3, npz_t * 1e3,
+        all(np.array_equal(params[k], v) and np.array_equal(npz_params[k], v) for k, v in model.params.items())))
+    del params, npz_params
+    os.remove(npz_path)
+
+    data = {
+        'X_train': np.random.randn(num_train, 3 * 32 * 32).astype(np.float32),
+        'y_train': np.random.randint(10, size=num_train),
+        'X_val': np.random.randn(500, 3 * 32 * 32).astype(np.float32),
+        'y_val': np.random.randint(10, size=500),
+    }
+    for flat_params in (True, False):
+        np.random.seed(0)
+        kwargs = dict(num_epochs=num_epochs, batch_size=100, update_rule='adam', flat_params=flat_params,
+                      optim_config={'learning_rate': 1e-3}, verbose=False)
+        first = Solver(FullyConnectedNet([256, 256], weight_scale=5e-2), data,
+                       **dict(kwargs, num_epochs=num_epochs // 2, checkpoint_path=path))
+        first.train()
+        if flat_params:
+            last_params, last_config = first.flat.copy_params(), first.flat_config
+        else:
+            last_params = first.model.params
+            last_config = first.optim_configs['W1']
+
+        resumed = Solver(FullyConnectedNet([256, 256], weight_scale=5e-2), data, **kwargs)
+        resumed.resume_from(path)
+        config = resumed.flat_config if flat_params else resumed.optim_configs['W1']
+        # train() swaps the best parameters into first.model, so without
+        # flat_params the last iterate is only in the checkpoint
+        params_match = (not flat_params or
+                        all(np.array_equal(resumed.model.params[k], v) for k, v in last_params.items()))
+        state_match = all(np.array_equal(config[k], last_config[k]) for k in ('m', 'v', 't', 'learning_rate'))
+        best_match = all(np.array_equal(resumed.best_params[k], v) for k, v in first.best_params.items())
+        resumed.train()
+        print('flat_params={}: params {}, Adam state {}, best params {}; resumed at epoch {}, '
+              'finished at epoch {} with {} accuracy checks'.format(
+                  flat_params, params_match, state_match, best_match, first.epoch, resumed.epoch,
+                  len(resumed.val_acc_history)))
+
+    def train(checkpoint_path):
+        np.random.seed(0)
+        solver = Solver(FullyConnectedNet([1024, 1024], weight_scale=5e-2), data, num_epochs=num_epochs,
+                        batch_size=100, update_rule='adam', optim_config={'learning_rate': 1e-3},
+                        verbose=False, checkpoint_path=checkpoint_path)
+        t0 = time()
+        solver.train()
+        return time() - t0
+
+    train(None)
+    elapsed = train(None)
+    elapsed_checkpoint = train(path)
+    print('Training took {:.2f}s, {:.2f}s ({:.2f}x) with a checkpoint every epoch'.format(
+        elapsed, elapsed_checkpoint, elapsed_checkpoint / elapsed))
+    os.remove(path)
+
+def quantization_test(data=None, hidden_dims=[512, 256], num_train=10000, num_epochs=5, num_calib=500,
+                      num_repeats=5):
+    """
+    Train a batchnorm FullyConnectedNet, quantize it to int8 with the first
+    num_calib validation samples for calibration, and compare the quantized
+    model to the float one on the rest of the validation set: accuracy,
+    agreement of the predictions, latency of predict, size of the parameters
+    and peak memory of the forward pass. data is a dictionary as for Solver,
+    by default a subset of CIFAR-10.
+    """
+    if data is None:
+        X_train, y_train, X_val, y_val, X_test, y_test = get_CIFAR10_data()
+        data = {
+            'X_train': X_train[:num_train].reshape(min(num_train, X_train.shape[0]), -1).astype(np.float32),
+            'y_train': y_train[:num_train],
+            'X_val': X_val.reshape(X_val.shape[0], -1).astype(np.float32),
+            'y_val': y_val,
+        }
+        mean = data['X_train'].mean(axis=0)
+        data['X_train'] -= mean
+        data['X_val'] -= mean
+    np.random.seed(0)
+    model = FullyConnectedNet(hidden_dims, input_dim=data['X_train'].shape[1], use_batchnorm=True,
+                              weight_scale=5e-2)
+    solver = Solver(model, data, num_epochs=num_epochs, batch_size=100, update_rule='adam',
+                    optim_config={'learning_rate': 1e-3}, verbose=False)
+    solver.train()
+
+    X_calib = data['X_val'][:num_calib]
+    X, y = data['X_val'][num_calib:], data['y_val'][num_calib:]
+    t0 = time()
+    qmodel = quantize_fc_net(model, X_calib)
+    print('Quantized in {:.3f}s with {} calibration samples'.format(time() - t0, num_calib))
+
+    float_pred = model.predict(X)
+    quant_pred = qmodel.predict(X)
+    float_acc, quant_acc = np.mean(float_pred == y), np.mean(quant_pred == y)
+    print('Accuracy on {} samples: float {:.4f}, int8 {:.4f} (delta {:+.4f}), same prediction on {:.2%}'.format(
+        len(y), float_acc, quant_acc, quant_acc - float_acc, np.mean(float_pred == quant_pred)))
+
+    float_bytes = sum(v.nbytes for v in model.params.values())
+    print('Parameters: float {:.2f} MB, int8 {:.2f} MB ({:.2f}x smaller)'.format(
+        float_bytes / 2.0 ** 20, qmodel.nbytes / 2.0 ** 20, float_bytes / qmodel.nbytes))
+    for name, predict, num_bytes in [('float', model.predict, float_bytes), ('int8', qmodel.predict, qmodel.nbytes)]:
+        elapsed = float('inf')
+        for _ in range(num_repeats):
+            t0 = time()
+            predict(X)
+            elapsed = min(elapsed, time() - t0)
+        tracemalloc.start()
+        predict(X)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{} predict: {:.2f} ms, peak memory {:.2f} MB, {:.2f} MB with the parameters'.format(
+            name, elapsed * 1e3, peak / 2.0 ** 20, (peak + num_bytes) / 2.0 ** 20))
+
+def build_search_model(config):
+    """
+    Model and Solver options of one configuration of hyperparameter_search.
+    It has to be a module-level function so the search can pickle it.
+    """
+    model = FullyConnectedNet([100, 100, 100], weight_scale=config['weight_scale'],
+                              reg=config['reg'], dtype=np.float32)
+    solver_kwargs = {
+        'update_rule': 'adam',
+        'optim_config': {'learning_rate': config['learning_rate']},
+        'lr_decay': 0.95,
+        'batch_size': 100,
+    }
+    return model, solver_kwargs
+
+def hyperparameter_search(num_train=4000, num_configs=27, max_epochs=9, num_processes=None):
+    """
+    Random search over learning rate, weight scale and regularization, first
+    with successive halving and then exhaustively, training every configuration
+    for max_epochs in the same process pool.
+    """
+    X_train, y_train, X_val, y_val, X_test, y_test = get_CIFAR10_data()
+    data = {
+        'X_train': X_train[:num_train].astype(np.float32),
+        'y_train': y_train[:num_train],
+        'X_val': X_val.astype(np.float32),
+        'y_val': y_val,
+    }
+    np.random.seed(0)
+    configs = [{'learning_rate': 10 ** np.random.uniform(-4.5, -2.5),
+                'weight_scale': 10 ** np.random.uniform(-2.5, -1),
+                'reg': 10 ** np.random.uniform(-4, -1)} for _ in range(num_configs)]
+
+    with HyperparameterSearch(build_search_model, data, num_processes=num_processes) as search:
+        result = search.successive_halving(configs, min_epochs=1, max_epochs=max_epochs, eta=3)
+        print(result.summary())
+
+        t0 = time()
+        exhaustive = search.successive_halving(configs, min_epochs=max_epochs, max_epochs=max_epochs)
+        exhaustive_t = time() - t0
+        print(exhaustive.summary())
+
+    print('successive halving: best val_acc {:.3f} in {:.1f}s'.format(result.best_val_acc, result.elapsed))
+    print('exhaustive sweep: best val_acc {:.3f} in {:.1f}s'.format(exhaustive.best_val_acc, exhaustive_t))
+    print('wall-clock saved: {:.1f}s ({:.1f}x)'.format(exhaustive_t - result.elapsed,
+                                                        exhaustive_t / result.elapsed))
+
 def main():
     # Test for ReLU
     # relu_test()
@@ -600,6 +1124,39 @@ def main():
     # Train a pair of deep networks using these new update rules
     # neural_network_with_rms_and_adam()
 
+    # float32 against float64 training speed, with strict dtype checks
+    # dtype_benchmark()
+
+    # Optimizer step over one flat parameter buffer
+    # flat_params_benchmark()
+
+    # Shuffled, prefetched minibatches
+    # batch_loader_test()
+
+    # Data-parallel training over several processes
+    # data_parallel_test()
+
+    # Accuracy checks in a side process
+    # async_validation_test()
+
+    # Inference-only scoring
+    # predict_benchmark()
+
+    # Activation checkpointing
+    # checkpointing_test()
+
+    # Per-op profile of a training run
+    # profiler_test()
+
+    # Checkpoints and resuming training
+    # solver_checkpoint_test()
+
+    # int8 post-training quantization
+    # quantization_test()
+
+    # Successive halving hyperparameter search
+    # hyperparameter_search()
+
     # Train a good model
     train_best_model()
 
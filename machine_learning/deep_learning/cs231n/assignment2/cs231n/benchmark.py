@@ -0,0 +1,375 @@
+"""
+Benchmark suite for the layer library.
+
+Every group of the suite runs the implementations of one layer pass over a
+grid of shapes and dtypes and reports, for each implementation, the best time
+of a few calls, the peak memory of one call measured with tracemalloc, the
+speedup over the reference implementation (the first of the group, usually
+the naive one) and the largest absolute difference of its outputs from the
+reference outputs. The groups are:
+
+    conv_forward, conv_backward: every registered NCHW backend of
+        conv_backends.py that supports the shape, naive first
+    max_pool_forward, max_pool_backward: naive, strides, reshape and im2col
+    batchnorm_forward, batchnorm_backward: batchnorm_forward /
+        batchnorm_backward, batchnorm_backward_alt and the fused layers
+    spatial_batchnorm_forward, spatial_batchnorm_backward: the original and
+        the fused spatial layers, NCHW
+
+Backward passes are timed on their own, from the cache of one forward pass of
+the same implementation.
+
+Example usage:
+
+    results = run_benchmarks(quick=True)
+    print(format_results(results))
+    save_results(results, 'benchmark_results.json')
+    regressions = compare_to_baseline(results, load_results('benchmark_baseline.json'))
+    print(format_regressions(regressions))
+
+A result and a baseline entry are matched by group, implementation, shape and
+dtype; entries missing on either side are not compared. Timings only compare
+across runs on the same machine under similar load.
+"""
+
+import json
+import os
+import platform
+import tracemalloc
+from collections import OrderedDict
+from time import strftime, time
+
+import numpy as np
+
+from .classifiers.layers import max_pool_forward_naive, max_pool_backward_naive,\
+    batchnorm_forward, batchnorm_backward, batchnorm_backward_alt,\
+    batchnorm_forward_fused, batchnorm_backward_fused,\
+    spatial_batchnorm_forward, spatial_batchnorm_backward,\
+    spatial_batchnorm_forward_fused, spatial_batchnorm_backward_fused
+from .classifiers.fast_layers import max_pool_forward_strides, max_pool_backward_strides,\
+    max_pool_forward_reshape, max_pool_backward_reshape,\
+    max_pool_forward_im2col, max_pool_backward_im2col
+from .classifiers.conv_backends import available_conv_backends, conv_forward_auto, conv_backward_auto
+
+# Batch size of the image-shaped inputs in the quick and in the full grid
+_QUICK_BATCH = 8
+_FULL_BATCH = 50
+
+# Convolutions as (C, H, W, F, HH, WW, stride, pad)
+_CONV_SHAPES = [
+    (3, 32, 32, 32, 7, 7, 1, 3),
+    (16, 16, 16, 32, 3, 3, 1, 1),
+    (32, 16, 16, 64, 4, 4, 2, 1),
+]
+
+# Max pools as (C, H, W, pool_height, pool_width, stride)
+_POOL_SHAPES = [
+    (32, 32, 32, 2, 2, 2),
+    (64, 15, 15, 3, 3, 2),
+    (32, 16, 17, 2, 3, 2),
+]
+
+# Batchnorm inputs as (N, D); the last one only in the full grid
+_BATCHNORM_SHAPES = [(100, 500), (500, 1024), (1000, 4096)]
+
+# Spatial batchnorm inputs as (C, H, W)
+_SPATIAL_BATCHNORM_SHAPES = [(32, 32, 32), (64, 16, 16)]
+
+GROUPS = ('conv_forward', 'conv_backward', 'max_pool_forward', 'max_pool_backward',
+          'batchnorm_forward', 'batchnorm_backward', 'spatial_batchnorm_forward',
+          'spatial_batchnorm_backward')
+
+
+def _conv_cases(direction, batch, dtype):
+    """
+    Yield (shape label, implementations) for the convolution groups, where
+    implementations is a list of (name, setup) and setup() returns the
+    function to benchmark.
+    """
+    for C, H, W, F, HH, WW, stride, pad in _CONV_SHAPES:
+        x = np.random.randn(batch, C, H, W).astype(dtype)
+        w = (np.random.randn(F, C, HH, WW) * 0.1).astype(dtype)
+        b = np.random.randn(F).astype(dtype)
+        conv_param = {'stride': stride, 'pad': pad}
+        names = available_conv_backends(x.shape, w.shape, conv_param)
+        names.sort(key=lambda name: name != 'naive')
+        label = 'x{}x{}x{}x{} w{}x{}x{}x{} s{} p{}'.format(batch, C, H, W, F, C, HH, WW, stride, pad)
+
+        def setup(name, x=x, w=w, b=b, conv_param=conv_param):
+            param = dict(conv_param, backend=name)
+            if direction == 'forward':
+                return lambda: conv_forward_auto(x, w, b, param)[0]
+            out, cache = conv_forward_auto(x, w, b, param)
+            dout = np.random.RandomState(0).randn(*out.shape).astype(dtype)
+            return lambda: conv_backward_auto(dout, cache)
+
+        yield label, [(name, lambda name=name, setup=setup: setup(name)) for name in names]
+
+
+def _pool_cases(direction, batch, dtype):
+    implementations = [
+        ('naive', max_pool_forward_naive, max_pool_backward_naive, None),
+        ('strides', max_pool_forward_strides, max_pool_backward_strides, None),
+        ('reshape', max_pool_forward_reshape, max_pool_backward_reshape,
+         lambda H, W, PH, PW, S: PH == PW == S and H % PH == 0 and W % PW == 0),
+        ('im2col', max_pool_forward_im2col, max_pool_backward_im2col,
+         lambda H, W, PH, PW, S: (H - PH) % S == 0 and (W - PW) % S == 0),
+    ]
+    for C, H, W, PH, PW, S in _POOL_SHAPES:
+        x = np.random.randn(batch, C, H, W).astype(dtype)
+        pool_param = {'pool_height': PH, 'pool_width': PW, 'stride': S}
+        label = 'x{}x{}x{}x{} pool{}x{} s{}'.format(batch, C, H, W, PH, PW, S)
+
+        def setup(forward, backward, x=x, pool_param=pool_param):
+            if direction == 'forward':
+                return lambda: forward(x, pool_param)[0]
+            out, cache = forward(x, pool_param)
+            dout = np.random.RandomState(0).randn(*out.shape).astype(dtype)
+            return lambda: backward(dout, cache)
+
+        yield label, [(name, lambda f=forward, g=backward, setup=setup: setup(f, g))
+                      for name, forward, backward, supports in implementations
+                      if supports is None or supports(H, W, PH, PW, S)]
+
+
+def _batchnorm_cases(direction, shapes, spatial, dtype):
+    if spatial:
+        forward, forward_fused = spatial_batchnorm_forward, spatial_batchnorm_forward_fused
+        backwards = [('spatial_batchnorm_backward', spatial_batchnorm_backward, forward),
+                     ('spatial_batchnorm_backward_fused', spatial_batchnorm_backward_fused, forward_fused)]
+    else:
+        forward, forward_fused = batchnorm_forward, batchnorm_forward_fused
+        backwards = [('batchnorm_backward', batchnorm_backward, forward),
+                     ('batchnorm_backward_alt', batchnorm_backward_alt, forward),
+                     ('batchnorm_backward_fused', batchnorm_backward_fused, forward_fused)]
+    for shape in shapes:
+        x = (5 * np.random.randn(*shape) + 12).astype(dtype)
+        C = shape[1]
+        gamma = np.random.randn(C).astype(dtype)
+        beta = np.random.randn(C).astype(dtype)
+        dout = np.random.randn(*shape).astype(dtype)
+        label = 'x' + 'x'.join(map(str, shape))
+
+        if direction == 'forward':
+            yield label, [(f.__name__, lambda f=f, x=x, gamma=gamma, beta=beta:
+                           lambda: f(x, gamma, beta, {'mode': 'train'})[0])
+                          for f in (forward, forward_fused)]
+        else:
+            def setup(backward, forward, x=x, gamma=gamma, beta=beta, dout=dout):
+                _, cache = forward(x, gamma, beta, {'mode': 'train'})
+                return lambda: backward(dout, cache)
+            yield label, [(name, lambda g=backward, f=f, setup=setup: setup(g, f))
+                          for name, backward, f in backwards]
+
+
+def _cases(group, quick, dtype):
+    batch = _QUICK_BATCH if quick else _FULL_BATCH
+    direction = group.rsplit('_', 1)[1]
+    if group.startswith('conv'):
+        return _conv_cases(direction, batch, dtype)
+    if group.startswith('max_pool'):
+        return _pool_cases(direction, batch, dtype)
+    if group.startswith('spatial'):
+        shapes = [(batch,) + shape for shape in _SPATIAL_BATCHNORM_SHAPES]
+        return _batchnorm_cases(direction, shapes, True, dtype)
+    shapes = _BATCHNORM_SHAPES[:-1] if quick else _BATCHNORM_SHAPES
+    return _batchnorm_cases(direction, shapes, False, dtype)
+
+
+def _best_time(f, num_repeats, max_seconds):
+    """
+    Best time of num_repeats calls after an untimed warm-up call, stopping
+    early once max_seconds have been spent.
+    """
+    t0 = time()
+    f()
+    spent = time() - t0
+    best = float('inf')
+    for _ in range(num_repeats):
+        if best != float('inf') and spent > max_seconds:
+            break
+        t0 = time()
+        f()
+        elapsed = time() - t0
+        spent += elapsed
+        best = min(best, elapsed)
+    return best
+
+
+def _peak_bytes(f):
+    """
+    Peak memory allocated during one call of f, and its result.
+    """
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    result = f()
+    peak = tracemalloc.get_traced_memory()[1] - start
+    if not was_tracing:
+        tracemalloc.stop()
+    return peak, result
+
+
+def _max_error(result, reference):
+    """
+    Largest absolute difference between two outputs, which are arrays or
+    tuples of arrays.
+    """
+    if isinstance(result, tuple):
+        return max(_max_error(a, b) for a, b in zip(result, reference))
+    return float(np.max(np.abs(result.astype(np.float64) - reference.astype(np.float64))))
+
+
+def run_benchmarks(groups=None, dtypes=(np.float32, np.float64), quick=True, num_repeats=5,
+                   max_seconds=2.0, seed=0, verbose=True):
+    """
+    Run the benchmark suite.
+
+    Inputs:
+        - groups: Names of the groups to run, from GROUPS; default all
+        - dtypes: dtypes to run every shape with
+        - quick: Whether to use the quick grid, with a batch size of 8 and
+            without the largest batchnorm shape, instead of the full grid
+        - num_repeats: Number of timed calls per implementation
+        - max_seconds: Stop timing an implementation after this many seconds,
+            which bounds the time spent on the naive layers
+        - seed: Seed of the random inputs
+        - verbose: Whether to print every result as it is measured
+
+    Returns:
+        - results: List of one dictionary per implementation, shape and dtype
+            with keys 'group', 'implementation', 'shape', 'dtype', 'time'
+            (seconds), 'peak_bytes', 'speedup' (reference time / time) and
+            'max_error' (largest absolute difference from the reference)
+    """
+    if groups is None:
+        groups = GROUPS
+    unknown = set(groups) - set(GROUPS)
+    if unknown:
+        raise ValueError('Unknown benchmark groups {}'.format(', '.join(sorted(unknown))))
+    np.random.seed(seed)
+
+    results = []
+    for group in groups:
+        for dtype in dtypes:
+            dtype = np.dtype(dtype)
+            for label, implementations in _cases(group, quick, dtype):
+                reference_time, reference_out = None, None
+                for name, setup in implementations:
+                    f = setup()
+                    elapsed = _best_time(f, num_repeats, max_seconds)
+                    peak, out = _peak_bytes(f)
+                    if reference_time is None:
+                        reference_time, reference_out = elapsed, out
+                    result = OrderedDict([
+                        ('group', group), ('implementation', name), ('shape', label),
+                        ('dtype', dtype.name), ('time', elapsed), ('peak_bytes', peak),
+                        ('speedup', reference_time / elapsed), ('max_error', _max_error(out, reference_out)),
+                    ])
+                    results.append(result)
+                    if verbose:
+                        print(_format_result(result))
+    return results
+
+
+def _format_result(result):
+    return '{:<26} {:<34} {:<32} {:<8} {:>10.3f} {:>10.2f} {:>9.1f}x {:>10.1e}'.format(
+        result['group'], result['implementation'], result['shape'], result['dtype'],
+        result['time'] * 1e3, result['peak_bytes'] / 2.0 ** 20, result['speedup'], result['max_error'])
+
+
+def format_results(results):
+    """
+    Table of results, as a string.
+    """
+    lines = ['{:<26} {:<34} {:<32} {:<8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'group', 'implementation', 'shape', 'dtype', 'time ms', 'peak MB', 'speedup', 'max error')]
+    lines.extend(_format_result(result) for result in results)
+    return '\n'.join(lines)
+
+
+def save_results(results, path):
+    """
+    Write results as JSON, along with the numpy version and the machine they
+    were measured on.
+    """
+    data = {
+        'date': strftime('%Y-%m-%d %H:%M:%S'),
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1)
+
+
+def load_results(path):
+    """
+    Results saved with save_results.
+    """
+    with open(path, 'r') as f:
+        return json.load(f)['results']
+
+
+def _key(result):
+    return (result['group'], result['implementation'], result['shape'], result['dtype'])
+
+
+def compare_to_baseline(results, baseline, time_tolerance=0.5, memory_tolerance=0.1,
+                        min_time=1e-3):
+    """
+    Find the results that are slower or use more memory than their baseline.
+
+    Inputs:
+        - results: Results of run_benchmarks
+        - baseline: Earlier results, e.g. from load_results
+        - time_tolerance: Relative slowdown allowed before a time counts as a
+            regression. Best-of-few timings of millisecond calls still vary by
+            a few tens of percent between runs, hence the default of 50%.
+        - memory_tolerance: Relative growth of the peak memory allowed
+        - min_time: Baseline times below this many seconds are too noisy to
+            compare and are skipped
+
+    Returns:
+        - regressions: List of dictionaries with the keys of the result plus
+            'metric' ('time' or 'peak_bytes'), 'baseline', 'current' and 'ratio'
+            (current / baseline), worst first
+    """
+    baseline = {_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline.get(_key(result))
+        if old is None:
+            continue
+        checks = [('peak_bytes', memory_tolerance)]
+        if old['time'] >= min_time:
+            checks.append(('time', time_tolerance))
+        for metric, tolerance in checks:
+            if old[metric] > 0 and result[metric] > old[metric] * (1 + tolerance):
+                regression = OrderedDict((k, result[k]) for k in ('group', 'implementation', 'shape', 'dtype'))
+                regression.update(metric=metric, baseline=old[metric], current=result[metric],
+                                  ratio=result[metric] / old[metric])
+                regressions.append(regression)
+    regressions.sort(key=lambda regression: regression['ratio'], reverse=True)
+    return regressions
+
+
+def format_regressions(regressions):
+    """
+    Report of regressions from compare_to_baseline, as a string.
+    """
+    if not regressions:
+        return 'No regressions against the baseline'
+    lines = ['{} regressions against the baseline:'.format(len(regressions))]
+    for r in regressions:
+        if r['metric'] == 'time':
+            values = '{:.3f} ms -> {:.3f} ms'.format(r['baseline'] * 1e3, r['current'] * 1e3)
+        else:
+            values = '{:.2f} MB -> {:.2f} MB'.format(r['baseline'] / 2.0 ** 20, r['current'] / 2.0 ** 20)
+        lines.append('  {} {} {} {}: {} {} ({:.2f}x)'.format(
+            r['group'], r['implementation'], r['shape'], r['dtype'], r['metric'], values, r['ratio']))
+    return '\n'.join(lines)
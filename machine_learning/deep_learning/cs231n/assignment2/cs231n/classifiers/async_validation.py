@@ -0,0 +1,235 @@
+"""
+Validation in a side process while training goes on.
+
+An AsyncValidator owns a few parameter snapshot buffers in shared memory and a
+worker process with its own copy of the model. submit copies the current
+parameters into a free buffer, a plain memcpy with no allocation, and returns
+right away; the worker computes the train and validation accuracy of that
+snapshot while the training loop carries on. Finished results come back
+through results.
+
+The buffers are reused rather than copied again: the caller keeps the buffer
+of the best snapshot so far as the best parameters and releases the others.
+With the default three buffers, one holds the best parameters and two can be
+in flight, so validation that takes longer than an epoch only blocks the
+training loop when both are still busy.
+
+The running averages in model.bn_params, which test-time batch normalization
+uses, are not parameters; they are pickled along with every submit.
+"""
+
+import multiprocessing
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+
+from .data_parallel import _shared_array
+
+def _accuracy(model, X, y, num_samples=None, batch_size=100):
+    """
+    Same as Solver.check_accuracy, for the worker's model.
+    """
+    N = X.shape[0]
+    if num_samples is not None and N > num_samples:
+        mask = np.random.choice(N, num_samples)
+        N = num_samples
+        X = X[mask]
+        y = y[mask]
+
+    if hasattr(model, 'predict'):
+        return np.mean(model.predict(X, batch_size=batch_size) == y)
+
+    y_pred = []
+    for start in range(0, N, batch_size):
+        scores = model.loss(X[start:start + batch_size])
+        y_pred.append(np.argmax(scores, axis=1))
+    return np.mean(np.hstack(y_pred) == y)
+
+
+def _worker(model, data, spec, layout, num_train_samples, conn):
+    """
+    Main loop of the worker process. Every message is a tuple
+    (slot, epoch, bn_params) asking for the accuracies of the snapshot in
+    buffer slot; None ends the loop.
+    """
+    X_train, y_train, X_val, y_val = data
+    shm, snapshots = _shared_array(*spec)
+    params = [OrderedDict((name, snapshot[s].reshape(shape)) for name, s, shape in layout)
+              for snapshot in snapshots]
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        slot, epoch, bn_params = message
+        try:
+            model.params = params[slot]
+            if bn_params is not None:
+                model.bn_params = bn_params
+            train_acc = _accuracy(model, X_train, y_train, num_samples=num_train_samples)
+            val_acc = _accuracy(model, X_val, y_val)
+            conn.send((slot, epoch, train_acc, val_acc, None))
+        except Exception:
+            conn.send((slot, epoch, None, None, traceback.format_exc()))
+
+    model.params = params = snapshots = None
+    shm.close()
+
+
+class AsyncValidator:
+    """
+    Side process computing train and validation accuracies of parameter
+    snapshots.
+
+    Example usage, with flat = FlatParams(model.params) and
+    model.params = flat.params:
+
+        validator = AsyncValidator(model, flat, X_train, y_train, X_val, y_val)
+        best = 0
+        for epoch in range(num_epochs):
+            ... train one epoch ...
+            for slot, epoch, train_acc, val_acc in validator.results(block=validator.num_free == 0):
+                if val_acc > best:
+                    best = val_acc
+                    validator.keep(slot)
+                else:
+                    validator.release(slot)
+            validator.submit(epoch)
+        ... the same loop over validator.results(wait_all=True) ...
+        best_params = validator.copy_kept()
+        validator.close()
+    """
+    def __init__(self, model, flat, X_train, y_train, X_val, y_val, num_buffers=3,
+                 num_train_samples=1000):
+        """
+        Start the worker.
+
+        Inputs:
+            - model: Model to validate, whose params are flat.params
+            - flat: FlatParams of the model
+            - X_train, y_train: Training data; the train accuracy is measured on
+                num_train_samples samples of it
+            - X_val, y_val: Validation data
+            - num_buffers: Number of snapshot buffers, at least 2
+            - num_train_samples: Number of training samples to measure on
+        """
+        if num_buffers < 2:
+            raise ValueError('num_buffers must be at least 2, got {}'.format(num_buffers))
+        if model.params is not flat.params:
+            raise ValueError('model.params must be the params of flat')
+        self.model = model
+        self.flat = flat
+        self.num_buffers = num_buffers
+        self._free = list(range(num_buffers))
+        self._kept = None
+        self._pending = 0
+        self._closed = False
+
+        spec = ((num_buffers,) + flat.data.shape, flat.data.dtype)
+        self._shm, self._snapshots = _shared_array(*spec)
+        self._layout = [(name, s, flat.params[name].shape) for name, s in flat.slices.items()]
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_worker, name='AsyncValidator',
+            args=(model, (X_train, y_train, X_val, y_val), spec + (self._shm.name,),
+                  self._layout, num_train_samples, child_conn))
+        self._process.daemon = True
+        self._process.start()
+        child_conn.close()
+
+    @property
+    def num_free(self):
+        """
+        Number of buffers submit can use without waiting.
+        """
+        return len(self._free)
+
+    def submit(self, epoch):
+        """
+        Snapshot the current parameters and start validating them. Needs a
+        free buffer.
+        """
+        if self._closed:
+            raise ValueError('submit() on a closed AsyncValidator')
+        if not self._free:
+            raise ValueError('No free snapshot buffer; collect results first')
+        slot = self._free.pop()
+        np.copyto(self._snapshots[slot], self.flat.data)
+        self._conn.send((slot, epoch, getattr(self.model, 'bn_params', None)))
+        self._pending += 1
+
+    def results(self, block=False, wait_all=False):
+        """
+        Collect finished validations, oldest first.
+
+        Inputs:
+            - block: Wait for at least one result if any is pending
+            - wait_all: Wait for every pending result
+
+        Returns:
+            - results: List of tuples (slot, epoch, train_acc, val_acc). Every
+                slot must be passed to keep or release.
+        """
+        results = []
+        while self._pending > 0 and (wait_all or (block and not results) or self._conn.poll()):
+            slot, epoch, train_acc, val_acc, error = self._conn.recv()
+            self._pending -= 1
+            if error is not None:
+                self._free.append(slot)
+                raise RuntimeError('Validation of epoch {} failed:\n{}'.format(epoch, error))
+            results.append((slot, epoch, train_acc, val_acc))
+        return results
+
+    def keep(self, slot):
+        """
+        Keep the snapshot in slot as the best parameters, releasing the one
+        kept before.
+        """
+        if self._kept is not None:
+            self._free.append(self._kept)
+        self._kept = slot
+
+    def release(self, slot):
+        """
+        Make the buffer of a snapshot that is not needed available again.
+        """
+        self._free.append(slot)
+
+    def kept_params(self):
+        """
+        The kept snapshot as a dictionary of views into its buffer, or None if
+        nothing was kept. The views are only valid until the next keep.
+        """
+        if self._kept is None:
+            return None
+        data = self._snapshots[self._kept]
+        return OrderedDict((name, data[s].reshape(shape)) for name, s, shape in self._layout)
+
+    def copy_kept(self):
+        """
+        Independent copy of the kept snapshot as a dictionary of arrays, or
+        None if nothing was kept.
+        """
+        if self._kept is None:
+            return None
+        data = self._snapshots[self._kept].copy()
+        return OrderedDict((name, data[s].reshape(shape)) for name, s, shape in self._layout)
+
+    def close(self):
+        """
+        Stop the worker and free the shared memory. Pending results are lost.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._conn.send(None)
+        except OSError:
+            # The worker is already gone
+            pass
+        self._conn.close()
+        self._process.join()
+        self._snapshots = None
+        self._shm.close()
+        self._shm.unlink()
@@ -0,0 +1,118 @@
+"""
+Data augmentation over whole minibatches.
+
+A BatchAugmenter is the transform stage of a BatchLoader (see batch_loader.py,
+or the augment option of Solver): it rewrites a freshly gathered minibatch in
+place with random horizontal flips, padded random crops and brightness /
+contrast jitter. Every operation works on the whole batch at once through
+broadcasting and strided views, and the padded work buffer is allocated once,
+so nothing is allocated per sample. When the loader prefetches, augmentation
+runs on its background thread together with the gather.
+"""
+
+import numpy as np
+
+class BatchAugmenter:
+    """
+    Random flips, padded crops and brightness / contrast jitter for image
+    minibatches of shape (N, C, H, W), or (N, H, W, C) with layout='NHWC'.
+
+    Each image is
+        1. flipped left-right with probability 1/2 if flip is True,
+        2. zero-padded by pad pixels on every side and cropped back to H x W at
+           a uniformly random offset, i.e. shifted by up to pad pixels,
+        3. contrast scaled around its own mean by a factor drawn uniformly from
+           [1 - contrast, 1 + contrast],
+        4. shifted by a brightness offset drawn uniformly from
+           [-brightness, brightness], in the units of the data.
+    """
+    def __init__(self, flip=True, pad=4, brightness=0.0, contrast=0.0, layout='NCHW'):
+        """
+        Inputs:
+            - flip: Whether to flip images left-right at random
+            - pad: Maximum shift of the random crops, in pixels; 0 disables cropping
+            - brightness: Maximum brightness offset; 0 disables it
+            - contrast: Maximum relative contrast change; 0 disables it
+            - layout: 'NCHW' or 'NHWC'
+        """
+        if layout not in ('NCHW', 'NHWC'):
+            raise ValueError('Invalid layout "%s"' % layout)
+        if pad < 0 or brightness < 0 or not 0 <= contrast < 1:
+            raise ValueError('Invalid augmentation strengths pad={}, brightness={}, contrast={}'.format(
+                pad, brightness, contrast))
+        self.flip = flip
+        self.pad = pad
+        self.brightness = brightness
+        self.contrast = contrast
+        self.layout = layout
+        self._padded = None
+
+    def _padded_buffer(self, X):
+        """
+        Zero-bordered work buffer for X, reused between calls. Only its interior
+        is ever written, so the border stays zero.
+        """
+        p = self.pad
+        if self.layout == 'NCHW':
+            N, C, H, W = X.shape
+            shape = (N, C, H + 2 * p, W + 2 * p)
+        else:
+            N, H, W, C = X.shape
+            shape = (N, H + 2 * p, W + 2 * p, C)
+        if (self._padded is None or self._padded.dtype != X.dtype
+                or self._padded.shape[0] < N or self._padded.shape[1:] != shape[1:]):
+            self._padded = np.zeros(shape, dtype=X.dtype)
+        return self._padded[:N]
+
+    def __call__(self, X, rng):
+        """
+        Augment the minibatch X in place.
+
+        Inputs:
+            - X: Writable array of images, of shape (N, C, H, W) or (N, H, W, C)
+            - rng: np.random.RandomState to draw the random parameters from
+        """
+        N = X.shape[0]
+        p = self.pad
+        padded = self._padded_buffer(X)
+        if self.layout == 'NCHW':
+            _, _, H, W = X.shape
+            interior = padded[:, :, p:p + H, p:p + W]
+            mirrored = X[:, :, :, ::-1]
+        else:
+            _, H, W, _ = X.shape
+            interior = padded[:, p:p + H, p:p + W, :]
+            mirrored = X[:, :, ::-1, :]
+
+        # Flip while copying into the padded buffer: mirrored is a view, and
+        # copyto only overwrites the images selected by the mask
+        np.copyto(interior, X)
+        if self.flip:
+            flipped = rng.rand(N) < 0.5
+            np.copyto(interior, mirrored, where=flipped.reshape(-1, 1, 1, 1))
+
+        if p > 0:
+            # windows[n, i, j] is the H x W crop of image n at offset (i, j)
+            S = 2 * p + 1
+            sN, s1, s2, s3 = padded.strides
+            shape = (N, S, S) + X.shape[1:]
+            if self.layout == 'NCHW':
+                strides = (sN, s2, s3, s1, s2, s3)
+            else:
+                strides = (sN, s1, s2, s1, s2, s3)
+            windows = np.lib.stride_tricks.as_strided(padded, shape=shape, strides=strides,
+                                                      writeable=False)
+            X[...] = windows[np.arange(N), rng.randint(S, size=N), rng.randint(S, size=N)]
+        else:
+            X[...] = interior
+
+        if self.contrast > 0:
+            factor = rng.uniform(1 - self.contrast, 1 + self.contrast, size=N).astype(X.dtype)
+            mean = X.mean(axis=(1, 2, 3), keepdims=True)
+            X -= mean
+            X *= factor.reshape(-1, 1, 1, 1)
+            X += mean
+        if self.brightness > 0:
+            offset = rng.uniform(-self.brightness, self.brightness, size=N).astype(X.dtype)
+            X += offset.reshape(-1, 1, 1, 1)
+        return X
@@ -0,0 +1,153 @@
+"""
+Minibatch pipeline for the Solver.
+
+A BatchLoader walks over the training set in a fresh random permutation every
+epoch, so each sample is visited exactly once per epoch, and gathers every
+minibatch into one of a few preallocated buffers. With num_prefetch > 0 the
+gathering runs on a background thread that keeps up to num_prefetch batches
+ready; np.take releases the GIL while it copies, so the gather of the next
+batches overlaps with the forward / backward pass of the current one and the
+training thread only pops finished batches.
+
+There is no device memory here, so "pinned" simply means the buffers are
+allocated once and reused for the whole run instead of a new array per step.
+
+An optional transform, such as a BatchAugmenter from augmentation.py, is
+applied to every gathered batch in its buffer, on the same thread as the
+gather.
+"""
+
+import queue
+import threading
+
+import numpy as np
+
+class BatchLoader:
+    """
+    Shuffled, optionally prefetched minibatches of (X, y).
+
+    Example usage:
+
+        loader = BatchLoader(X_train, y_train, batch_size=100, num_prefetch=2)
+        for t in range(num_epochs * loader.batches_per_epoch):
+            X_batch, y_batch = loader.next_batch()
+            ...
+        loader.close()
+
+    The arrays returned by next_batch are views into the loader's buffers and
+    stay valid until the following call to next_batch; copy them to keep them
+    longer.
+    """
+    def __init__(self, X, y, batch_size, num_prefetch=2, seed=None, transform=None):
+        """
+        Inputs:
+            - X: Array of data, of shape (N, d_1, ..., d_k)
+            - y: Array of labels, of shape (N,)
+            - batch_size: Number of samples per batch. The last batch of an epoch
+                holds the remaining N % batch_size samples if that is not zero.
+            - num_prefetch: Number of batches gathered ahead of time on a
+                background thread; 0 gathers each batch when it is requested.
+            - seed: Seed of the permutations. Defaults to a seed drawn from
+                np.random, so np.random.seed makes the order reproducible.
+            - transform: Optional function transform(X_batch, rng) that modifies
+                each gathered X_batch in place, drawing its randomness from the
+                loader's np.random.RandomState rng.
+        """
+        if num_prefetch < 0:
+            raise ValueError('num_prefetch must be non-negative, got {}'.format(num_prefetch))
+        self.X = X
+        self.y = y
+        self.num_train = X.shape[0]
+        self.batch_size = min(batch_size, self.num_train)
+        self.num_prefetch = num_prefetch
+        self.transform = transform
+        self.batches_per_epoch = -(-self.num_train // self.batch_size)
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+        self._rng = np.random.RandomState(seed)
+
+        # One buffer per queued batch, plus the one the caller is using
+        num_buffers = num_prefetch + 1
+        self._X_buffers = np.empty((num_buffers, self.batch_size) + X.shape[1:], dtype=X.dtype)
+        self._y_buffers = np.empty((num_buffers, self.batch_size) + y.shape[1:], dtype=y.dtype)
+        self._batches = self._batch_indices()
+        self._current = None
+        self._closed = False
+
+        if num_prefetch > 0:
+            self._free = queue.Queue()
+            for slot in range(num_buffers):
+                self._free.put(slot)
+            self._ready = queue.Queue()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._worker, name='BatchLoader')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _batch_indices(self):
+        """
+        Endless generator of index arrays, one permutation per epoch.
+        """
+        while True:
+            order = self._rng.permutation(self.num_train)
+            for start in range(0, self.num_train, self.batch_size):
+                yield order[start:start + self.batch_size]
+
+    def _gather(self, slot, idx):
+        n = idx.shape[0]
+        np.take(self.X, idx, axis=0, out=self._X_buffers[slot, :n])
+        np.take(self.y, idx, axis=0, out=self._y_buffers[slot, :n])
+        if self.transform is not None:
+            self.transform(self._X_buffers[slot, :n], self._rng)
+        return n
+
+    def _worker(self):
+        try:
+            while True:
+                slot = self._free.get()
+                if self._stop.is_set():
+                    return
+                n = self._gather(slot, next(self._batches))
+                self._ready.put((slot, n, None))
+        except Exception as e:
+            # Hand the error to the training thread instead of dying silently
+            self._ready.put((None, 0, e))
+
+    def next_batch(self):
+        """
+        Return the next minibatch as a tuple (X_batch, y_batch).
+        """
+        if self._closed:
+            raise ValueError('next_batch() on a closed BatchLoader')
+        if self.num_prefetch == 0:
+            n = self._gather(0, next(self._batches))
+            return self._X_buffers[0, :n], self._y_buffers[0, :n]
+
+        # The buffer handed out last time can be refilled now
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+        slot, n, error = self._ready.get()
+        if error is not None:
+            raise error
+        self._current = slot
+        return self._X_buffers[slot, :n], self._y_buffers[slot, :n]
+
+    def close(self):
+        """
+        Stop the background thread. The loader cannot be used afterwards.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self.num_prefetch > 0:
+            self._stop.set()
+            # Wake the worker up if it is waiting for a free buffer
+            self._free.put(None)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,193 @@
+"""
+Checkpoint files: a set of named arrays plus JSON metadata in one flat binary
+file that loads as memory-mapped views, without reading or copying the data.
+
+The layout is
+
+    8 bytes    magic b'CS231NCK'
+    8 bytes    length L of the index, little-endian unsigned
+    L bytes    JSON index: {'arrays': [{'name', 'dtype', 'shape', 'offset'}, ...],
+                            'meta': ...}
+    padding    up to a multiple of 64 bytes
+    data       every array in C order at its offset from the start of the
+               data, each offset a multiple of 64
+
+save_checkpoint writes to a temporary file next to the target, syncs it and
+renames it over the target, so a crash leaves either the old or the new
+checkpoint, never a partial one. load_checkpoint reads the index and maps the
+rest of the file; opening a checkpoint costs the same for any model size, and
+pages are read from disk only when an array is touched.
+
+Example usage, a model snapshot for inference:
+
+    save_checkpoint('model.ckpt', model.params)
+    model.params, _ = load_checkpoint('model.ckpt')
+
+A CheckpointWriter writes checkpoints on a background thread: submit copies
+the arrays into staging buffers it reuses between checkpoints and returns
+while the file is written. Solver uses one for its periodic checkpoints.
+"""
+
+import json
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+_MAGIC = b'CS231NCK'
+_ALIGN = 64
+
+
+def _aligned(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def _to_json(value):
+    """
+    value with numpy scalars converted to Python numbers, recursively through
+    dictionaries, lists and tuples.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {k: _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    return value
+
+
+def save_checkpoint(path, arrays, meta=None):
+    """
+    Atomically write arrays and meta into the checkpoint file path.
+
+    Inputs:
+        - path: File to write
+        - arrays: Dictionary mapping names to arrays
+        - meta: Optional JSON-serializable metadata; numpy scalars in it are
+            converted to Python numbers
+    """
+    entries, offset = [], 0
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        entries.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape),
+                        'offset': offset})
+        offset = _aligned(offset + array.nbytes)
+    index = json.dumps({'arrays': entries, 'meta': _to_json(meta)}).encode('utf-8')
+    header = _MAGIC + struct.pack('<Q', len(index)) + index
+    header += b'\0' * (_aligned(len(header)) - len(header))
+
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(header)
+            for entry, array in zip(entries, arrays.values()):
+                array = np.ascontiguousarray(array)
+                f.seek(len(header) + entry['offset'])
+                f.write(array.reshape(-1).view(np.uint8).data)
+            f.truncate(len(header) + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def load_checkpoint(path, mode='r'):
+    """
+    Open a checkpoint written by save_checkpoint without reading its arrays.
+
+    Inputs:
+        - path: Checkpoint file
+        - mode: Memory-map mode, 'r' for read-only arrays or 'c' for writable
+            copy-on-write arrays whose changes never reach the file
+
+    Returns a tuple of:
+        - arrays: OrderedDict mapping names to arrays backed by the file
+        - meta: The metadata saved with them
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(_MAGIC))
+        if magic != _MAGIC:
+            raise ValueError('{} is not a checkpoint file'.format(path))
+        index_length, = struct.unpack('<Q', f.read(8))
+        index = json.loads(f.read(index_length).decode('utf-8'))
+    data_start = _aligned(len(_MAGIC) + 8 + index_length)
+
+    data = np.memmap(path, dtype=np.uint8, mode=mode)
+    arrays = OrderedDict()
+    for entry in index['arrays']:
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        start = data_start + entry['offset']
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        arrays[entry['name']] = data[start:start + nbytes].view(dtype).reshape(shape)
+    return arrays, index['meta']
+
+
+class CheckpointWriter:
+    """
+    Background writer of checkpoint files.
+
+    Example usage:
+
+        writer = CheckpointWriter()
+        for epoch in range(num_epochs):
+            ... train one epoch ...
+            writer.submit('run.ckpt', arrays, meta)
+        writer.close()
+
+    At most one checkpoint is written at a time; submit waits for the previous
+    one to finish. An error in the background write is raised by the next
+    submit, wait or close.
+    """
+    def __init__(self):
+        self._staging = OrderedDict()
+        self._thread = None
+        self._error = None
+
+    def _write(self, path, meta):
+        try:
+            save_checkpoint(path, self._staging, meta)
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        """
+        Wait until the checkpoint being written, if any, is on disk.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, path, arrays, meta=None):
+        """
+        Copy arrays into the staging buffers and meta into new containers, and
+        start writing them to path. Both can be modified as soon as this
+        returns, e.g. a loss history that training keeps appending to.
+        """
+        self.wait()
+        meta = _to_json(meta)
+        arrays = OrderedDict((name, np.asarray(array)) for name, array in arrays.items())
+        if [(name, a.shape, a.dtype) for name, a in arrays.items()] != \
+                [(name, a.shape, a.dtype) for name, a in self._staging.items()]:
+            self._staging = OrderedDict((name, np.empty_like(a)) for name, a in arrays.items())
+        for name, array in arrays.items():
+            np.copyto(self._staging[name], array)
+        self._thread = threading.Thread(target=self._write, args=(path, meta),
+                                        name='CheckpointWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """
+        Wait for the last checkpoint and free the staging buffers.
+        """
+        self.wait()
+        self._staging = OrderedDict()
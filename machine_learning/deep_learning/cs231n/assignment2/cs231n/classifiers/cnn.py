@@ -1,8 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
-from .layer_utils import conv_relu_pool_forward, conv_relu_pool_backward
+from .conv_backends import conv_forward_auto, get_conv_backend
+from .fast_layers import max_pool_forward_inference
+from .layer_utils import conv_relu_pool_forward, conv_relu_pool_backward,\
+    conv_relu_pool_forward_fused, conv_relu_pool_backward_fused, cache_nbytes
 from .layers import affine_forward, relu_forward, softmax_loss, affine_backward, relu_backward
 
+# Column buffer size of the tiled convolution of a checkpointed
+# ThreeLayerConvNet when no tile_bytes is given
+CHECKPOINT_TILE_BYTES = 8 * 1024 * 1024
+
 class ThreeLayerConvNet():
     """
     A three-layer convolutional network with the following architecture:
@@ -12,10 +21,17 @@ class ThreeLayerConvNet():
     The network operates on minibatches of data that have shape (N, C, H, W)
     consisting of N images, each with height H and width W and with C input
     channels.
+
+    After every training call of loss, peak_cache_bytes holds the largest
+    number of bytes that the layer caches, and the input kept for
+    checkpointing, held at once during it (see layer_utils.cache_nbytes). The
+    parameters are not counted; the buffers of a ConvPlan are, since the
+    planned convolution keeps them alive between calls.
     """
     def __init__(self, input_dim=(3, 32, 32),num_filters=32,
                  filter_size=7, hidden_dim=100, num_classes=10,
-                 weight_scale=1e-3, reg=0.0, dtype=np.float32):
+                 weight_scale=1e-3, reg=0.0, dtype=np.float32,
+                 tile_bytes=None, fused=False, layout='NCHW', checkpoint=False):
 
         """
         Initialize a new network.
@@ -30,10 +46,47 @@ class ThreeLayerConvNet():
                 of weights.
             - reg: Scalar giving L2 regularization strength
             - dtype: numpy datatype to use for computation
+            - tile_bytes: If not None, run the convolution with the tiled backend
+                and cap its im2col buffers at this many bytes, so that memory
+                stays flat in the batch size.
+            - fused: If True, run the first layer with conv_relu_pool_forward_fused,
+                which only caches the pooled output and a uint8 argmax index.
+                Its convolution is always the tiled im2col one, so this bypasses
+                the backend registry and its auto-tuner. By default the separate
+                conv, relu and pool layers are chained, with the convolution
+                picked by conv_forward_auto. The fused layer is NCHW only and is
+                skipped for NHWC.
+            - layout: 'NCHW' or 'NHWC', the memory layout used inside the
+                convolutional layer. Inputs are always (N, C, H, W) and are
+                transposed once on the way in; the pooled activations are put
+                back in NCHW order before the affine layer, so the parameters
+                are the same for both layouts.
+            - checkpoint: If True, the training forward pass runs the
+                convolutional layer like predict does, keeping nothing but its
+                input and pooled output, and the backward pass runs its forward
+                pass again to rebuild the cache just before going back through
+                it. The convolution then uses the tiled backend, with tile_bytes
+                or else CHECKPOINT_TILE_BYTES, rather than the auto-tuned one,
+                because a ConvPlan would keep its full-batch column buffers
+                alive across steps. This costs one more conv forward per step;
+                in exchange the pre-pool activations and pooling indices are not
+                held while the affine layers run and no full-batch column
+                matrix is ever allocated. peak_cache_bytes shows the difference. The fused
+                layer already caches little, so with fused=True checkpointing
+                saves next to nothing.
         """
+        if layout not in ('NCHW', 'NHWC'):
+            raise ValueError('Invalid layout "%s"' % layout)
+        if layout == 'NHWC' and tile_bytes is not None:
+            raise ValueError('tile_bytes is only supported with the NCHW layout')
         self.params = {}
         self.reg = reg
         self.dtype = dtype
+        self.tile_bytes = tile_bytes
+        self.fused = fused
+        self.layout = layout
+        self.checkpoint = checkpoint
+        self.peak_cache_bytes = None
 
         C, H, W = input_dim
         self.params['W1'] = weight_scale * np.random.randn(num_filters, C, filter_size, filter_size)
@@ -46,21 +99,52 @@ class ThreeLayerConvNet():
         for k, v in self.params.items():
             self.params[k] = v.astype(dtype)
 
+    def _layer_params(self):
+        """
+        conv_param and pool_param of the convolutional layer.
+        """
+        filter_size = self.params['W1'].shape[2]
+        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+        if self.tile_bytes is not None:
+            conv_param['backend'] = 'tiled'
+            conv_param['tile_bytes'] = self.tile_bytes
+        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+        if self.layout == 'NHWC':
+            conv_param['layout'] = pool_param['layout'] = 'NHWC'
+        return conv_param, pool_param
+
     def loss(self, X, y=None):
         """
         Evaluate loss and gradient for the three-layer convolutional network
 
         Input / output: Same API as TwoLayerNet in fc_net.py
         """
+        X = X.astype(self.dtype, copy=False)
         W1, b1 = self.params['W1'], self.params['b1']
         W2, b2 = self.params['W2'], self.params['b2']
         W3, b3 = self.params['W3'], self.params['b3']
 
         # pass conv_param to the forward pass for the convolutional layer
-        filter_size = W1.shape[2]
-        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
-        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
-        conv_forward_out_1, cache_forward_1 = conv_relu_pool_forward(X, W1, b1, conv_param, pool_param)
+        conv_param, pool_param = self._layer_params()
+        fused = self.fused and self.layout == 'NCHW'
+        checkpoint = self.checkpoint and y is not None
+        if checkpoint and self.layout == 'NCHW':
+            conv_param['backend'] = 'tiled'
+            conv_param.setdefault('tile_bytes', CHECKPOINT_TILE_BYTES)
+        if self.layout == 'NHWC':
+            X = X.transpose(0, 2, 3, 1)
+        if fused:
+            first_forward, first_backward = conv_relu_pool_forward_fused, conv_relu_pool_backward_fused
+        else:
+            first_forward, first_backward = conv_relu_pool_forward, conv_relu_pool_backward
+        if checkpoint and not fused:
+            conv_forward_out_1, cache_forward_1 = self._conv_relu_pool(X, conv_param, pool_param), None
+        else:
+            conv_forward_out_1, cache_forward_1 = first_forward(X, W1, b1, conv_param, pool_param)
+            if checkpoint:
+                cache_forward_1 = None
+        if self.layout == 'NHWC':
+            conv_forward_out_1 = conv_forward_out_1.transpose(0, 3, 1, 2)
         affine_forward_out_2, cache_forward_2 = affine_forward(conv_forward_out_1, W2, b2)
         affine_relu_2, cache_relu_2 = relu_forward(affine_forward_out_2)
         scores, cache_forward_3 = affine_forward(affine_relu_2, W3, b3)
@@ -68,6 +152,10 @@ class ThreeLayerConvNet():
         if y is None:
             return scores
 
+        params = self.params.values()
+        peak_cache_bytes = cache_nbytes(X if checkpoint else None, cache_forward_1, cache_forward_2,
+                                        cache_relu_2, cache_forward_3, exclude=params)
+
         loss, grads = 0, {}
 
         loss, dout = softmax_loss(scores, y)
@@ -76,10 +164,89 @@ class ThreeLayerConvNet():
         dx3, grads['W3'], grads['b3'] = affine_backward(dout, cache_forward_3)
         dx2 = relu_backward(dx3, cache_relu_2)
         dx2, grads['W2'], grads['b2'] = affine_backward(dx2, cache_forward_2)
-        dx1, grads['W1'], grads['b1'] = conv_relu_pool_backward(dx2, cache_forward_1)
+        cache_forward_2 = cache_relu_2 = cache_forward_3 = None
+        if self.layout == 'NHWC':
+            dx2 = dx2.transpose(0, 2, 3, 1)
+        if checkpoint:
+            _, cache_forward_1 = first_forward(X, W1, b1, conv_param, pool_param)
+            peak_cache_bytes = max(peak_cache_bytes, cache_nbytes(cache_forward_1, exclude=params))
+        self.peak_cache_bytes = peak_cache_bytes
+        dx1, grads['W1'], grads['b1'] = first_backward(dx2, cache_forward_1)
 
         grads['W3'] = grads['W3'] + self.reg * self.params['W3']
         grads['W2'] = grads['W2'] + self.reg * self.params['W2']
         grads['W1'] = grads['W1'] + self.reg * self.params['W1']
 
-        return loss, grads  
\ No newline at end of file
+        return loss, grads  
+
+    def _conv_relu_pool(self, x, conv_param, pool_param):
+        """
+        Output of the convolutional layer on x, keeping no cache.
+        """
+        a, _ = conv_forward_auto(x, self.params['W1'], self.params['b1'], conv_param)
+        np.maximum(a, 0, out=a)
+        return max_pool_forward_inference(a, pool_param)
+
+    def predict(self, X, batch_size=100, num_threads=1, return_scores=False):
+        """
+        Inference-only forward pass.
+
+        Unlike loss(X), this keeps no caches: the convolution's cache is dropped
+        as soon as it returns and the pooling computes no argmax. Only one chunk
+        of X at a time is cast to the model dtype. The chunks of batch_size
+        samples are dealt out to num_threads threads, which reuse their buffers
+        for the affine layers across chunks and run in parallel wherever NumPy
+        releases the GIL.
+
+        Inputs / Returns: Same as FullyConnectedNet.predict in fc_net.py
+        """
+        N = X.shape[0]
+        W1, b1 = self.params['W1'], self.params['b1']
+        W2, b2 = self.params['W2'], self.params['b2']
+        W3, b3 = self.params['W3'], self.params['b3']
+        conv_param, pool_param = self._layer_params()
+        scores = np.empty((N, W3.shape[1]), dtype=self.dtype)
+
+        def layer_input(start, stop):
+            x = X[start:stop].astype(self.dtype, copy=False)
+            if self.layout == 'NHWC':
+                x = x.transpose(0, 2, 3, 1)
+            return x
+
+        # Pick the convolution of every chunk size here, so that the threads
+        # never run the tuner at the same time
+        params = {}
+        for n in {min(batch_size, N), N % batch_size} - {0}:
+            backend = get_conv_backend(layer_input(0, n), W1, b1, conv_param)
+            if num_threads > 1 and backend == 'planned':
+                # A ConvPlan's buffers are shared by every call with the same
+                # shapes, so threads run the same im2col without them
+                backend = 'strides'
+            params[n] = dict(conv_param, backend=backend)
+
+        def run(starts):
+            hidden = np.empty((batch_size, W2.shape[1]), dtype=self.dtype)
+            for start in starts:
+                stop = min(start + batch_size, N)
+                x = layer_input(start, stop)
+                pooled = self._conv_relu_pool(x, params[stop - start], pool_param)
+                if self.layout == 'NHWC':
+                    pooled = pooled.transpose(0, 3, 1, 2)
+                h = hidden[:stop - start]
+                np.dot(pooled.reshape(stop - start, -1), W2, out=h)
+                h += b2
+                np.maximum(h, 0, out=h)
+                out = scores[start:stop]
+                np.dot(h, W3, out=out)
+                out += b3
+
+        starts = range(0, N, batch_size)
+        if num_threads > 1:
+            with ThreadPoolExecutor(num_threads) as pool:
+                list(pool.map(run, [starts[k::num_threads] for k in range(num_threads)]))
+        else:
+            run(starts)
+
+        if return_scores:
+            return scores
+        return np.argmax(scores, axis=1)
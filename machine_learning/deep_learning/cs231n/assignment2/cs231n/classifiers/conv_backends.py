@@ -0,0 +1,283 @@
+"""
+A registry of convolution implementations with an auto-tuner on top.
+
+Every backend has the same interface as conv_forward_naive / conv_backward_naive
+plus a supports(x_shape, w_shape, conv_param) predicate. The first time
+conv_forward_auto sees a signature (the shape of one sample, the batch size
+rounded up to a power of two, w.shape, stride, pad, dtype) it times
+forward + backward of every backend that supports it, remembers the fastest
+one and writes the choice to a small JSON tuning file, so later runs go
+straight to the winner. Rounding the batch size means a last, partial batch
+does not trigger a tuning run of its own. Reference backends such as naive
+are only timed when no other backend supports the configuration.
+
+Setting conv_param['backend'] to a registered name skips the tuner and
+always uses that backend, e.g. 'tiled' to bound the memory of large batches.
+Every backend also declares the memory layout it works on, and only backends
+matching conv_param['layout'] ('NCHW' by default, or 'NHWC') are considered.
+
+The tuning file defaults to ~/.cs231n/conv_tuning.json and can be moved with
+the CS231N_CONV_TUNING environment variable or set_tuning_file(); passing
+None keeps the choices in memory only.
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from time import time
+
+import numpy as np
+
+from .layers import conv_forward_naive, conv_backward_naive
+from .fast_layers import conv_forward_im2col, conv_backward_im2col,\
+    conv_forward_strides, conv_backward_strides,\
+    conv_forward_planned, conv_backward_planned,\
+    conv_forward_1x1, conv_backward_1x1,\
+    conv_forward_winograd, conv_backward_winograd,\
+    conv_forward_fft, conv_backward_fft,\
+    conv_forward_tiled, conv_backward_tiled,\
+    conv_forward_nhwc, conv_backward_nhwc
+
+_backends = OrderedDict()
+_layouts = {}
+_references = set()
+_choices = {}
+_loaded = False
+# Held while _choices or the tuning file is updated
+_choices_lock = threading.Lock()
+_tuning_file = os.environ.get('CS231N_CONV_TUNING',
+                              os.path.join(os.path.expanduser('~'), '.cs231n', 'conv_tuning.json'))
+
+
+def _layout(conv_param):
+    return conv_param.get('layout', 'NCHW')
+
+
+def _fits(x_shape, w_shape, conv_param):
+    """
+    True if the filters tile the padded input exactly, which every backend
+    except naive asserts.
+    """
+    if _layout(conv_param) == 'NHWC':
+        _, H, W, _ = x_shape
+    else:
+        _, _, H, W = x_shape
+    _, _, HH, WW = w_shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    return (H + 2 * pad - HH) % stride == 0 and (W + 2 * pad - WW) % stride == 0
+
+
+def register_conv_backend(name, forward, backward, supports=None, layout='NCHW', reference=False):
+    """
+    Add a convolution implementation to the registry.
+
+    Inputs:
+        - name: Unique string naming the backend; this is what the tuning file stores
+        - forward: Function (x, w, b, conv_param) -> (out, cache)
+        - backward: Function (dout, cache) -> (dx, dw, db)
+        - supports: Optional function (x_shape, w_shape, conv_param) -> bool telling
+            whether the backend can handle that configuration. Defaults to
+            accepting everything.
+        - layout: Memory layout of x and out, 'NCHW' or 'NHWC'
+        - reference: Whether this is a slow reference implementation, which the
+            tuner only times if no other backend supports a configuration
+    """
+    if supports is None:
+        supports = lambda x_shape, w_shape, conv_param: True
+    _backends[name] = (forward, backward, supports)
+    _layouts[name] = layout
+    if reference:
+        _references.add(name)
+    else:
+        _references.discard(name)
+
+
+def available_conv_backends(x_shape, w_shape, conv_param):
+    """
+    Names of the registered backends that support this configuration.
+    """
+    return [name for name, (_, _, supports) in _backends.items()
+            if _layouts[name] == _layout(conv_param)
+            and supports(x_shape, w_shape, conv_param)]
+
+
+def set_tuning_file(path):
+    """
+    Use path as the tuning file (None disables persistence) and forget the
+    choices loaded from the previous one.
+    """
+    global _tuning_file, _loaded
+    with _choices_lock:
+        _tuning_file = path
+        _loaded = False
+        _choices.clear()
+
+
+def _signature(x, w, conv_param):
+    dtype = np.result_type(x.dtype, w.dtype)
+    # Batch sizes share a signature up to the next power of two
+    batch_bucket = 1 << max(x.shape[0] - 1, 0).bit_length()
+    signature = 'N<={}|{}|{}|stride={}|pad={}|{}'.format(batch_bucket, 'x'.join(map(str, x.shape[1:])),
+                                                         'x'.join(map(str, w.shape)),
+                                                         conv_param['stride'], conv_param['pad'],
+                                                         dtype.name)
+    if _layout(conv_param) != 'NCHW':
+        signature += '|' + _layout(conv_param)
+    return signature
+
+
+def _read_tuning_file():
+    """
+    Choices stored in the tuning file, or an empty dictionary if there is none.
+    """
+    if _tuning_file is None or not os.path.exists(_tuning_file):
+        return {}
+    try:
+        with open(_tuning_file, 'r') as f:
+            choices = json.load(f)
+    except (IOError, ValueError):
+        # A broken tuning file only costs a re-tune
+        return {}
+    return choices if isinstance(choices, dict) else {}
+
+
+def _load_choices():
+    global _loaded
+    with _choices_lock:
+        _choices.update(_read_tuning_file())
+        _loaded = True
+
+
+def _record_choice(signature, choice):
+    """
+    Store choice in memory and in the tuning file. The file is read again
+    just before it is replaced, so the choices other processes saved since it
+    was loaded are kept, and picked up by this one.
+    """
+    with _choices_lock:
+        _choices[signature] = choice
+        if _tuning_file is None:
+            return
+        choices = _read_tuning_file()
+        for key, value in _choices.items():
+            choices.setdefault(key, value)
+        choices[signature] = choice
+        _choices.update(choices)
+
+        directory = os.path.dirname(_tuning_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(_tuning_file, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(choices, f, indent=2, sort_keys=True)
+        os.replace(tmp, _tuning_file)
+
+
+def tune_conv(x, w, b, conv_param, num_repeats=3):
+    """
+    Time every backend that supports this configuration and record the fastest.
+
+    Each candidate runs one untimed warm-up forward pass and then num_repeats
+    timed forward + backward passes, of which the best is kept. A candidate
+    whose forward pass alone is several times slower than the best forward +
+    backward so far is dropped without running its backward pass, which keeps
+    the slower backends from dominating the tuning time. Reference backends
+    are skipped, with a time of None, if any other backend is a candidate.
+
+    Returns a dictionary with the keys 'backend' (name of the winner) and
+    'times' (name -> seconds, None for pruned candidates).
+    """
+    candidates = available_conv_backends(x.shape, w.shape, conv_param)
+    if not candidates:
+        raise ValueError('No convolution backend supports {}'.format(_signature(x, w, conv_param)))
+
+    best_name, best_time = None, float('inf')
+    times = {}
+    if any(name not in _references for name in candidates):
+        times = {name: None for name in candidates if name in _references}
+        candidates = [name for name in candidates if name not in _references]
+    for name in candidates:
+        forward, backward, _ = _backends[name]
+        # The first call pays for page faults on freshly allocated buffers,
+        # which can be many times the steady-state cost, so it is not timed
+        out, cache = forward(x, w, b, conv_param)
+        dout = np.ones_like(out)
+
+        elapsed = float('inf')
+        for _ in range(num_repeats):
+            t0 = time()
+            out, cache = forward(x, w, b, conv_param)
+            if time() - t0 > 3 * best_time:
+                break
+            backward(dout, cache)
+            elapsed = min(elapsed, time() - t0)
+
+        times[name] = elapsed if elapsed != float('inf') else None
+        if elapsed < best_time:
+            best_name, best_time = name, elapsed
+
+    choice = {'backend': best_name, 'times': times}
+    _record_choice(_signature(x, w, conv_param), choice)
+    return choice
+
+
+def get_conv_backend(x, w, b, conv_param):
+    """
+    Name of the backend to use for this configuration, tuning it on first use.
+    """
+    if 'backend' in conv_param:
+        if conv_param['backend'] not in _backends:
+            raise ValueError('Unknown convolution backend "{}"'.format(conv_param['backend']))
+        if _layouts[conv_param['backend']] != _layout(conv_param):
+            raise ValueError('Convolution backend "{}" does not support the {} layout'.format(
+                conv_param['backend'], _layout(conv_param)))
+        return conv_param['backend']
+    if not _loaded:
+        _load_choices()
+    choice = _choices.get(_signature(x, w, conv_param))
+    # Re-tune if the stored winner is not registered in this process
+    if choice is None or choice['backend'] not in _backends:
+        choice = tune_conv(x, w, b, conv_param)
+    return choice['backend']
+
+
+def conv_forward_auto(x, w, b, conv_param):
+    """
+    Forward pass for a convolutional layer through the fastest registered
+    backend for this configuration. Same interface as conv_forward_naive.
+    """
+    name = get_conv_backend(x, w, b, conv_param)
+    forward, _, _ = _backends[name]
+    out, backend_cache = forward(x, w, b, conv_param)
+    cache = (name, backend_cache)
+    return out, cache
+
+
+def conv_backward_auto(dout, cache):
+    """
+    Backward pass matching conv_forward_auto.
+    """
+    name, backend_cache = cache
+    _, backward, _ = _backends[name]
+    return backward(dout, backend_cache)
+
+
+register_conv_backend('planned', conv_forward_planned, conv_backward_planned, _fits)
+register_conv_backend('strides', conv_forward_strides, conv_backward_strides, _fits)
+register_conv_backend('im2col_cython', conv_forward_im2col, conv_backward_im2col,
+                      lambda x_shape, w_shape, conv_param: _fits(x_shape, w_shape, conv_param)
+                      and w_shape[2] == w_shape[3])
+register_conv_backend('tiled', conv_forward_tiled, conv_backward_tiled, _fits)
+register_conv_backend('gemm_1x1', conv_forward_1x1, conv_backward_1x1,
+                      lambda x_shape, w_shape, conv_param: w_shape[2] == w_shape[3] == 1
+                      and conv_param['pad'] == 0)
+register_conv_backend('winograd', conv_forward_winograd, conv_backward_winograd,
+                      lambda x_shape, w_shape, conv_param: w_shape[2] == w_shape[3] == 3
+                      and conv_param['stride'] == 1)
+register_conv_backend('fft', conv_forward_fft, conv_backward_fft,
+                      lambda x_shape, w_shape, conv_param: conv_param['stride'] == 1)
+# conv_backward_naive slices the padding off with pad:-pad
+register_conv_backend('naive', conv_forward_naive, conv_backward_naive,
+                      lambda x_shape, w_shape, conv_param: conv_param['pad'] > 0, reference=True)
+register_conv_backend('nhwc', conv_forward_nhwc, conv_backward_nhwc, _fits, layout='NHWC')
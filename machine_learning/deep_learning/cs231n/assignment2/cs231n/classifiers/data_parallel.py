@@ -0,0 +1,221 @@
+"""
+Data-parallel training over several processes.
+
+A DataParallel runs model.loss in num_workers worker processes. Everything the
+workers touch lives in shared memory:
+    - the minibatch buffer, which the master fills with every batch,
+    - the parameter buffer of the master's FlatParams, so an in-place update
+      rule on the master is seen by every worker without copying,
+    - one gradient buffer per worker.
+Each step the master splits the minibatch into one contiguous shard per
+worker, the workers compute the loss and gradients of their shard and write
+the gradients scaled by the shard's share of the batch into their buffer,
+and the master sums those buffers into FlatParams.grad.
+
+Since the losses of the models are means over the batch plus a regularization
+term, this weighted sum is the gradient of the whole batch, so training gives
+the same parameters as a single process at the same batch size up to
+floating point summation order. That does not hold for batch normalization,
+which would normalize each shard on its own and keep its running averages in
+the workers, so models with batchnorm are rejected. Dropout masks are random
+either way; every worker seeds its own generator.
+
+Only the small pipe messages that start a step and return its loss are
+pickled; arrays are never sent between the processes.
+"""
+
+import multiprocessing
+import traceback
+from collections import OrderedDict
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+def _shared_array(shape, dtype, name=None):
+    """
+    Array in a new shared memory block, or in the existing block name.
+    Returns a tuple (shm, array).
+    """
+    if name is None:
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        shm = SharedMemory(create=True, size=size)
+    else:
+        shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _worker(rank, model, specs, layout, seed, conn):
+    """
+    Main loop of worker process rank. Every message is a tuple
+    (start, stop, scale) naming the shard X[start:stop] of the shared
+    minibatch; None ends the loop.
+    """
+    shms, arrays = {}, {}
+    for key, (name, shape, dtype) in specs.items():
+        shms[key], arrays[key] = _shared_array(shape, dtype, name)
+    X, y, data = arrays['X'], arrays['y'], arrays['data']
+    grad = arrays['grads'][rank]
+    model.params = OrderedDict((name, data[s].reshape(shape)) for name, s, shape in layout)
+    grads_out = [(name, grad[s].reshape(shape)) for name, s, shape in layout]
+    np.random.seed(seed)
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        start, stop, scale = message
+        try:
+            loss, grads = model.loss(X[start:stop], y[start:stop])
+            for name, out in grads_out:
+                np.multiply(grads[name], scale, out=out, casting='same_kind')
+            conn.send((loss * scale, None))
+        except Exception:
+            conn.send((None, traceback.format_exc()))
+
+    model.params = arrays = X = y = data = grad = grads_out = None
+    for shm in shms.values():
+        shm.close()
+
+
+class DataParallel:
+    """
+    Worker processes computing the loss and gradients of a model on shards of
+    every minibatch.
+
+    Example usage, with an elementwise update rule from optim.py:
+
+        flat = FlatParams(model.params)
+        model.params = flat.params
+        config = {'learning_rate': 1e-3, 'inplace': True}
+        with DataParallel(model, flat, X_train, y_train, batch_size, 4) as parallel:
+            for t in range(num_iterations):
+                X_batch, y_batch = loader.next_batch()
+                loss = parallel.loss(X_batch, y_batch)
+                optim.adam(flat.data, flat.grad, config)
+
+    While it is open, flat.data lives in shared memory; close moves it back to
+    ordinary memory.
+    """
+    def __init__(self, model, flat, X, y, batch_size, num_workers, seed=None):
+        """
+        Start the workers.
+
+        Inputs:
+            - model: Model to train, whose params are flat.params
+            - flat: FlatParams of the model; its gradient buffer receives the
+                summed gradients
+            - X, y: Training data and labels. Only their shapes and dtypes are
+                used, to size the shared minibatch buffer.
+            - batch_size: Largest minibatch passed to loss
+            - num_workers: Number of worker processes
+            - seed: Base seed of the workers' np.random; worker k uses seed + k.
+                Defaults to a seed drawn from np.random.
+        """
+        if num_workers < 1:
+            raise ValueError('num_workers must be positive, got {}'.format(num_workers))
+        if getattr(model, 'use_batchnorm', False):
+            raise ValueError('Models with batch normalization cannot be trained data-parallel')
+        if model.params is not flat.params:
+            raise ValueError('model.params must be the params of flat')
+        if seed is None:
+            seed = np.random.randint(2**31 - num_workers)
+        self.flat = flat
+        self.num_workers = num_workers
+        self._closed = False
+
+        shapes = {
+            'X': ((batch_size,) + X.shape[1:], X.dtype),
+            'y': ((batch_size,) + y.shape[1:], y.dtype),
+            'data': (flat.data.shape, flat.data.dtype),
+            'grads': ((num_workers,) + flat.data.shape, flat.data.dtype),
+        }
+        self._shms, arrays = {}, {}
+        for key, (shape, dtype) in shapes.items():
+            self._shms[key], arrays[key] = _shared_array(shape, dtype)
+        self._X, self._y, self._grads = arrays['X'], arrays['y'], arrays['grads']
+        flat.move_to(arrays['data'])
+
+        specs = {key: (self._shms[key].name, shape, dtype) for key, (shape, dtype) in shapes.items()}
+        layout = [(name, s, flat.params[name].shape) for name, s in flat.slices.items()]
+        self._conns = []
+        self._processes = []
+        for rank in range(num_workers):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker, name='DataParallel-{}'.format(rank),
+                                              args=(rank, model, specs, layout, seed + rank, child_conn))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._processes.append(process)
+
+    def loss(self, X, y):
+        """
+        Training loss of the minibatch (X, y). The gradients are summed into
+        flat.grad.
+
+        Inputs:
+            - X: Array of input data of shape (N, d_1, ..., d_k), N <= batch_size
+            - y: Array of labels, of shape (N,)
+
+        Returns:
+            - loss: Scalar giving the loss of the whole minibatch
+        """
+        if self._closed:
+            raise ValueError('loss() on a closed DataParallel')
+        N = X.shape[0]
+        self._X[:N] = X
+        self._y[:N] = y
+
+        # Contiguous shards, the first N % num_workers one sample larger
+        num_active = min(self.num_workers, N)
+        sizes = np.full(num_active, N // num_active)
+        sizes[:N % num_active] += 1
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+        for k in range(num_active):
+            self._conns[k].send((int(bounds[k]), int(bounds[k + 1]), float(sizes[k]) / N))
+
+        loss, errors = 0.0, []
+        for k in range(num_active):
+            shard_loss, error = self._conns[k].recv()
+            if error is not None:
+                errors.append('worker {}:\n{}'.format(k, error))
+            else:
+                loss += shard_loss
+        if errors:
+            raise RuntimeError('Data-parallel loss failed in ' + '\n'.join(errors))
+
+        np.sum(self._grads[:num_active], axis=0, out=self.flat.grad)
+        return loss
+
+    def close(self):
+        """
+        Stop the workers, move the parameters back to ordinary memory and free
+        the shared memory. Cannot be used afterwards.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for conn in self._conns:
+            conn.send(None)
+            conn.close()
+        for process in self._processes:
+            process.join()
+        self.flat.move_to(self.flat.data.copy())
+
+        self._X = self._y = self._grads = None
+        for shm in self._shms.values():
+            try:
+                shm.close()
+            except BufferError:
+                # Someone still holds a view of the block; it stays mapped
+                # until that view is gone, but the name can be released
+                pass
+            shm.unlink()
+        self._shms = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
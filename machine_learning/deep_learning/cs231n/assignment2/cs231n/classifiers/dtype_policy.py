@@ -0,0 +1,116 @@
+"""
+Dtype policy for the layer library: every layer, loss and update rule returns
+floating point arrays of the same dtype as its floating point inputs, so a
+model built with dtype=np.float32 runs in float32 from the input to the
+optimizer state.
+
+The policy is enforced by the functions themselves. To find places that break
+it, turn on strict mode with set_strict_dtypes(True) or by setting the
+CS231N_STRICT_DTYPES environment variable; every function decorated with
+preserves_dtype then checks its inputs and outputs and raises a TypeError
+naming the function as soon as anything is upcast (or downcast). Strict mode
+is off by default and then costs one flag check per call.
+
+The decorator is also where profiler.py hooks into every layer, loss and
+update rule; see set_call_hook.
+"""
+
+import functools
+import os
+
+import numpy as np
+
+_strict = bool(os.environ.get('CS231N_STRICT_DTYPES'))
+_hook = None
+
+
+def set_strict_dtypes(strict=True):
+    """
+    Turn strict dtype checking on or off. Returns the previous setting.
+    """
+    global _strict
+    previous = _strict
+    _strict = bool(strict)
+    return previous
+
+
+def strict_dtypes():
+    """
+    True if strict dtype checking is on.
+    """
+    return _strict
+
+
+def set_call_hook(hook):
+    """
+    Install hook, a function hook(name) returning a context manager that is
+    entered around every call of a function decorated with preserves_dtype,
+    or remove it with None. Returns the previous hook.
+    """
+    global _hook
+    previous = _hook
+    _hook = hook
+    return previous
+
+
+def _floating_arrays(value):
+    """
+    Yield every floating point array in value, looking inside the tuples,
+    lists and dictionaries used for caches and optimizer configs.
+    """
+    if isinstance(value, np.ndarray):
+        if np.issubdtype(value.dtype, np.floating):
+            yield value
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            for array in _floating_arrays(item):
+                yield array
+    elif isinstance(value, dict):
+        for item in value.values():
+            for array in _floating_arrays(item):
+                yield array
+
+
+def check_dtype(name, dtype, value):
+    """
+    Raise a TypeError if any floating point array in value is not of dtype.
+
+    Inputs:
+        - name: Name used in the error message, usually the function checked
+        - dtype: Expected numpy dtype
+        - value: Array, or tuple / list / dict of arrays, to check
+    """
+    for array in _floating_arrays(value):
+        if array.dtype != dtype:
+            raise TypeError('{} changed dtype from {} to {}'.format(name, np.dtype(dtype).name,
+                                                                    array.dtype.name))
+
+
+def preserves_dtype(func):
+    """
+    Decorator for layers, losses and update rules. In strict mode the dtype of
+    the first floating point array argument is the reference: every other
+    floating point array argument and everything returned, caches and configs
+    included, must have the same dtype.
+    """
+    def checked(*args, **kwargs):
+        if not _strict:
+            return func(*args, **kwargs)
+        arrays = list(_floating_arrays(args))
+        if not arrays:
+            return func(*args, **kwargs)
+        dtype = arrays[0].dtype
+        check_dtype(func.__name__ + ' input', dtype, args)
+        result = func(*args, **kwargs)
+        check_dtype(func.__name__, dtype, result)
+        return result
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _hook is None:
+            if not _strict:
+                return func(*args, **kwargs)
+            return checked(*args, **kwargs)
+        with _hook(func.__name__):
+            return checked(*args, **kwargs)
+    return wrapper
@@ -1,8 +1,15 @@
+from collections import OrderedDict
+
 import numpy as np
 
 from cs231n.im2col_cython import col2im_cython, im2col_cython
 from cs231n.im2col_cython import col2im_6d_cython
+from cs231n.im2col_cython import im2col_cython_parallel, col2im_cython_parallel,\
+    col2im_6d_cython_parallel
+
+from .dtype_policy import preserves_dtype
 
+@preserves_dtype
 def conv_forward_im2col(x, w, b, conv_param):
   """
   A fast implementation of the forward pass for a convolutional layer
@@ -22,7 +29,7 @@ def conv_forward_im2col(x, w, b, conv_param):
   out = np.zeros((N, num_filters, out_height, out_width), dtype=x.dtype)
 
   # x_cols = im2col_indices(x, w.shape[2], w.shape[3], pad, stride)
-  x_cols = im2col_cython(x, w.shape[2], w.shape[3], pad, stride)
+  x_cols = im2col_cython_parallel(x, w.shape[2], w.shape[3], pad, stride)
   res = w.reshape((w.shape[0], -1)).dot(x_cols) + b.reshape(-1, 1)
 
   out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
@@ -32,6 +39,7 @@ def conv_forward_im2col(x, w, b, conv_param):
   return out, cache
 
 
+@preserves_dtype
 def conv_forward_strides(x, w, b, conv_param):
   N, C, H, W = x.shape
   F, _, HH, WW = w.shape
@@ -76,6 +84,7 @@ def conv_forward_strides(x, w, b, conv_param):
   return out, cache
   
 
+@preserves_dtype
 def conv_backward_strides(dout, cache):
   x, w, b, conv_param, x_cols = cache
   stride, pad = conv_param['stride'], conv_param['pad']
@@ -91,11 +100,12 @@ def conv_backward_strides(dout, cache):
 
   dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
   dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-  dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+  dx = col2im_6d_cython_parallel(dx_cols, N, C, H, W, HH, WW, pad, stride)
 
   return dx, dw, db
 
 
+@preserves_dtype
 def conv_backward_im2col(dout, cache):
   """
   A fast implementation of the backward pass for a convolutional layer
@@ -112,56 +122,833 @@ def conv_backward_im2col(dout, cache):
 
   dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
   # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
-  dx = col2im_cython(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
-                     filter_height, filter_width, pad, stride)
+  dx = col2im_cython_parallel(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
+                              filter_height, filter_width, pad, stride)
+
+  return dx, dw, db
+
+
+class ConvPlan:
+  """
+  Preallocated work buffers for conv_forward_strides / conv_backward_strides
+  on one fixed configuration (x.shape, w.shape, stride, pad, dtype).
+
+  The padded input keeps its zero border between calls, so each forward pass
+  only copies x into the interior; the column matrix, the GEMM result and the
+  backward column gradient are all written in place. The output is a new
+  array on every call.
+
+  The column matrix is shared by every forward call with the same
+  configuration, e.g. two conv layers of the same shape. Every forward pass
+  bumps generation, and backward rebuilds the columns from x when they were
+  overwritten since the forward pass of its cache.
+  """
+  def __init__(self, x_shape, w_shape, stride, pad, dtype):
+    N, C, H, W = x_shape
+    F, _, HH, WW = w_shape
+    assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+    assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+
+    self.x_shape, self.w_shape = x_shape, w_shape
+    self.stride, self.pad = stride, pad
+    self.dtype = np.dtype(dtype)
+
+    Hp, Wp = H + 2 * pad, W + 2 * pad
+    self.out_h = (Hp - HH) // stride + 1
+    self.out_w = (Wp - WW) // stride + 1
+    cols = N * self.out_h * self.out_w
+
+    self.x_padded = np.zeros((N, C, Hp, Wp), dtype=self.dtype)
+    self.x_interior = self.x_padded[:, :, pad:pad + H, pad:pad + W]
+
+    # Same im2col-by-strides trick as conv_forward_strides, but the view is
+    # built once over the persistent padded buffer.
+    shape = (C, HH, WW, N, self.out_h, self.out_w)
+    strides = (Hp * Wp, Wp, 1, C * Hp * Wp, stride * Wp, stride)
+    strides = self.dtype.itemsize * np.array(strides)
+    self.x_stride = np.lib.stride_tricks.as_strided(self.x_padded,
+                      shape=shape, strides=strides)
+
+    self.x_cols = np.empty((C * HH * WW, cols), dtype=self.dtype)
+    self.x_cols_6d = self.x_cols.reshape(shape)
+    self.res = np.empty((F, cols), dtype=self.dtype)
+    self.generation = 0
+    self.dout_cols = np.empty((F, cols), dtype=self.dtype)
+    self.dx_cols = np.empty((C * HH * WW, cols), dtype=self.dtype)
+
+  @property
+  def nbytes(self):
+    """
+    Total size of the work buffers.
+    """
+    return sum(a.nbytes for a in (self.x_padded, self.x_cols, self.res,
+                                  self.dout_cols, self.dx_cols))
+
+  def forward(self, x, w, b):
+    N, C, H, W = self.x_shape
+    F = self.w_shape[0]
+
+    self._fill_cols(x)
+    np.dot(w.reshape(F, -1), self.x_cols, out=self.res)
+    self.res += b.reshape(-1, 1)
+
+    res = self.res.reshape(F, N, self.out_h, self.out_w)
+    return res.transpose(1, 0, 2, 3).copy()
+
+  def _fill_cols(self, x):
+    self.x_interior[...] = x
+    self.x_cols_6d[...] = self.x_stride
+    self.generation += 1
+
+  def backward(self, dout, x, w, generation):
+    N, C, H, W = self.x_shape
+    F, _, HH, WW = self.w_shape
+
+    if generation != self.generation:
+      self._fill_cols(x)
+
+    db = np.sum(dout, axis=(0, 2, 3))
+
+    dout_cols = self.dout_cols.reshape(F, N, self.out_h, self.out_w)
+    dout_cols[...] = dout.transpose(1, 0, 2, 3)
+    dw = self.dout_cols.dot(self.x_cols.T).reshape(w.shape)
+
+    np.dot(w.reshape(F, -1).T, self.dout_cols, out=self.dx_cols)
+    dx_cols = self.dx_cols.reshape(C, HH, WW, N, self.out_h, self.out_w)
+    dx = col2im_6d_cython_parallel(dx_cols, N, C, H, W, HH, WW, self.pad, self.stride)
+
+    return dx, dw, db
+
+
+# Most recently used last
+_conv_plans = OrderedDict()
+# Largest number of ConvPlans kept in _conv_plans
+MAX_CONV_PLANS = 8
+
+
+def get_conv_plan(x, w, conv_param):
+  """
+  Return the ConvPlan for this (x.shape, w.shape, stride, pad, dtype),
+  building it on first use.
+
+  Only the MAX_CONV_PLANS most recently used plans are kept, so a stream of
+  new shapes, such as varying batch sizes, does not keep their buffers alive
+  forever. An evicted plan stays valid for the caches that still refer to it.
+
+  A plan saves reallocating the padded input, the columns and the GEMM
+  result, but forward still returns a copy of the output, because handing out
+  the result buffer would let the next call overwrite an activation that is
+  still in use. A net whose convolutions need more than MAX_CONV_PLANS plans
+  rebuilds them on every pass and gains nothing over the strides backend.
+  """
+  stride, pad = conv_param['stride'], conv_param['pad']
+  dtype = np.result_type(x.dtype, w.dtype)
+  key = (x.shape, w.shape, stride, pad, dtype)
+  plan = _conv_plans.get(key)
+  if plan is None:
+    plan = ConvPlan(x.shape, w.shape, stride, pad, dtype)
+    _conv_plans[key] = plan
+    while len(_conv_plans) > MAX_CONV_PLANS:
+      _conv_plans.popitem(last=False)
+  else:
+    _conv_plans.move_to_end(key)
+  return plan
+
+
+def clear_conv_plans():
+  """
+  Drop every cached ConvPlan and release its buffers.
+  """
+  _conv_plans.clear()
+
+
+@preserves_dtype
+def conv_forward_planned(x, w, b, conv_param):
+  """
+  conv_forward_strides on top of a cached ConvPlan, so that repeated calls
+  with the same shapes do not reallocate the padded input, the columns or the
+  output. See ConvPlan for how caches of several calls share the columns.
+  """
+  plan = get_conv_plan(x, w, conv_param)
+  out = plan.forward(x, w, b)
+  cache = (x, w, b, conv_param, plan, plan.generation)
+  return out, cache
+
+
+@preserves_dtype
+def conv_backward_planned(dout, cache):
+  """
+  Backward pass matching conv_forward_planned. If another forward call with
+  the same configuration ran in between, the columns are rebuilt from x.
+  """
+  x, w, b, conv_param, plan, generation = cache
+  return plan.backward(dout.astype(plan.dtype, copy=False), x, w, generation)
+
+
+@preserves_dtype
+def conv_forward_1x1(x, w, b, conv_param):
+  """
+  A 1x1 convolution without padding is a plain matrix multiply over the
+  channel axis, so it needs no im2col at all. The batched matmul writes the
+  output directly in (N, F, H', W') order.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  assert HH == WW == 1 and pad == 0, 'conv_forward_1x1 needs 1x1 filters and pad 0'
+
+  x_strided = x[:, :, ::stride, ::stride]
+  _, _, out_h, out_w = x_strided.shape
+  x_rows = x_strided.reshape(N, C, out_h * out_w)
+
+  out = np.matmul(w.reshape(F, C), x_rows)
+  out += b.reshape(-1, 1)
+  out.shape = (N, F, out_h, out_w)
+
+  cache = (x, w, b, conv_param, x_rows)
+  return out, cache
+
+
+@preserves_dtype
+def conv_backward_1x1(dout, cache):
+  x, w, b, conv_param, x_rows = cache
+  stride = conv_param['stride']
+  N, C, H, W = x.shape
+  F = w.shape[0]
+  _, _, out_h, out_w = dout.shape
+
+  dout_rows = dout.reshape(N, F, out_h * out_w)
+  db = np.sum(dout, axis=(0, 2, 3))
+  dw = np.tensordot(dout_rows, x_rows, axes=([0, 2], [0, 2])).reshape(w.shape)
+
+  dx_rows = np.matmul(w.reshape(F, C).T, dout_rows)
+  if stride == 1:
+    dx = dx_rows.reshape(x.shape)
+  else:
+    dx = np.zeros_like(x, dtype=dx_rows.dtype)
+    dx[:, :, ::stride, ::stride] = dx_rows.reshape(N, C, out_h, out_w)
+
+  return dx, dw, db
+
+
+# Transforms for Winograd F(2x2, 3x3): a 4x4 input tile d and a 3x3 filter g
+# give the 2x2 output tile A^T [(G g G^T) * (B^T d B)] A.
+_WINOGRAD_BT = np.array([[1, 0, -1, 0],
+                         [0, 1, 1, 0],
+                         [0, -1, 1, 0],
+                         [0, 1, 0, -1]], dtype=np.float64)
+_WINOGRAD_G = np.array([[1, 0, 0],
+                        [0.5, 0.5, 0.5],
+                        [0.5, -0.5, 0.5],
+                        [0, 0, 1]], dtype=np.float64)
+_WINOGRAD_AT = np.array([[1, 1, 1, 0],
+                         [0, 1, -1, -1]], dtype=np.float64)
+
+
+def _winograd_transform(left, right, tiles):
+  """
+  Compute out[k][l] = sum_ij left[k, i] * right[l, j] * tiles[i][j] for nested
+  lists of equally shaped arrays. The Winograd matrices are mostly 0 and +-1,
+  so this is done with additions on whole arrays instead of a tensor product.
+  """
+  def combine(coeffs, arrays):
+    acc = None
+    for c, a in zip(coeffs, arrays):
+      if c == 0:
+        continue
+      term = a if c == 1 else (-a if c == -1 else c * a)
+      acc = term if acc is None else acc + term
+    return acc
+
+  rows = [[combine(left[k], [tiles[i][j] for i in range(len(tiles))])
+           for j in range(len(tiles[0]))] for k in range(left.shape[0])]
+  return [[combine(right[l], rows[k]) for l in range(right.shape[0])]
+          for k in range(left.shape[0])]
+
+
+@preserves_dtype
+def conv_forward_winograd(x, w, b, conv_param):
+  """
+  Forward pass for a 3x3, stride 1 convolutional layer using Winograd
+  F(2x2, 3x3).
+
+  The padded input is cut into overlapping 4x4 tiles with stride 2, each of
+  which yields a 2x2 block of the output. After transforming tiles and filters
+  the channel sum becomes 16 independent batches of (F, C) x (C, tiles) matrix
+  products, which costs 16 instead of 36 multiplies per 2x2 output block and
+  never builds the 9x larger im2col matrix.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  assert HH == WW == 3 and stride == 1, 'conv_forward_winograd needs 3x3 filters and stride 1'
+
+  dtype = np.result_type(x.dtype, w.dtype)
+  out_h, out_w = H + 2 * pad - 2, W + 2 * pad - 2
+  th, tw = (out_h + 1) // 2, (out_w + 1) // 2
+
+  # Pad to a whole number of tiles; the extra row / column is cropped below
+  x_padded = np.zeros((N, C, 2 * th + 2, 2 * tw + 2), dtype=dtype)
+  x_padded[:, :, pad:pad + H, pad:pad + W] = x
+
+  # tiles[i][j][n, c, y, x] is element (i, j) of tile (y, x)
+  tiles = [[x_padded[:, :, i:i + 2 * th:2, j:j + 2 * tw:2] for j in range(4)]
+           for i in range(4)]
+  V = _winograd_transform(_WINOGRAD_BT, _WINOGRAD_BT, tiles)
+  V = np.stack([v for row in V for v in row]).reshape(16, N, C, th * tw)
+
+  U = np.einsum('ik,fckl,jl->ijfc', _WINOGRAD_G, w, _WINOGRAD_G)
+  U = U.astype(dtype).reshape(16, 1, F, C)
+
+  M = np.matmul(U, V).reshape(4, 4, N, F, th, tw)
+  Y = _winograd_transform(_WINOGRAD_AT, _WINOGRAD_AT, M)
+
+  out = np.empty((N, F, 2 * th, 2 * tw), dtype=dtype)
+  for a in range(2):
+    for c in range(2):
+      out[:, :, a::2, c::2] = Y[a][c]
+  out = out[:, :, :out_h, :out_w] + b.reshape(1, -1, 1, 1)
+
+  cache = (x, w, b, conv_param, U, V)
+  return out, cache
+
+
+@preserves_dtype
+def conv_backward_winograd(dout, cache):
+  """
+  Backward pass matching conv_forward_winograd. Every step of the forward pass
+  is linear, so the gradients flow back through the transposed transforms.
+  """
+  x, w, b, conv_param, U, V = cache
+  pad = conv_param['pad']
+  N, C, H, W = x.shape
+  F = w.shape[0]
+  _, _, out_h, out_w = dout.shape
+  th, tw = (out_h + 1) // 2, (out_w + 1) // 2
+  dtype = V.dtype
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  dY = np.zeros((N, F, 2 * th, 2 * tw), dtype=dtype)
+  dY[:, :, :out_h, :out_w] = dout
+  dY = [[dY[:, :, a::2, c::2] for c in range(2)] for a in range(2)]
+  dM = _winograd_transform(_WINOGRAD_AT.T, _WINOGRAD_AT.T, dY)
+  dM = np.stack([m for row in dM for m in row]).reshape(16, N, F, th * tw)
+
+  dU = np.matmul(dM, V.transpose(0, 1, 3, 2)).sum(axis=1).reshape(4, 4, F, C)
+  dw = np.einsum('ik,ijfc,jl->fckl', _WINOGRAD_G, dU, _WINOGRAD_G).astype(w.dtype)
+
+  dV = np.matmul(U.transpose(0, 1, 3, 2), dM).reshape(4, 4, N, C, th, tw)
+  dtiles = _winograd_transform(_WINOGRAD_BT.T, _WINOGRAD_BT.T, dV)
+
+  # Scatter the overlapping 4x4 tiles back onto the padded input
+  dx_padded = np.zeros((N, C, 2 * th + 2, 2 * tw + 2), dtype=dtype)
+  for i in range(4):
+    for j in range(4):
+      dx_padded[:, :, i:i + 2 * th:2, j:j + 2 * tw:2] += dtiles[i][j]
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+  return dx, dw, db
+
+
+@preserves_dtype
+def conv_forward_fft(x, w, b, conv_param):
+  """
+  Forward pass for a stride 1 convolutional layer computed in the frequency
+  domain.
+
+  Every (image, channel) plane and every filter is transformed once with a
+  real 2D FFT over the padded input size, the channel sum becomes a batched
+  complex matrix product per frequency, and one inverse FFT per (image,
+  filter) gives the output. The cost barely depends on the filter size, so
+  this pays off for large kernels.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  assert stride == 1, 'conv_forward_fft needs stride 1'
+
+  dtype = np.result_type(x.dtype, w.dtype)
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  out_h, out_w = Hp - HH + 1, Wp - WW + 1
+
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant')
+  x_freq = np.fft.rfft2(x_padded, s=(Hp, Wp))
+  w_freq = np.fft.rfft2(w, s=(Hp, Wp))
+  K = x_freq.shape[2] * x_freq.shape[3]
+
+  # Cross-correlation is a product with the conjugate filter spectrum; the
+  # padded size is large enough that the circular wrap-around never reaches
+  # the valid part of the output.
+  x_k = x_freq.reshape(N, C, K).transpose(2, 0, 1)
+  w_k = np.conj(w_freq).reshape(F, C, K).transpose(2, 1, 0)
+  out_freq = np.matmul(x_k, w_k).transpose(1, 2, 0).reshape(N, F, *x_freq.shape[2:])
+  out = np.fft.irfft2(out_freq, s=(Hp, Wp))[:, :, :out_h, :out_w]
+  out = (out + b.reshape(1, -1, 1, 1)).astype(dtype)
+
+  cache = (x, w, b, conv_param, x_freq, w_freq)
+  return out, cache
+
+
+@preserves_dtype
+def conv_backward_fft(dout, cache):
+  """
+  Backward pass matching conv_forward_fft, reusing the spectra of the padded
+  input and of the filters from the forward pass.
+  """
+  x, w, b, conv_param, x_freq, w_freq = cache
+  pad = conv_param['pad']
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  K = x_freq.shape[2] * x_freq.shape[3]
+  freq_shape = x_freq.shape[2:]
+
+  db = np.sum(dout, axis=(0, 2, 3))
+
+  dout_freq = np.fft.rfft2(dout, s=(Hp, Wp))
+  dout_k = dout_freq.reshape(N, F, K).transpose(2, 1, 0)
+
+  # dw correlates the padded input with dout
+  x_k = x_freq.reshape(N, C, K).transpose(2, 0, 1)
+  dw_freq = np.matmul(np.conj(dout_k), x_k).transpose(1, 2, 0).reshape(F, C, *freq_shape)
+  dw = np.fft.irfft2(dw_freq, s=(Hp, Wp))[:, :, :HH, :WW].astype(w.dtype)
+
+  # dx is the full convolution of dout with the filters
+  w_k = w_freq.reshape(F, C, K).transpose(2, 0, 1)
+  dx_freq = np.matmul(dout_k.transpose(0, 2, 1), w_k).transpose(1, 2, 0).reshape(N, C, *freq_shape)
+  dx_padded = np.fft.irfft2(dx_freq, s=(Hp, Wp))
+  dx = dx_padded[:, :, pad:pad + H, pad:pad + W].astype(x.dtype)
+
+  return dx, dw, db
+
+
+DEFAULT_TILE_BYTES = 64 * 1024 * 1024
+
+
+@preserves_dtype
+def conv_forward_nhwc(x, w, b, conv_param):
+  """
+  Forward pass for a convolutional layer on channels-last data.
+
+  The filters keep the usual (F, C, HH, WW) layout, so parameters can be
+  shared with the NCHW layers. With the channels innermost every row of the
+  column matrix is a contiguous (HH, WW, C) patch and the GEMM result is
+  already (N * out_h * out_w, F), which is exactly the NHWC output: unlike
+  conv_forward_strides there is no transpose and copy afterwards.
+
+  Inputs:
+  - x: Input data of shape (N, H, W, C)
+  - w, b, conv_param: As for conv_forward_naive
+
+  Returns a tuple of:
+  - out: Output data of shape (N, out_h, out_w, F)
+  - cache: (x, w, b, conv_param, x_cols)
+  """
+  N, H, W, C = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+  assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+
+  p = pad
+  x_padded = np.pad(x, ((0, 0), (p, p), (p, p), (0, 0)), mode='constant')
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  out_h = (Hp - HH) // stride + 1
+  out_w = (Wp - WW) // stride + 1
+
+  shape = (N, out_h, out_w, HH, WW, C)
+  strides = (Hp * Wp * C, stride * Wp * C, stride * C, Wp * C, C, 1)
+  strides = x_padded.itemsize * np.array(strides)
+  x_stride = np.lib.stride_tricks.as_strided(x_padded, shape=shape, strides=strides)
+  x_cols = np.ascontiguousarray(x_stride)
+  x_cols.shape = (N * out_h * out_w, HH * WW * C)
+
+  w_cols = w.transpose(0, 2, 3, 1).reshape(F, -1)
+  out = x_cols.dot(w_cols.T)
+  out += b
+  out.shape = (N, out_h, out_w, F)
+
+  cache = (x, w, b, conv_param, x_cols)
+  return out, cache
+
+
+@preserves_dtype
+def conv_backward_nhwc(dout, cache):
+  """
+  Backward pass for conv_forward_nhwc. dout has shape (N, out_h, out_w, F) and
+  is used as a (N * out_h * out_w, F) matrix directly; the column gradients
+  are folded back with one strided add per filter position.
+  """
+  x, w, b, conv_param, x_cols = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, H, W, C = x.shape
+  F, _, HH, WW = w.shape
+  _, out_h, out_w, _ = dout.shape
+
+  dout_rows = dout.reshape(-1, F)
+  db = np.sum(dout_rows, axis=0)
+  dw = dout_rows.T.dot(x_cols).reshape(F, HH, WW, C).transpose(0, 3, 1, 2)
+  dw = np.ascontiguousarray(dw)
+
+  w_cols = w.transpose(0, 2, 3, 1).reshape(F, -1)
+  dx_cols = dout_rows.dot(w_cols).reshape(N, out_h, out_w, HH, WW, C)
+  dx_padded = np.zeros((N, H + 2 * pad, W + 2 * pad, C), dtype=dx_cols.dtype)
+  for i in range(HH):
+    for j in range(WW):
+      dx_padded[:, i:i + stride * out_h:stride, j:j + stride * out_w:stride] += dx_cols[:, :, :, i, j]
+  dx = dx_padded[:, pad:pad + H, pad:pad + W]
 
   return dx, dw, db
 
 
+def conv_tile_size(x_shape, w_shape, conv_param, itemsize):
+  """
+  Number of images per micro-batch so that the column matrix of one
+  micro-batch fits in conv_param['tile_bytes'].
+  """
+  N, C, H, W = x_shape
+  F, _, HH, WW = w_shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  out_h = (H + 2 * pad - HH) // stride + 1
+  out_w = (W + 2 * pad - WW) // stride + 1
+  budget = conv_param.get('tile_bytes', DEFAULT_TILE_BYTES)
+  per_image = C * HH * WW * out_h * out_w * itemsize
+  return int(min(N, max(1, budget // per_image)))
+
+
+def conv_tile_cols(x, x_padded, x_cols, conv_param, HH, WW):
+  """
+  im2col of one micro-batch x into the preallocated buffers: x_padded keeps a
+  zero border, x_cols receives the (C * HH * WW, n * out_h * out_w) columns.
+  Returns the column matrix as a view of x_cols.
+  """
+  n, C, H, W = x.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  x_padded = x_padded[:n]
+  _, _, Hp, Wp = x_padded.shape
+  out_h = (Hp - HH) // stride + 1
+  out_w = (Wp - WW) // stride + 1
+
+  x_padded[:, :, pad:pad + H, pad:pad + W] = x
+  shape = (C, HH, WW, n, out_h, out_w)
+  strides = (Hp * Wp, Wp, 1, C * Hp * Wp, stride * Wp, stride)
+  strides = x_padded.itemsize * np.array(strides)
+  x_stride = np.lib.stride_tricks.as_strided(x_padded, shape=shape, strides=strides)
+
+  cols = x_cols[:C * HH * WW * n * out_h * out_w].reshape(shape)
+  cols[...] = x_stride
+  return cols.reshape(C * HH * WW, n * out_h * out_w)
+
+
+@preserves_dtype
+def conv_forward_tiled(x, w, b, conv_param):
+  """
+  conv_forward_strides over micro-batches of the input, so the column matrix
+  never holds more than conv_param['tile_bytes'] (default DEFAULT_TILE_BYTES)
+  whatever the batch size. Each micro-batch is written straight into the
+  preallocated output, and the columns are not kept in the cache;
+  conv_backward_tiled rebuilds them one micro-batch at a time. Peak memory is
+  therefore flat in N instead of growing with N * C * HH * WW.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+  assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+
+  dtype = np.result_type(x.dtype, w.dtype)
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  out_h = (Hp - HH) // stride + 1
+  out_w = (Wp - WW) // stride + 1
+  tile = conv_tile_size(x.shape, w.shape, conv_param, dtype.itemsize)
+
+  out = np.empty((N, F, out_h, out_w), dtype=dtype)
+  x_padded = np.zeros((tile, C, Hp, Wp), dtype=dtype)
+  x_cols = np.empty(C * HH * WW * tile * out_h * out_w, dtype=dtype)
+  res = np.empty(F * tile * out_h * out_w, dtype=dtype)
+  w_rows = w.reshape(F, -1)
+
+  for start in range(0, N, tile):
+    x_tile = x[start:start + tile]
+    n = x_tile.shape[0]
+    cols = conv_tile_cols(x_tile, x_padded, x_cols, conv_param, HH, WW)
+    res_tile = res[:F * n * out_h * out_w].reshape(F, n * out_h * out_w)
+    np.dot(w_rows, cols, out=res_tile)
+    out[start:start + n] = res_tile.reshape(F, n, out_h, out_w).transpose(1, 0, 2, 3)
+  out += b.reshape(1, -1, 1, 1)
+
+  cache = (x, w, b, conv_param)
+  return out, cache
+
+
+@preserves_dtype
+def conv_backward_tiled(dout, cache):
+  """
+  Backward pass matching conv_forward_tiled. The columns of every micro-batch
+  are rebuilt into the same bounded buffers, dw is accumulated over the
+  micro-batches and dx is written straight into the preallocated gradient.
+  """
+  x, w, b, conv_param = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  _, _, out_h, out_w = dout.shape
+
+  dtype = np.result_type(x.dtype, w.dtype)
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  tile = conv_tile_size(x.shape, w.shape, conv_param, dtype.itemsize)
+
+  db = np.sum(dout, axis=(0, 2, 3))
+  dw = np.zeros((F, C * HH * WW), dtype=dtype)
+  dx = np.empty(x.shape, dtype=dtype)
+  x_padded = np.zeros((tile, C, Hp, Wp), dtype=dtype)
+  x_cols = np.empty(C * HH * WW * tile * out_h * out_w, dtype=dtype)
+  dx_cols = np.empty(C * HH * WW * tile * out_h * out_w, dtype=dtype)
+  w_rows = w.reshape(F, -1)
+
+  for start in range(0, N, tile):
+    x_tile = x[start:start + tile]
+    n = x_tile.shape[0]
+    cols = conv_tile_cols(x_tile, x_padded, x_cols, conv_param, HH, WW)
+
+    dout_rows = dout[start:start + n].transpose(1, 0, 2, 3).reshape(F, -1)
+    dw += dout_rows.dot(cols.T)
+
+    dx_tile_cols = dx_cols[:C * HH * WW * n * out_h * out_w].reshape(C * HH * WW, -1)
+    np.dot(w_rows.T, dout_rows.astype(dtype, copy=False), out=dx_tile_cols)
+    dx_tile_cols = dx_tile_cols.reshape(C, HH, WW, n, out_h, out_w)
+    dx[start:start + n] = col2im_6d_cython_parallel(dx_tile_cols, n, C, H, W,
+                                                    HH, WW, pad, stride)
+
+  return dx, dw.reshape(w.shape), db
+
+
 conv_forward_fast = conv_forward_strides
 conv_backward_fast = conv_backward_strides
 
 
+@preserves_dtype
 def max_pool_forward_fast(x, pool_param):
   """
   A fast implementation of the forward pass for a max pooling layer.
 
-  This chooses between the reshape method and the im2col method. If the pooling
-  regions are square and tile the input image, then we can use the reshape
-  method which is very fast. Otherwise we fall back on the im2col method, which
-  is not much faster than the naive method.
+  This uses the strided window method, which handles any window size and
+  stride, including overlapping windows, and beats the reshape method even on
+  pools that tile the input, mostly because its backward pass is a single
+  scatter-add.
   """
-  N, C, H, W = x.shape
-  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
-  stride = pool_param['stride']
-
-  same_size = pool_height == pool_width == stride
-  tiles = H % pool_height == 0 and W % pool_width == 0
-  if same_size and tiles:
-    out, reshape_cache = max_pool_forward_reshape(x, pool_param)
-    cache = ('reshape', reshape_cache)
-  else:
-    out, im2col_cache = max_pool_forward_im2col(x, pool_param)
-    cache = ('im2col', im2col_cache)
+  out, strides_cache = max_pool_forward_strides(x, pool_param)
+  cache = ('strides', strides_cache)
   return out, cache
 
 
+@preserves_dtype
 def max_pool_backward_fast(dout, cache):
   """
   A fast implementation of the backward pass for a max pooling layer.
 
-  This switches between the reshape method an the im2col method depending on
-  which method was used to generate the cache.
+  This switches between the reshape, strided window and im2col methods depending
+  on which method was used to generate the cache.
   """
   method, real_cache = cache
   if method == 'reshape':
     return max_pool_backward_reshape(dout, real_cache)
+  elif method == 'strides':
+    return max_pool_backward_strides(dout, real_cache)
   elif method == 'im2col':
     return max_pool_backward_im2col(dout, real_cache)
   else:
     raise ValueError('Unrecognized method "%s"' % method)
 
 
+@preserves_dtype
+def max_pool_forward_inference(x, pool_param):
+  """
+  Forward pass for max pooling at inference time: the output of
+  max_pool_forward_fast without computing the argmax for a backward pass,
+  as a running maximum over the window positions of the strided view.
+
+  pool_param may also set 'layout' to 'NHWC' for channels-last data.
+
+  Returns:
+  - out: Output data of shape (N, C, out_h, out_w), or (N, out_h, out_w, C)
+  """
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  windows = _pool_windows(np.ascontiguousarray(x), pool_height, pool_width,
+                          pool_param['stride'], pool_param.get('layout', 'NCHW'))
+  out = windows[..., 0, 0].copy()
+  for k in range(1, pool_height * pool_width):
+    np.maximum(out, windows[..., k // pool_width, k % pool_width], out=out)
+  return out
+
+
+def _pool_windows(x, pool_height, pool_width, stride, layout='NCHW', writeable=False):
+  """
+  View of the pooling windows of x without copying anything.
+
+  Inputs:
+  - x: C-contiguous input data of shape (N, C, H, W), or (N, H, W, C) if
+    layout is 'NHWC'
+  - pool_height, pool_width, stride: Pooling geometry
+  - layout: 'NCHW' or 'NHWC'
+  - writeable: Whether the view may be written to, as when accumulating a
+    gradient into it
+
+  Returns:
+  - windows: View of shape (N, C, out_h, out_w, pool_height, pool_width), or
+    (N, out_h, out_w, C, pool_height, pool_width) for NHWC, so that
+    windows[..., i, j] has the shape and layout of the pooled output. Rows
+    and columns that do not fill a whole window are dropped, as in
+    max_pool_forward_naive.
+  """
+  if layout == 'NCHW':
+    N, C, H, W = x.shape
+    out_h = (H - pool_height) // stride + 1
+    out_w = (W - pool_width) // stride + 1
+    shape = (N, C, out_h, out_w, pool_height, pool_width)
+    strides = (C * H * W, H * W, stride * W, stride, W, 1)
+  elif layout == 'NHWC':
+    N, H, W, C = x.shape
+    out_h = (H - pool_height) // stride + 1
+    out_w = (W - pool_width) // stride + 1
+    shape = (N, out_h, out_w, C, pool_height, pool_width)
+    strides = (H * W * C, stride * W * C, stride * C, 1, W * C, C)
+  else:
+    raise ValueError('Unrecognized layout "%s"' % layout)
+  strides = x.itemsize * np.array(strides)
+  return np.lib.stride_tricks.as_strided(x, shape=shape, strides=strides,
+                                         writeable=writeable)
+
+
+@preserves_dtype
+def max_pool_forward_strides(x, pool_param):
+  """
+  Forward pass for max pooling with arbitrary, possibly overlapping windows.
+
+  The windows are an as_strided view of x. Rather than copying them out, we
+  sweep over the pool_height * pool_width positions inside a window; each
+  position is itself a strided view with the shape of the output, so every
+  step is one vectorized compare and update over the whole batch. Along the
+  way we track which position won, and turn that into the flat index into x
+  of each maximum, which is all the backward pass needs.
+
+  pool_param may also set 'layout' to 'NHWC' for channels-last data.
+
+  Returns a tuple of:
+  - out: Output data of shape (N, C, out_h, out_w), or (N, out_h, out_w, C)
+  - cache: (x_shape, argmax) where argmax holds the flat index into x of the
+    element each output was taken from. Ties go to the first element in
+    row-major order within the window.
+  """
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  layout = pool_param.get('layout', 'NCHW')
+  x = np.ascontiguousarray(x)
+  windows = _pool_windows(x, pool_height, pool_width, stride, layout)
+
+  # position[n, c, i, j] counts the window positions in row-major order and
+  # only grows, so max(position, better * k) records the latest strict winner
+  # without a masked copy
+  out = windows[..., 0, 0].copy()
+  position_type = np.min_scalar_type(pool_height * pool_width - 1)
+  position = np.zeros(out.shape, dtype=position_type)
+  better = np.empty(out.shape, dtype=bool)
+  scratch = np.empty(out.shape, dtype=position_type)
+  for k in range(1, pool_height * pool_width):
+    candidate = windows[..., k // pool_width, k % pool_width]
+    np.greater(candidate, out, out=better)
+    np.maximum(out, candidate, out=out)
+    np.multiply(better, position_type.type(k), out=scratch)
+    np.maximum(position, scratch, out=position)
+
+  # Flat index into x of every maximum: offset in the window plus window
+  # corner, both read off the element strides of the window view
+  steps = [s // x.itemsize for s in windows.strides]
+  offsets = (np.arange(pool_height).reshape(-1, 1) * steps[4]
+             + np.arange(pool_width) * steps[5]).ravel()
+  argmax = offsets.take(position)
+  for axis in range(4):
+    corner_shape = [1] * 4
+    corner_shape[axis] = out.shape[axis]
+    argmax += (np.arange(out.shape[axis]) * steps[axis]).reshape(corner_shape)
+
+  cache = (x.shape, argmax)
+  return out, cache
+
+
+@preserves_dtype
+def max_pool_backward_strides(dout, cache):
+  """
+  Backward pass for max_pool_forward_strides.
+
+  Every upstream gradient goes to the single input element it was pooled from,
+  so the whole pass is one scatter-add of dout into the flat argmax indices.
+  Overlapping windows that share a maximum add up correctly.
+  """
+  x_shape, argmax = cache
+  dx = np.bincount(argmax.ravel(), weights=dout.ravel(),
+                   minlength=int(np.prod(x_shape)))
+  return dx.reshape(x_shape).astype(dout.dtype, copy=False)
+
+
+@preserves_dtype
+def avg_pool_forward_fast(x, pool_param):
+  """
+  Forward pass for an average pooling layer.
+
+  Uses the same strided windows as max_pool_forward_strides, so any window
+  size and stride works. pool_param has the same keys as for max pooling,
+  including the optional 'layout'.
+
+  Returns a tuple of:
+  - out: Output data of shape (N, C, out_h, out_w), or (N, out_h, out_w, C)
+  - cache: (x_shape, pool_param)
+  """
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  layout = pool_param.get('layout', 'NCHW')
+  x = np.ascontiguousarray(x)
+  windows = _pool_windows(x, pool_height, pool_width, stride, layout)
+
+  out = windows[..., 0, 0].copy()
+  for i in range(pool_height):
+    for j in range(pool_width):
+      if i == 0 and j == 0:
+        continue
+      out += windows[..., i, j]
+  out /= pool_height * pool_width
+
+  cache = (x.shape, pool_param)
+  return out, cache
+
+
+@preserves_dtype
+def avg_pool_backward_fast(dout, cache):
+  """
+  Backward pass for avg_pool_forward_fast.
+
+  For a fixed position inside the window, the windows of different outputs
+  never share an input element, so each position is a single in-place add of
+  the scaled upstream gradient into a strided view of dx.
+  """
+  x_shape, pool_param = cache
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  layout = pool_param.get('layout', 'NCHW')
+
+  dx = np.zeros(x_shape, dtype=dout.dtype)
+  dx_windows = _pool_windows(dx, pool_height, pool_width, stride, layout, writeable=True)
+  dout_scaled = dout / (pool_height * pool_width)
+  for i in range(pool_height):
+    for j in range(pool_width):
+      dx_windows[..., i, j] += dout_scaled
+  return dx
+
+
+@preserves_dtype
 def max_pool_forward_reshape(x, pool_param):
   """
   A fast implementation of the forward pass for the max pooling layer that uses
@@ -183,6 +970,7 @@ def max_pool_forward_reshape(x, pool_param):
   return out, cache
 
 
+@preserves_dtype
 def max_pool_backward_reshape(dout, cache):
   """
   A fast implementation of the backward pass for the max pooling layer that
@@ -214,6 +1002,7 @@ def max_pool_backward_reshape(dout, cache):
   return dx
 
 
+@preserves_dtype
 def max_pool_forward_im2col(x, pool_param):
   """
   An implementation of the forward pass for max pooling based on im2col.
@@ -232,7 +1021,7 @@ def max_pool_forward_im2col(x, pool_param):
   out_width = (W - pool_width) // stride + 1
 
   x_split = x.reshape(N * C, 1, H, W)
-  x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+  x_cols = im2col_cython(x_split, pool_height, pool_width, 0, stride)
   x_cols_argmax = np.argmax(x_cols, axis=0)
   x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
   out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
@@ -241,6 +1030,7 @@ def max_pool_forward_im2col(x, pool_param):
   return out, cache
 
 
+@preserves_dtype
 def max_pool_backward_im2col(dout, cache):
   """
   An implementation of the backward pass for max pooling based on im2col.
@@ -256,8 +1046,7 @@ def max_pool_backward_im2col(dout, cache):
   dout_reshaped = dout.transpose(2, 3, 0, 1).flatten()
   dx_cols = np.zeros_like(x_cols)
   dx_cols[x_cols_argmax, np.arange(dx_cols.shape[1])] = dout_reshaped
-  dx = col2im_indices(dx_cols, (N * C, 1, H, W), pool_height, pool_width,
-              padding=0, stride=stride)
+  dx = col2im_cython(dx_cols, N * C, 1, H, W, pool_height, pool_width, 0, stride)
   dx = dx.reshape(x.shape)
 
   return dx
\ No newline at end of file
@@ -1,7 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 from .layer_utils import affine_relu_forward, affine_relu_backward,\
-    affine_bn_relu_forward, affine_bn_relu_backward
+    affine_bn_relu_forward, affine_bn_relu_backward, cache_nbytes
 from .layers import affine_forward, affine_backward, softmax_loss,\
     dropout_forward, dropout_backward
 
@@ -87,11 +89,15 @@ class FullyConnectedNet:
     will be
 
     (affine - [batch_norm] - relu - [dropout]) x (L - 1) - affine - softmax
+
+    After every training call of loss, peak_cache_bytes holds the largest
+    number of bytes that the layer caches and checkpointed layer inputs held at
+    once during it (see layer_utils.cache_nbytes), not counting the parameters.
     """
 
     def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                  dropout=0, use_batchnorm=False, reg=0.0,
-                 weight_scale=1e-2, dtype=np.float32, seed=None):
+                 weight_scale=1e-2, dtype=np.float32, seed=None, checkpoint_every=None):
         """
         Initialize a new FullyConnectedNet
 
@@ -110,7 +116,19 @@ class FullyConnectedNet:
                 for numeric gradient checking
             - seed: If not None, then pass this random seed to the dropout layers. This will
                 make the dropout layers deteriminstic so we can gradient check the model.
+            - checkpoint_every: If not None, the training forward pass keeps no layer
+                caches, only the input of every checkpoint_every-th hidden layer, and the
+                backward pass recomputes the forward pass of each such segment of layers
+                from its input before going back through it. This costs one more forward
+                pass of the hidden layers; peak memory falls from one cache per hidden
+                layer to about (L - 1) / checkpoint_every layer inputs plus the caches of
+                one segment, so around sqrt(L) is the usual choice. Gradients, batchnorm
+                running averages and dropout masks are the same as without it.
         """
+        if checkpoint_every is not None and checkpoint_every < 1:
+            raise ValueError('checkpoint_every must be positive, got {}'.format(checkpoint_every))
+        self.checkpoint_every = checkpoint_every
+        self.peak_cache_bytes = None
         self.use_batchnorm = use_batchnorm
         self.use_dropout = dropout > 0
         self.reg = reg
@@ -159,7 +177,7 @@ class FullyConnectedNet:
 
         Input / output: Same as TwolayerNet above.
         """
-        X = X.astype(self.dtype)
+        X = X.astype(self.dtype, copy=False)
         mode = 'test' if y is None else 'train'
 
         # Set train / test mode for batchnorm params and dropout param since they
@@ -173,29 +191,26 @@ class FullyConnectedNet:
 
         ###########################################################################################
         # The forward pass for the fully-conntected net
+        # With checkpointing only the inputs of the checkpointed layers are kept, along with
+        # the random state for the dropout masks; at test time no cache is needed at all.
+        checkpoint_every = self.checkpoint_every if mode == 'train' else None
         layer_input = X
-        ar_cache = {}
-        dp_cache = {}
-        
+        caches = {}
+        checkpoints = {}
+
         for lay in range(self.num_layers - 1):
-            if self.use_batchnorm:
-                layer_input, ar_cache[lay] = affine_bn_relu_forward(layer_input,
-                                                                    self.params['W{}'.format(lay+1)],
-                                                                    self.params['b{}'.format(lay+1)],
-                                                                    self.params['gamma{}'.format(lay+1)],
-                                                                    self.params['beta{}'.format(lay+1)],
-                                                                    self.bn_params[lay])
+            if mode == 'test':
+                layer_input, _ = self._hidden_forward(lay, layer_input)
+            elif checkpoint_every is None:
+                layer_input, caches[lay] = self._hidden_forward(lay, layer_input)
             else:
-                layer_input, ar_cache[lay] = affine_relu_forward(layer_input,
-                                                                 self.params['W{}'.format(lay+1)],
-                                                                 self.params['b{}'.format(lay+1)])
+                if lay % checkpoint_every == 0:
+                    checkpoints[lay] = (layer_input, np.random.get_state())
+                layer_input, _ = self._hidden_forward(lay, layer_input)
 
-            if self.use_dropout:
-                layer_input, dp_cache[lay] = dropout_forward(layer_input, self.dropout_param)
-
-        ar_out, ar_cache[self.num_layers] = affine_forward(layer_input,
-                                                           self.params['W{}'.format(self.num_layers)],
-                                                           self.params['b{}'.format(self.num_layers)])
+        ar_out, ar_cache = affine_forward(layer_input,
+                                          self.params['W{}'.format(self.num_layers)],
+                                          self.params['b{}'.format(self.num_layers)])
         scores = ar_out
 
         ###########################################################################################
@@ -211,27 +226,231 @@ class FullyConnectedNet:
         loss, dscores = softmax_loss(scores, y)
         dhout = dscores
         loss = loss + 0.5 * self.reg * np.sum(self.params[param_name]**2)
-        dx, dw, db = affine_backward(dhout, ar_cache[self.num_layers])
+        dx, dw, db = affine_backward(dhout, ar_cache)
         grads[param_name] = dw + self.reg * self.params[param_name]
         grads['b{}'.format(self.num_layers)] = db
 
         dhout = dx
+        params = self.params.values()
+        peak_cache_bytes = cache_nbytes(caches, checkpoints, ar_cache, exclude=params)
+        if checkpoint_every is not None:
+            random_state = np.random.get_state()
 
-        for idx in range(self.num_layers - 1):
-            lay = self.num_layers - 1 - idx -1
+        for lay in reversed(range(self.num_layers - 1)):
             loss = loss + 0.5 * self.reg * np.sum(self.params['W{}'.format(lay+1)]**2)
-            if self.use_dropout:
-                dhout = dropout_backward(dhout, dp_cache[lay])
-            if self.use_batchnorm:
-                dx, dw, db, dgamma, dbeta = affine_bn_relu_backward(dhout, ar_cache[lay])
-            else:
-                dx, dw, db = affine_relu_backward(dhout, ar_cache[lay])
-            grads['W{}'.format(lay+1)] = dw + self.reg * self.params['W{}'.format(lay+1)]
-            grads['b{}'.format(lay+1)] = db
-            if self.use_batchnorm:
-                grads['gamma{}'.format(lay+1)] = dgamma
-                grads['beta{}'.format(lay+1)] = dbeta
-
-            dhout = dx
+            if lay not in caches:
+                # First layer seen of a segment: recompute the segment from its checkpoint
+                # with the same dropout masks, keeping the running averages as they are
+                start = lay - lay % checkpoint_every
+                layer_input, state = checkpoints.pop(start)
+                np.random.set_state(state)
+                for seg_lay in range(start, lay + 1):
+                    layer_input, caches[seg_lay] = self._hidden_forward(seg_lay, layer_input, recompute=True)
+                peak_cache_bytes = max(peak_cache_bytes, cache_nbytes(caches, checkpoints, exclude=params))
+            dhout = self._hidden_backward(lay, dhout, caches.pop(lay), grads)
+
+        if checkpoint_every is not None:
+            np.random.set_state(random_state)
+        self.peak_cache_bytes = peak_cache_bytes
         ###########################################################################################
-        return loss, grads
\ No newline at end of file
+        return loss, grads
+
+    def _hidden_forward(self, lay, x, recompute=False):
+        """
+        Forward pass of hidden layer lay: affine - [batch_norm] - relu - [dropout].
+        A recompute does not update the batchnorm running averages.
+
+        Returns a tuple of:
+            - out: Output of the layer
+            - cache: Object to give to _hidden_backward
+        """
+        W, b = self.params['W{}'.format(lay+1)], self.params['b{}'.format(lay+1)]
+        if self.use_batchnorm:
+            bn_param = self.bn_params[lay]
+            if recompute:
+                bn_param = dict(bn_param)
+            out, ar_cache = affine_bn_relu_forward(x, W, b,
+                                                   self.params['gamma{}'.format(lay+1)],
+                                                   self.params['beta{}'.format(lay+1)],
+                                                   bn_param)
+        else:
+            out, ar_cache = affine_relu_forward(x, W, b)
+
+        dp_cache = None
+        if self.use_dropout:
+            out, dp_cache = dropout_forward(out, self.dropout_param)
+        return out, (ar_cache, dp_cache)
+
+    def _hidden_backward(self, lay, dout, cache, grads):
+        """
+        Backward pass of hidden layer lay. Stores the gradients of its
+        parameters in grads and returns the gradient with respect to its input.
+        """
+        ar_cache, dp_cache = cache
+        if self.use_dropout:
+            dout = dropout_backward(dout, dp_cache)
+        if self.use_batchnorm:
+            dx, dw, db, dgamma, dbeta = affine_bn_relu_backward(dout, ar_cache)
+            grads['gamma{}'.format(lay+1)] = dgamma
+            grads['beta{}'.format(lay+1)] = dbeta
+        else:
+            dx, dw, db = affine_relu_backward(dout, ar_cache)
+        grads['W{}'.format(lay+1)] = dw + self.reg * self.params['W{}'.format(lay+1)]
+        grads['b{}'.format(lay+1)] = db
+        return dx
+
+    def predict(self, X, batch_size=100, num_threads=1, return_scores=False):
+        """
+        Inference-only forward pass, with batchnorm and dropout in test mode.
+
+        Unlike loss(X), this builds no caches, leaves the layer parameter
+        dictionaries alone and never copies the whole of X. The chunks of
+        batch_size samples are dealt out to num_threads threads; every thread
+        reuses one set of activation buffers for all its chunks, and since
+        NumPy releases the GIL in the matrix products, the threads run in
+        parallel.
+
+        Inputs:
+            - X: Array of input data of shape (N, d_1, ..., d_k)
+            - batch_size: Number of samples per chunk
+            - num_threads: Number of threads
+            - return_scores: If True return the scores instead of the labels
+
+        Returns:
+            - y_pred: Array of shape (N,) of predicted labels, or the scores of
+                shape (N, C) if return_scores is True
+        """
+        layers = []
+        for lay in range(self.num_layers):
+            W, b = self.params['W{}'.format(lay+1)], self.params['b{}'.format(lay+1)]
+            scale = shift = None
+            if self.use_batchnorm and lay < self.num_layers - 1:
+                scale, shift = self._bn_scale_shift(lay)
+            layers.append((W, b, scale, shift))
+        return _predict_layers(X, layers, self.dtype, batch_size, num_threads, return_scores)
+
+    def _bn_scale_shift(self, lay):
+        """
+        Test-time batchnorm of hidden layer lay as out = x * scale + shift.
+        """
+        bn_param = self.bn_params[lay]
+        b = self.params['b{}'.format(lay+1)]
+        eps = bn_param.get('eps', 1e-5)
+        running_mean = bn_param.get('running_mean', np.zeros_like(b))
+        running_var = bn_param.get('running_var', np.zeros_like(b))
+        scale = self.params['gamma{}'.format(lay+1)] / np.sqrt(running_var + eps)
+        shift = self.params['beta{}'.format(lay+1)] - running_mean * scale
+        return scale, shift
+
+    def compile_for_inference(self):
+        """
+        Frozen copy of the network for test-time prediction, with every
+        batchnorm folded into the affine layer before it and dropout removed,
+        so each hidden layer is a single fused affine - relu.
+
+        Returns:
+            - model: An InferenceNet
+        """
+        weights, biases = [], []
+        for lay in range(self.num_layers):
+            W = self.params['W{}'.format(lay+1)].astype(np.float64)
+            b = self.params['b{}'.format(lay+1)].astype(np.float64)
+            if self.use_batchnorm and lay < self.num_layers - 1:
+                # bn(x.W + b) = x.(W * scale) + (b * scale + shift)
+                scale, shift = (v.astype(np.float64) for v in self._bn_scale_shift(lay))
+                W = W * scale
+                b = b * scale + shift
+            weights.append(W)
+            biases.append(b)
+        return InferenceNet(weights, biases, dtype=self.dtype)
+
+class InferenceNet:
+    """
+    Frozen, inference-only form of a FullyConnectedNet, as returned by its
+    compile_for_inference method:
+
+    (affine - relu) x (L - 1) - affine
+
+    The parameters in self.params are read-only. loss only supports the
+    test-time call loss(X), so the model works with Solver.check_accuracy but
+    cannot be trained.
+    """
+    def __init__(self, weights, biases, dtype=np.float32):
+        """
+        Inputs:
+            - weights: List of the L weight matrices
+            - biases: List of the L bias vectors
+            - dtype: A numpy datatype object for the parameters and scores
+        """
+        self.num_layers = len(weights)
+        self.dtype = dtype
+        self.params = {}
+        for lay, (W, b) in enumerate(zip(weights, biases)):
+            for name, value in (('W', W), ('b', b)):
+                value = np.array(value, dtype=dtype)
+                value.flags.writeable = False
+                self.params['{}{}'.format(name, lay+1)] = value
+
+    def loss(self, X, y=None):
+        """
+        Scores of X, of shape (N, C). Only the test-time call is supported.
+        """
+        if y is not None:
+            raise ValueError('An InferenceNet cannot be trained')
+        return self.predict(X, batch_size=max(1, X.shape[0]), return_scores=True)
+
+    def predict(self, X, batch_size=100, num_threads=1, return_scores=False):
+        """
+        Same as FullyConnectedNet.predict.
+        """
+        layers = [(self.params['W{}'.format(lay+1)], self.params['b{}'.format(lay+1)], None, None)
+                  for lay in range(self.num_layers)]
+        return _predict_layers(X, layers, self.dtype, batch_size, num_threads, return_scores)
+
+def _predict_layers(X, layers, dtype, batch_size, num_threads, return_scores):
+    """
+    Shared inference loop of FullyConnectedNet.predict and InferenceNet.predict.
+
+    Inputs:
+        - X: Array of input data of shape (N, d_1, ..., d_k)
+        - layers: List of tuples (W, b, scale, shift), one per affine layer. All
+            but the last are followed by x * scale + shift if scale is not None,
+            and by a ReLU.
+        - dtype, batch_size, num_threads, return_scores: As for predict
+    """
+    N = X.shape[0]
+    X = X.reshape(N, -1)
+    scores = np.empty((N, layers[-1][0].shape[1]), dtype=dtype)
+
+    def run(starts):
+        x_buffer = None
+        if X.dtype != dtype:
+            x_buffer = np.empty((batch_size, X.shape[1]), dtype=dtype)
+        buffers = [np.empty((batch_size, W.shape[1]), dtype=dtype) for W, _, _, _ in layers[:-1]]
+        for start in starts:
+            stop = min(start + batch_size, N)
+            h = X[start:stop]
+            if x_buffer is not None:
+                h = x_buffer[:stop - start]
+                np.copyto(h, X[start:stop], casting='unsafe')
+            for (W, b, scale, shift), buf in zip(layers, buffers + [None]):
+                out = scores[start:stop] if buf is None else buf[:stop - start]
+                np.dot(h, W, out=out)
+                out += b
+                if buf is not None:
+                    if scale is not None:
+                        out *= scale
+                        out += shift
+                    np.maximum(out, 0, out=out)
+                h = out
+
+    starts = range(0, N, batch_size)
+    if num_threads > 1:
+        with ThreadPoolExecutor(num_threads) as pool:
+            list(pool.map(run, [starts[k::num_threads] for k in range(num_threads)]))
+    else:
+        run(starts)
+
+    if return_scores:
+        return scores
+    return np.argmax(scores, axis=1)
@@ -0,0 +1,104 @@
+"""
+A FlatParams packs all the parameters of a model into one contiguous 1-D
+buffer, and their gradients into a second one of the same size. Every
+parameter is a named reshaped view into the buffer, so the model keeps using
+its params dictionary as before while an elementwise update rule from optim.py
+updates all of them with a single call:
+
+    flat = FlatParams(model.params)
+    model.params = flat.params
+    config = {'learning_rate': 1e-3, 'inplace': True}
+    for t in range(num_iterations):
+        loss, grads = model.loss(X_batch, y_batch)
+        flat.set_grads(grads)
+        optim.adam(flat.data, flat.grad, config)
+
+This replaces a Python loop over the parameters, with a handful of temporary
+arrays per parameter per step, by a handful of in-place operations over one
+buffer.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+class FlatParams:
+    """
+    Parameters and gradients of a model in two flat buffers.
+
+    Attributes:
+        - data: 1-D array holding every parameter
+        - grad: 1-D array of the same size holding every gradient
+        - params: OrderedDict mapping parameter names to views into data with
+            the original shapes
+        - grads: OrderedDict of the matching views into grad
+        - slices: OrderedDict mapping parameter names to their slice of data
+    """
+    def __init__(self, params, dtype=None):
+        """
+        Copy params into a new flat buffer.
+
+        Inputs:
+            - params: Dictionary mapping parameter names to arrays
+            - dtype: dtype of the buffers. Defaults to the dtype of the parameters,
+                which must then all agree.
+        """
+        if dtype is None:
+            dtypes = set(np.asarray(v).dtype for v in params.values())
+            if len(dtypes) > 1:
+                raise ValueError('Parameters have different dtypes {}; pass dtype explicitly'.format(
+                    ', '.join(sorted(d.name for d in dtypes))))
+            dtype = dtypes.pop() if dtypes else np.float64
+
+        self.slices = OrderedDict()
+        offset = 0
+        for name, value in params.items():
+            size = np.size(value)
+            self.slices[name] = slice(offset, offset + size)
+            offset += size
+
+        self.data = np.empty(offset, dtype=dtype)
+        self.grad = np.zeros(offset, dtype=dtype)
+        self.params = OrderedDict()
+        self.grads = OrderedDict()
+        for name, value in params.items():
+            shape = np.shape(value)
+            self.params[name] = self.data[self.slices[name]].reshape(shape)
+            self.grads[name] = self.grad[self.slices[name]].reshape(shape)
+            self.params[name][...] = value
+
+    def set_grads(self, grads):
+        """
+        Copy a dictionary of gradients, as returned by model.loss, into grad.
+        Every parameter must have a gradient.
+        """
+        if len(grads) != len(self.grads):
+            missing = set(self.grads) - set(grads)
+            extra = set(grads) - set(self.grads)
+            raise ValueError('Gradients do not match the parameters (missing: {}, unknown: {})'.format(
+                ', '.join(sorted(missing)) or '-', ', '.join(sorted(extra)) or '-'))
+        for name, view in self.grads.items():
+            np.copyto(view, grads[name], casting='same_kind')
+
+    def move_to(self, data):
+        """
+        Copy the parameters into data, a 1-D array of the same size and dtype,
+        e.g. one in shared memory, and make it the buffer behind params. The
+        params dictionary is updated in place, so a model holding it sees the
+        new views.
+        """
+        if data.shape != self.data.shape or data.dtype != self.data.dtype:
+            raise ValueError('Expected a buffer of shape {} and dtype {}, got {} and {}'.format(
+                self.data.shape, self.data.dtype, data.shape, data.dtype))
+        data[...] = self.data
+        self.data = data
+        for name, s in self.slices.items():
+            self.params[name] = data[s].reshape(self.params[name].shape)
+
+    def copy_params(self):
+        """
+        Independent copy of the parameters as a dictionary of arrays.
+        """
+        data = self.data.copy()
+        return OrderedDict((name, data[s].reshape(self.params[name].shape))
+                           for name, s in self.slices.items())
@@ -2,12 +2,15 @@ import numpy as np
 
 from .layers import affine_forward,\
     affine_backward, relu_forward, relu_backward,\
-    batchnorm_forward, batchnorm_backward_alt, conv_forward_naive,\
+    batchnorm_forward_fused, batchnorm_backward_fused, conv_forward_naive,\
     conv_backward_naive, max_pool_forward_naive
 
-from .fast_layers import conv_forward_fast, conv_backward_fast,\
-    max_pool_forward_fast, max_pool_backward_fast
+from .fast_layers import max_pool_forward_fast, max_pool_backward_fast,\
+    conv_backward_tiled, conv_tile_size, conv_tile_cols
+from .conv_backends import conv_forward_auto, conv_backward_auto
+from .dtype_policy import preserves_dtype
 
+@preserves_dtype
 def affine_relu_forward(x, w, b):
     """
     Convenience layer that perorms an affine transform followed by a ReLU
@@ -24,6 +27,7 @@ def affine_relu_forward(x, w, b):
     cache = (fc_cache, relu_cache)
     return out, cache
 
+@preserves_dtype
 def affine_relu_backward(dout, cache):
     """
     Backward pass for the affine-relu convenience layer
@@ -33,20 +37,23 @@ def affine_relu_backward(dout, cache):
     dx, dw, db = affine_backward(da, fc_cache)
     return dx, dw, db
 
+@preserves_dtype
 def affine_bn_relu_forward(x , w , b, gamma, beta, bn_param):
     a, fc_cache = affine_forward(x, w, b)
-    bn, bn_cache = batchnorm_forward(a, gamma, beta, bn_param)
+    bn, bn_cache = batchnorm_forward_fused(a, gamma, beta, bn_param)
     out, relu_cache = relu_forward(bn)
     cache = (fc_cache, bn_cache, relu_cache)
     return out, cache
 
+@preserves_dtype
 def affine_bn_relu_backward(dout, cache):
     fc_cache, bn_cache, relu_cache = cache
     dbn = relu_backward(dout, relu_cache)
-    da, dgamma, dbeta =  batchnorm_backward_alt(dbn, bn_cache)
+    da, dgamma, dbeta = batchnorm_backward_fused(dbn, bn_cache)
     dx, dw, db = affine_backward(da, fc_cache)
     return dx, dw, db, dgamma, dbeta
 
+@preserves_dtype
 def conv_relu_forward(x, w, b, conv_param):
     """
     A convenience layer taht performs a convolution followed by a ReLU
@@ -59,20 +66,22 @@ def conv_relu_forward(x, w, b, conv_param):
         - out: Output from the ReLU
         - cache: Object to give the backward pass
     """
-    a, conv_cache = conv_forward_fast(x, w, b, conv_param)
+    a, conv_cache = conv_forward_auto(x, w, b, conv_param)
     out, relu_cache = relu_forward(a)
     cache = (conv_cache, relu_cache)
     return out, cache
 
+@preserves_dtype
 def conv_relu_backward(dout, cache):
     """
     Backward pass for the conv-relu convenience layer.
     """
     conv_cache, relu_cache = cache
     da = relu_backward(dout, relu_cache)
-    dx, dw, db = conv_backward_fast(da, conv_cache)
+    dx, dw, db = conv_backward_auto(da, conv_cache)
     return dx, dw, db
 
+@preserves_dtype
 def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
     """
     Convenience layer that performs a convolution, a ReLU, and a pool.
@@ -86,12 +95,13 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
         - out: Output fro mthe pooling layer
         - cache: Object to give to the backward pass
     """
-    a, conv_cache = conv_forward_fast(x, w, b, conv_param)
+    a, conv_cache = conv_forward_auto(x, w, b, conv_param)
     s, relu_cache = relu_forward(a)
     out, pool_cache = max_pool_forward_fast(s, pool_param)
     cache = (conv_cache, relu_cache, pool_cache)
     return out, cache
 
+@preserves_dtype
 def conv_relu_pool_backward(dout, cache):
     """
     Backward pass for the conv-relu-pool convenience layer
@@ -99,5 +109,127 @@ def conv_relu_pool_backward(dout, cache):
     conv_cache, relu_cache, pool_cache = cache
     ds = max_pool_backward_fast(dout, pool_cache)
     da = relu_backward(ds, relu_cache)
-    dx, dw, db = conv_backward_fast(da, conv_cache)
-    return dx, dw, db
\ No newline at end of file
+    dx, dw, db = conv_backward_auto(da, conv_cache)
+    return dx, dw, db
+
+@preserves_dtype
+def conv_relu_pool_forward_fused(x, w, b, conv_param, pool_param):
+    """
+    Fused conv - relu - 2x2 max pool.
+
+    The convolution runs over micro-batches as in conv_forward_tiled (so
+    conv_param['tile_bytes'] applies), and ReLU and pooling are applied to
+    each GEMM output tile right away: ReLU commutes with max and the bias is
+    constant over a pooling window, so both are applied to the pooled values.
+    Only the pooled output and a uint8 index per pooled value are kept; the
+    index is the position of the max inside its 2x2 window (0-3), or 4 if
+    the ReLU zeroed it.
+
+    Unlike max_pool_backward_reshape, ties inside a window send the whole
+    gradient to the first maximum.
+
+    Inputs / outputs: Same as conv_relu_pool_forward; pool_param must describe
+    2x2 pooling with stride 2 and the conv output must have even height and width.
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    assert pool_param['pool_height'] == pool_param['pool_width'] == pool_param['stride'] == 2,\
+        'conv_relu_pool_forward_fused only supports 2x2 pooling with stride 2'
+
+    dtype = np.result_type(x.dtype, w.dtype)
+    Hp, Wp = H + 2 * pad, W + 2 * pad
+    out_h = (Hp - HH) // stride + 1
+    out_w = (Wp - WW) // stride + 1
+    assert out_h % 2 == 0 and out_w % 2 == 0, 'conv output does not tile into 2x2 pools'
+    pool_h, pool_w = out_h // 2, out_w // 2
+    tile = conv_tile_size(x.shape, w.shape, conv_param, dtype.itemsize)
+
+    out = np.empty((N, F, pool_h, pool_w), dtype=dtype)
+    index = np.empty((N, F, pool_h, pool_w), dtype=np.uint8)
+    x_padded = np.zeros((tile, C, Hp, Wp), dtype=dtype)
+    x_cols = np.empty(C * HH * WW * tile * out_h * out_w, dtype=dtype)
+    res = np.empty(F * tile * out_h * out_w, dtype=dtype)
+    w_rows = w.reshape(F, -1)
+
+    for start in range(0, N, tile):
+        x_tile = x[start:start + tile]
+        n = x_tile.shape[0]
+        cols = conv_tile_cols(x_tile, x_padded, x_cols, conv_param, HH, WW)
+        res_tile = res[:F * n * out_h * out_w].reshape(F, n * out_h * out_w)
+        np.dot(w_rows, cols, out=res_tile)
+
+        # (F, n, out_h, out_w) -> (n, F, pool_h, pool_w, 4) windows
+        windows = res_tile.reshape(F, n, pool_h, 2, pool_w, 2)
+        windows = windows.transpose(1, 0, 2, 4, 3, 5).reshape(n, F, pool_h, pool_w, 4)
+        idx = np.argmax(windows, axis=4)
+        pooled = np.take_along_axis(windows, idx[..., None], axis=4)[..., 0]
+        pooled += b.reshape(1, -1, 1, 1)
+
+        dead = pooled <= 0
+        pooled[dead] = 0
+        idx[dead] = 4
+        out[start:start + n] = pooled
+        index[start:start + n] = idx
+
+    cache = (x, w, b, conv_param, index)
+    return out, cache
+
+@preserves_dtype
+def conv_relu_pool_backward_fused(dout, cache):
+    """
+    Backward pass for the fused conv-relu-pool layer. The argmax index routes
+    dout to a single full-size conv gradient, which goes through
+    conv_backward_tiled.
+    """
+    x, w, b, conv_param, index = cache
+    N, F, pool_h, pool_w = dout.shape
+
+    da = np.zeros((N, F, pool_h, 2, pool_w, 2), dtype=dout.dtype)
+    for k in range(4):
+        da[:, :, :, k // 2, :, k % 2] = np.where(index == k, dout, 0)
+    da = da.reshape(N, F, 2 * pool_h, 2 * pool_w)
+
+    dx, dw, db = conv_backward_tiled(da, (x, w, b, conv_param))
+    return dx, dw, db
+
+def cache_nbytes(*objects, exclude=()):
+    """
+    Number of bytes of memory that layer caches keep alive.
+
+    Walks tuples, lists and dictionaries down to arrays and counts the whole
+    buffer behind every array once, however many views of it are reachable.
+    Other objects with an nbytes attribute, such as a ConvPlan, count for that
+    many bytes.
+
+    Inputs:
+        - objects: Caches, arrays or containers of them; None is skipped
+        - exclude: Arrays whose buffers are not counted, e.g. the parameters
+            of the model, which the caches of its affine layers refer to
+
+    Returns:
+        - nbytes: Integer number of bytes
+    """
+    def root(a):
+        while isinstance(a.base, np.ndarray):
+            a = a.base
+        return a
+
+    seen = {id(root(np.asarray(a))) for a in exclude}
+    nbytes = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if obj is None:
+            continue
+        if isinstance(obj, (tuple, list)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, np.ndarray) or hasattr(obj, 'nbytes'):
+            if isinstance(obj, np.ndarray):
+                obj = root(obj)
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                nbytes += int(obj.nbytes)
+    return nbytes
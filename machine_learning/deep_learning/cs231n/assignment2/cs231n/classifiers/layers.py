@@ -1,5 +1,8 @@
 import numpy as np
 
+from .dtype_policy import preserves_dtype
+
+@preserves_dtype
 def affine_forward(x, w, b):
     """
     Computes the forward pass for an affline (fully-connected) layer
@@ -28,6 +31,7 @@ def affine_forward(x, w, b):
     cache = (x, w, b)
     return out, cache
 
+@preserves_dtype
 def affine_backward(dout, cache):
     """
     Computes the backward pass for an affine layer
@@ -54,6 +58,7 @@ def affine_backward(dout, cache):
     db = np.sum(dout, axis=0)
     return dx, dw, db
 
+@preserves_dtype
 def relu_forward(x):
     """
     Computes the forward pass for a layer of rectified linear units(ReLUs)
@@ -69,6 +74,7 @@ def relu_forward(x):
     cache = x
     return out, cache
 
+@preserves_dtype
 def relu_backward(dout, cache): 
     """
     Computes the backward pass for a layer of rectified linear units (ReLUs)
@@ -85,6 +91,7 @@ def relu_backward(dout, cache):
 
     return dx
 
+@preserves_dtype
 def batchnorm_forward(x, gamma, beta, bn_param):
     """
     Forward pass for batch normalization
@@ -152,6 +159,7 @@ def batchnorm_forward(x, gamma, beta, bn_param):
 
     return out, cache
 
+@preserves_dtype
 def batchnorm_backward(dout, cache):
     """
     Backward pass for batch normalization.
@@ -190,6 +198,7 @@ def batchnorm_backward(dout, cache):
     dx = dx_10
     return dx, dgamma, dbeta
 
+@preserves_dtype
 def batchnorm_backward_alt(dout, cache):
     """
     Alternative backward pass for batch normalization.
@@ -215,14 +224,214 @@ def batchnorm_backward_alt(dout, cache):
     
     return dx, dgamma, dbeta
 
+@preserves_dtype
+def spatial_batchnorm_forward(x, gamma, beta, bn_param):
+    """
+    Forward pass for spatial batch normalization: every channel is normalized
+    over the batch and both spatial dimensions, by running batchnorm_forward
+    on a (N * H * W, C) view of the data.
+
+    Inputs:
+        - x: Input data of shape (N, C, H, W), or (N, H, W, C) if
+            bn_param['layout'] is 'NHWC'
+        - gamma: Scale parameter of shape (C,)
+        - beta: Shift parameter of shape (C,)
+        - bn_param: Dictionary with the same keys as for batchnorm_forward, plus
+            - layout: Optional, 'NCHW' (default) or 'NHWC'. Channels-last data
+              already is a (N * H * W, C) matrix, so nothing is transposed or
+              copied on the way in or out.
+
+    Returns a tuple of:
+        - out: Output data of the same shape as x
+        - cache: Values needed for the backward pass
+    """
+    layout = bn_param.get('layout', 'NCHW')
+    if layout == 'NHWC':
+        C = x.shape[3]
+        out, bn_cache = batchnorm_forward(x.reshape(-1, C), gamma, beta, bn_param)
+        out = out.reshape(x.shape)
+    elif layout == 'NCHW':
+        N, C, H, W = x.shape
+        x_rows = x.transpose(0, 2, 3, 1).reshape(-1, C)
+        out, bn_cache = batchnorm_forward(x_rows, gamma, beta, bn_param)
+        out = out.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+    else:
+        raise ValueError('Invalid spatial batchnorm layout {}'.format(layout))
+
+    cache = (layout, bn_cache)
+    return out, cache
+
+@preserves_dtype
+def spatial_batchnorm_backward(dout, cache):
+    """
+    Backward pass for spatial batch normalization.
+
+    Inputs:
+        - dout: Upstream derivatives, of the shape and layout of the forward output
+        - cache: Values from spatial_batchnorm_forward
+
+    Returns a tuple of:
+        - dx: Gradient with respect to inputs, of the same shape as dout
+        - dgamma: Gradient with respect to scale parameter, of shape (C,)
+        - dbeta: Gradient with respect to shift parameter, of shape (C,)
+    """
+    layout, bn_cache = cache
+    if layout == 'NHWC':
+        C = dout.shape[3]
+        dx, dgamma, dbeta = batchnorm_backward_alt(dout.reshape(-1, C), bn_cache)
+        dx = dx.reshape(dout.shape)
+    else:
+        N, C, H, W = dout.shape
+        dout_rows = dout.transpose(0, 2, 3, 1).reshape(-1, C)
+        dx, dgamma, dbeta = batchnorm_backward_alt(dout_rows, bn_cache)
+        dx = dx.reshape(N, H, W, C).transpose(0, 3, 1, 2)
+    return dx, dgamma, dbeta
+
+def _channel_sum_of_products(axes, ndim):
+    """
+    einsum subscripts summing the elementwise product of two arrays of ndim
+    dimensions over axes, leaving the one channel axis.
+    """
+    letters = 'abcd'[:ndim]
+    channel = [letter for axis, letter in enumerate(letters) if axis not in axes]
+    return '{0},{0}->{1}'.format(letters, channel[0])
+
+def _batchnorm_fused_forward(x, gamma, beta, bn_param, axes, param_shape):
+    """
+    Batch normalization of x over axes, with gamma and beta reshaped to
+    param_shape to broadcast against x. The centered data is computed once and
+    normalized in place into x_hat, the variance is a sum of products of it
+    with itself, and gamma * x_hat + beta is written into one output array, so
+    the training pass allocates two arrays of the size of x: x_hat and out.
+    """
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+
+    C = gamma.shape[0]
+    out, cache = None, None
+    running_mean = bn_param.get('running_mean', np.zeros(C, dtype=x.dtype))
+    running_var = bn_param.get('running_var', np.zeros(C, dtype=x.dtype))
+
+    if mode == 'train':
+        M = x.size // C
+        sample_mean = np.sum(x, axis=axes) / x.dtype.type(M)
+        x_hat = x - sample_mean.reshape(param_shape)
+        sample_var = np.einsum(_channel_sum_of_products(axes, x.ndim), x_hat, x_hat) / x.dtype.type(M)
+        inv_std = 1 / np.sqrt(sample_var + x.dtype.type(eps))
+        x_hat *= inv_std.reshape(param_shape)
+        out = x_hat * gamma.reshape(param_shape)
+        out += beta.reshape(param_shape)
+        cache = (x_hat, gamma, inv_std, axes, param_shape)
+        running_mean = momentum * running_mean + (1 - momentum) * sample_mean
+        running_var = momentum * running_var + (1 - momentum) * sample_var
+
+    elif mode == 'test':
+        scale = gamma / (np.sqrt(running_var + eps))
+        out = x * scale.reshape(param_shape)
+        out += (beta - running_mean * scale).reshape(param_shape)
+    else:
+        raise ValueError('Invalid forward batchnorm mode {}'.format(mode))
+
+    bn_param['running_mean'] = running_mean
+    bn_param['running_var'] = running_var
+
+    return out, cache
+
+def _batchnorm_fused_backward(dout, cache):
+    """
+    Backward pass of _batchnorm_fused_forward in the two-reduction form
+
+        dx = gamma * inv_std / M * (M * dout - sum(dout) - x_hat * sum(dout * x_hat))
+
+    where the two sums are dbeta and dgamma; dx is the only array of the size
+    of dout that is allocated.
+    """
+    x_hat, gamma, inv_std, axes, param_shape = cache
+    M = dout.size // gamma.shape[0]
+    dbeta = np.sum(dout, axis=axes)
+    dgamma = np.einsum(_channel_sum_of_products(axes, dout.ndim), dout, x_hat)
+
+    dx = x_hat * (dgamma / -M).reshape(param_shape)
+    dx += dout
+    dx -= (dbeta / M).reshape(param_shape)
+    dx *= (gamma * inv_std).reshape(param_shape)
+    return dx, dgamma, dbeta
+
+@preserves_dtype
+def batchnorm_forward_fused(x, gamma, beta, bn_param):
+    """
+    Forward pass for batch normalization with fewer passes over the data than
+    batchnorm_forward: the mean is a single (pairwise) sum, the variance a sum
+    of squares of the centered data without materializing the squares, and the
+    centered data is normalized in place. The running averages are updated the
+    same way.
+
+    Inputs / outputs: Same as batchnorm_forward, but the cache is only
+    understood by batchnorm_backward_fused.
+    """
+    return _batchnorm_fused_forward(x, gamma, beta, bn_param, (0,), (-1,))
+
+@preserves_dtype
+def batchnorm_backward_fused(dout, cache):
+    """
+    Backward pass for batchnorm_forward_fused, computing dbeta and dgamma as
+    the only two reductions and dx from them in a few in-place operations.
+
+    Inputs:
+        - dout: Upstream derivatives, of shape (N, D)
+        - cache: Cache from batchnorm_forward_fused
+
+    Returns a tuple of:
+        - dx: Gradient with respect to inputs x, of shape (N, D)
+        - dgamma: Gradient with respect to scale parameter gamma, of shape (D,)
+        - dbeta: Gradient with respect to shift parameter beta, of shape (D,)
+    """
+    return _batchnorm_fused_backward(dout, cache)
+
+@preserves_dtype
+def spatial_batchnorm_forward_fused(x, gamma, beta, bn_param):
+    """
+    Spatial batch normalization with the kernels of batchnorm_forward_fused.
+    Unlike spatial_batchnorm_forward, channels-first data is reduced over the
+    batch and spatial axes where it is, without a transposed copy on the way in
+    or out.
+
+    Inputs / outputs: Same as spatial_batchnorm_forward, but the cache is only
+    understood by spatial_batchnorm_backward_fused.
+    """
+    layout = bn_param.get('layout', 'NCHW')
+    if layout == 'NHWC':
+        return _batchnorm_fused_forward(x, gamma, beta, bn_param, (0, 1, 2), (-1,))
+    elif layout == 'NCHW':
+        return _batchnorm_fused_forward(x, gamma, beta, bn_param, (0, 2, 3), (-1, 1, 1))
+    raise ValueError('Invalid spatial batchnorm layout {}'.format(layout))
+
+@preserves_dtype
+def spatial_batchnorm_backward_fused(dout, cache):
+    """
+    Backward pass for spatial_batchnorm_forward_fused.
+
+    Inputs / outputs: Same as spatial_batchnorm_backward.
+    """
+    return _batchnorm_fused_backward(dout, cache)
+
+@preserves_dtype
 def dropout_forward(x, dropout_param):
     """
     Performs the forward pass for (inverted) dropout.
 
+    The mask is drawn as 16-bit random integers from an np.random.Generator,
+    which is several times faster than the float64 np.random.rand, and kept
+    in the cache packed to one bit per element with np.packbits. Without a
+    seed the Generator is seeded from np.random, so np.random.seed and
+    np.random.set_state still reproduce the masks.
+
     Inputs:
     - x: Input data, of any shape
     - dropout_param: A dictionary with the following keys:
-        - p: Dropout parameter. We drop each neuron output with probability p.
+        - p: Dropout parameter. We drop each neuron output with probability p,
+        rounded to a multiple of 2 ** -16.
         - mode: 'test' or 'train'. If the mode is train, then perform dropout;
         if the mode is test, then just return the input.
         - seed: Seed for the random number generator. Passing seed makes this
@@ -231,20 +440,24 @@ def dropout_forward(x, dropout_param):
 
     Outputs:
     - out: Array of the same shape as x.
-    - cache: A tuple (dropout_param, mask). In training mode, mask is the dropout
-        mask that was used to multiply the input; in test mode, mask is None.
+    - cache: A tuple (dropout_param, mask). In training mode, mask is the keep
+        mask packed into a uint8 array of x.size / 8 bytes; in test mode, mask
+        is None.
     """
     p, mode = dropout_param['p'], dropout_param['mode']
-    if 'seed' in dropout_param:
-        np.random.seed(dropout_param['seed'])
 
     mask = None
     out = None
 
     if mode == 'train':
-        mask = (np.random.rand(*x.shape) >= p) / (1 - p)
-        #mask = (np.random.rand(x.shape[1]) >= p) / (1 - p)
-        out = x * mask
+        if 'seed' in dropout_param:
+            rng = np.random.default_rng(dropout_param['seed'])
+        else:
+            rng = np.random.default_rng(np.random.randint(2**31 - 1))
+        keep = rng.integers(0, 1 << 16, size=x.shape, dtype=np.uint16) >= int(round(p * (1 << 16)))
+        out = x * keep
+        out *= x.dtype.type(1 / (1 - p))
+        mask = np.packbits(keep)
     elif mode == 'test':
         out = x
 
@@ -253,6 +466,7 @@ def dropout_forward(x, dropout_param):
 
     return out, cache
 
+@preserves_dtype
 def dropout_backward(dout, cache):
     """
     Perform the backward pass for (inverted) dropout.
@@ -266,11 +480,14 @@ def dropout_backward(dout, cache):
     
     dx = None
     if mode == 'train':
-        dx = dout * mask
+        keep = np.unpackbits(mask, count=dout.size).reshape(dout.shape).view(bool)
+        dx = dout * keep
+        dx *= dout.dtype.type(1 / (1 - dropout_param['p']))
     elif mode == 'test':
         dx = dout
     return dx
 
+@preserves_dtype
 def conv_forward_naive(x, w, b, conv_param):
     """
     A naive implementation of the forward pass for a convolutional layer
@@ -294,7 +511,6 @@ def conv_forward_naive(x, w, b, conv_param):
             - H' = 1 + (W + 2 * pad - WW) / stride
         - cache: (x, w, b, conv_param)
     """
-    import pdb;pdb.set_trace()
     N, C, H, W = x.shape
     F, _, HH, WW = w.shape
     stride, pad = conv_param['stride'], conv_param['pad']
@@ -302,7 +518,7 @@ def conv_forward_naive(x, w, b, conv_param):
     H_out = 1 + int((H + 2 * pad - HH) / stride)
     W_out = 1 + int((W + 2 * pad - WW) / stride)
 
-    out = np.zeros((N, F, H_out, W_out))
+    out = np.zeros((N, F, H_out, W_out), dtype=np.result_type(x, w))
     x_pad = np.pad(x, ((0,), (0,), (pad,), (pad,)), mode='constant', constant_values=0)
     for i in range(H_out):
         for j in range(W_out):
@@ -315,6 +531,7 @@ def conv_forward_naive(x, w, b, conv_param):
     cache = (x, w, b, conv_param)
     return out, cache
 
+@preserves_dtype
 def conv_backward_naive(dout, cache):
     """
     A naive implementation of the backward pass for a convolutional layer.
@@ -354,6 +571,7 @@ def conv_backward_naive(dout, cache):
 
     return dx, dw, db
 
+@preserves_dtype
 def max_pool_forward_naive(x, pool_param):
     """
     A naive implementation of the forward pass for a max pooling layer.
@@ -373,7 +591,7 @@ def max_pool_forward_naive(x, pool_param):
     HH, WW, stride = pool_param['pool_height'], pool_param['pool_width'], pool_param['stride']
     H_out = (H-HH)//stride+1
     W_out = (W-WW)//stride+1
-    out = np.zeros((N,C,H_out,W_out))
+    out = np.zeros((N,C,H_out,W_out), dtype=x.dtype)
     for i in range(H_out):
         for j in range(W_out):
             x_masked = x[:,:,i*stride : i*stride+HH, j*stride : j*stride+WW]
@@ -381,6 +599,7 @@ def max_pool_forward_naive(x, pool_param):
     cache = (x, pool_param)
     return out, cache
 
+@preserves_dtype
 def max_pool_backward_naive(dout, cache):
     """
     A naive implementation of the backward pass for a max pooling layer.
@@ -407,6 +626,7 @@ def max_pool_backward_naive(dout, cache):
             dx[:,:,i*stride : i*stride+HH, j*stride : j*stride+WW] += temp_binary_mask * (dout[:,:,i,j])[:,:,None,None]
     return dx
 
+@preserves_dtype
 def svm_loss(X, y):
     """
     Computes the loss and gradient using for multiclass SVM classification
@@ -432,6 +652,7 @@ def svm_loss(X, y):
     dx /= N
     return loss, dx
 
+@preserves_dtype
 def softmax_loss(X, y):
     """
     Computes the loss and gradient using for multiclass softmax classification
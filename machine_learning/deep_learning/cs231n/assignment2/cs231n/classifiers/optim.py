@@ -1,5 +1,3 @@
-import numpy as np
-
 """
 This file implements various first-order update rules that are commonly used for
 training neural networks. Each update rule accepts current weights and the
@@ -26,21 +24,64 @@ well; however the default values of the other hyperparameters should work well
 for a variety of different problems.
 
 For efficiency, update rules may perform in-place updates, mutating w and
-setting next_w equal to w.
+setting next_w equal to w. The rules below keep their state arrays in config
+and update them in place, with intermediate results in a work array kept in
+config['scratch']. w itself is left alone and next_w is a new array, unless
+config['inplace'] is true: then w is updated in place and returned, so a step
+allocates nothing after the first one. Only set it for a w the caller owns and
+can write to, not for a read-only array such as one loaded by
+checkpoint.load_checkpoint. Since the rules are elementwise they can also
+update every parameter of a model at once through the flat buffers of a
+FlatParams (see flat_params.py); Solver does so with config['inplace'] set.
+
+Update rules keep w, dw and their state arrays in the dtype of w. Hyperparameters
+are read as Python floats, because a numpy float64 scalar (say a learning rate
+drawn with np.random.uniform) would otherwise upcast float32 arrays to float64.
 """
+
+import numpy as np
+
+from .dtype_policy import preserves_dtype
+
+def _scratch(w, config):
+    """
+    Work array of the shape and dtype of w, kept in config between steps.
+    """
+    scratch = config.get('scratch')
+    if scratch is None or scratch.shape != w.shape or scratch.dtype != w.dtype:
+        scratch = np.empty_like(w)
+        config['scratch'] = scratch
+    return scratch
+
+def _add(w, step, config):
+    """
+    w + step, into w itself if config['inplace'] is true and into a new array
+    otherwise.
+    """
+    if config.get('inplace'):
+        w += step
+        return w
+    return w + step
+
+@preserves_dtype
 def sgd(w, dw, config=None):
     """
     Perform vanilla stochastic gradient descent
 
     config format:
       - learning_rate: Scalar learning rate
+      - scratch: Work array, created on first use
+      - inplace: If true, update w in place
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-2)
 
-    w -= config['learning_rate'] * dw
+    scratch = _scratch(w, config)
+    np.multiply(dw, -float(config['learning_rate']), out=scratch)
+    w = _add(w, scratch, config)
     return w, config
 
+@preserves_dtype
 def sgd_momentum(w, dw, config=None):
     """
     Performs stochastic gradient descent with momentum
@@ -51,20 +92,29 @@ def sgd_momentum(w, dw, config=None):
           Setting momentum = 0 reduces to sgd
       - velocity: A numpy array of the same shape as w and dw used to store a moving
           average of the gradients
+      - scratch: Work array, created on first use
+      - inplace: If true, update w in place
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-2)
     config.setdefault('momentum', 0.9)
-    v = config.get('velocity', np.zeros_like(w))
+    v = config.get('velocity')
+    if v is None:
+        v = np.zeros_like(w)
+    scratch = _scratch(w, config)
 
-    v = config['momentum'] * v - config['learning_rate'] * dw
+    # v = momentum * v - learning_rate * dw
+    v *= float(config['momentum'])
+    np.multiply(dw, float(config['learning_rate']), out=scratch)
+    v -= scratch
 
-    next_w = w + v
+    next_w = _add(w, v, config)
 
     config['velocity'] = v
 
     return next_w, config
 
+@preserves_dtype
 def rmsprop(x, dx, config=None):
     """
     Uses the RMSProp update rule, which uses a moving average of squared
@@ -76,18 +126,35 @@ def rmsprop(x, dx, config=None):
           squared gradient cache.
       - epsilon: Small scalar used for smoothing to avoid dividing by zero.
       - cache: Moving averatge of second moments of gradients.
+      - scratch: Work array, created on first use
+      - inplace: If true, update x in place
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-2)
     config.setdefault('decay_rate', 0.99)
     config.setdefault('epsilon', 1e-8)
-    config.setdefault('cache', np.zeros_like(x))
-
-    config['cache'] = config['decay_rate'] * config['cache'] + (1 - config['decay_rate']) * (dx**2)
-    next_x = x - config['learning_rate'] * dx / (np.sqrt(config['cache']) + config['epsilon'])
+    if config.get('cache') is None:
+        config['cache'] = np.zeros_like(x)
+    cache = config['cache']
+    scratch = _scratch(x, config)
+    decay_rate = float(config['decay_rate'])
+
+    # cache = decay_rate * cache + (1 - decay_rate) * dx**2
+    cache *= decay_rate
+    np.multiply(dx, dx, out=scratch)
+    scratch *= 1 - decay_rate
+    cache += scratch
+
+    # x -= learning_rate * dx / (sqrt(cache) + epsilon)
+    np.sqrt(cache, out=scratch)
+    scratch += float(config['epsilon'])
+    np.divide(dx, scratch, out=scratch)
+    scratch *= -float(config['learning_rate'])
+    next_x = _add(x, scratch, config)
 
     return next_x, config
 
+@preserves_dtype
 def adam(x, dx, config=None):
     """
     Uses the Adam update rule, which incorporates moving averages of both
@@ -101,21 +168,43 @@ def adam(x, dx, config=None):
         - m: Moving average of gradient.
         - v: Moving average of squared gradient.
         - t: Iteration number.
+        - scratch: Work array, created on first use
+        - inplace: If true, update x in place
     """
     if config is None: config = {}
     config.setdefault('learning_rate', 1e-3)
     config.setdefault('beta1', 0.9)
     config.setdefault('beta2', 0.999)
     config.setdefault('epsilon', 1e-8)
-    config.setdefault('m', np.zeros_like(x))
-    config.setdefault('v', np.zeros_like(x))
+    if config.get('m') is None:
+        config['m'] = np.zeros_like(x)
+    if config.get('v') is None:
+        config['v'] = np.zeros_like(x)
     config.setdefault('t', 0)
+    m, v = config['m'], config['v']
+    scratch = _scratch(x, config)
 
+    beta1, beta2 = float(config['beta1']), float(config['beta2'])
     config['t'] += 1
-    config['m'] = config['beta1'] * config['m'] + (1 - config['beta1']) * dx
-    config['v'] = config['beta2'] * config['v'] + (1 - config['beta2']) * (dx**2)
-    mb = config['m'] / (1 - config['beta1']**config['t'])
-    vb = config['v'] / (1 - config['beta2']**config['t'])
-    next_x = x - config['learning_rate'] * mb / (np.sqrt(vb) + config['epsilon'])
 
-    return next_x, config
\ No newline at end of file
+    # m = beta1 * m + (1 - beta1) * dx
+    m *= beta1
+    np.multiply(dx, 1 - beta1, out=scratch)
+    m += scratch
+
+    # v = beta2 * v + (1 - beta2) * dx**2
+    v *= beta2
+    np.multiply(dx, dx, out=scratch)
+    scratch *= 1 - beta2
+    v += scratch
+
+    # x -= learning_rate * mb / (sqrt(vb) + epsilon) with the bias corrected
+    # mb = m / (1 - beta1**t) and vb = v / (1 - beta2**t)
+    np.divide(v, 1 - beta2**config['t'], out=scratch)
+    np.sqrt(scratch, out=scratch)
+    scratch += float(config['epsilon'])
+    np.divide(m, scratch, out=scratch)
+    scratch *= -float(config['learning_rate']) / (1 - beta1**config['t'])
+    next_x = _add(x, scratch, config)
+
+    return next_x, config
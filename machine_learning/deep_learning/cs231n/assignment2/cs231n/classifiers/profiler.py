@@ -0,0 +1,337 @@
+"""
+Opt-in per-op profiling of the layer library and the Solver.
+
+While a Profiler is started, every layer, loss and update rule decorated with
+preserves_dtype (see dtype_policy.py) is recorded as an event with its wall
+time and, with memory=True, the bytes it left allocated and its peak
+allocation, both measured with tracemalloc. Composite layers such as
+affine_bn_relu_forward are recorded along with the layers they call, and each
+event carries its self time, which excludes the time of the events nested in
+it. A Solver given a Profiler also records its own steps: fetching the batch,
+model.loss and the parameter update, and the number of images per second of
+every iteration.
+
+Example usage:
+
+    profiler = Profiler()
+    solver = Solver(model, data, profiler=profiler, ...)
+    solver.train()
+    print(profiler.summary())
+    profiler.write_chrome_trace('trace.json')
+
+or, for a model on its own:
+
+    with Profiler() as profiler:
+        with profiler.iteration(X.shape[0]):
+            model.loss(X, y)
+
+The Chrome trace opens in chrome://tracing or https://ui.perfetto.dev.
+
+Only the calling process is profiled, so nothing is recorded from the workers
+of a data-parallel Solver. Times of ops running on several threads at once, as
+in a threaded predict, are recorded per thread, but tracemalloc counts the
+allocations of all threads together. tracemalloc slows every allocation down;
+use memory=False for timings closer to an unprofiled run.
+"""
+
+import csv
+import json
+import os
+import threading
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter
+
+import numpy as np
+
+from . import dtype_policy
+from . import optim
+
+# Columns of the CSV trace, in order
+_EVENT_FIELDS = ('name', 'category', 'iteration', 'thread', 'depth', 'start', 'duration',
+                 'self_time', 'bytes', 'peak_bytes')
+
+
+def _category(name):
+    """
+    Category of a decorated function from its name.
+    """
+    if 'backward' in name:
+        return 'backward'
+    if name in vars(optim):
+        return 'update'
+    if name.endswith('_loss'):
+        return 'loss'
+    return 'forward'
+
+
+class Profiler:
+    """
+    Recorder of per-op events and per-iteration throughput.
+
+    Attributes:
+        - events: List of one dictionary per recorded call, with keys
+            'name', 'category' ('forward', 'backward', 'loss', 'update' or that
+            of an explicit span), 'iteration' (index of the enclosing
+            iteration, or None), 'thread', 'depth' (nesting level on its
+            thread), 'start' and 'duration' in seconds from the start of the
+            profile, 'self_time', and 'bytes' and 'peak_bytes' (None without
+            memory tracking)
+        - iterations: List of one dictionary per iteration with keys
+            'iteration', 'start', 'duration', 'num_images' and 'images_per_sec'
+    """
+    def __init__(self, memory=True):
+        """
+        Inputs:
+            - memory: Whether to record allocations with tracemalloc
+        """
+        self.memory = memory
+        self.events = []
+        self.iterations = []
+        self._local = threading.local()
+        self._t0 = None
+        self._enabled = False
+        self._started_tracemalloc = False
+        self._previous_hook = None
+        self._iteration = None
+        self._num_images = 0
+
+    def start(self):
+        """
+        Start recording. Returns False if the profiler was already started.
+        """
+        if self._enabled:
+            return False
+        if self._t0 is None:
+            self._t0 = perf_counter()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._previous_hook = dtype_policy.set_call_hook(self.span)
+        self._enabled = True
+        return True
+
+    def stop(self):
+        """
+        Stop recording. The recorded events are kept, and start continues the
+        same profile.
+        """
+        if not self._enabled:
+            return
+        dtype_policy.set_call_hook(self._previous_hook)
+        self._previous_hook = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        self._enabled = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _stack(self):
+        """
+        Stack of open spans of the calling thread. Every entry is a list
+        [time of the nested spans, highest traced memory seen].
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name, category=None):
+        """
+        Context manager recording the code it wraps as one event.
+
+        Inputs:
+            - name: Name of the event
+            - category: Category of the event; by default derived from name as
+                for the layers
+        """
+        if not self._enabled:
+            yield
+            return
+        stack = self._stack()
+        frame = [0.0, 0]
+        if self.memory:
+            # tracemalloc has a single peak, so every span resets it and hands
+            # the peak seen so far on to the span it is nested in
+            start_bytes, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            frame[1] = start_bytes
+        stack.append(frame)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            end = perf_counter()
+            stack.pop()
+            duration = end - start
+            event = {
+                'name': name,
+                'category': category or _category(name),
+                'iteration': self._iteration,
+                'thread': threading.get_ident(),
+                'depth': len(stack),
+                'start': start - self._t0,
+                'duration': duration,
+                'self_time': duration - frame[0],
+                'bytes': None,
+                'peak_bytes': None,
+            }
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(frame[1], peak)
+                event['bytes'] = current - start_bytes
+                event['peak_bytes'] = peak - start_bytes
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], peak)
+            if stack:
+                stack[-1][0] += duration
+            self.events.append(event)
+
+    @contextmanager
+    def iteration(self, num_images=0):
+        """
+        Context manager marking one training iteration. Events recorded in it
+        carry its index; add_images counts further images into it.
+        """
+        if not self._enabled:
+            yield
+            return
+        self._iteration = len(self.iterations)
+        self._num_images = num_images
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            duration = perf_counter() - start
+            self.iterations.append({
+                'iteration': self._iteration,
+                'start': start - self._t0,
+                'duration': duration,
+                'num_images': self._num_images,
+                'images_per_sec': self._num_images / duration if duration > 0 else 0.0,
+            })
+            self._iteration = None
+
+    def add_images(self, num_images):
+        """
+        Count num_images more images into the current iteration.
+        """
+        self._num_images += num_images
+
+    def op_stats(self):
+        """
+        Statistics per op, in decreasing order of self time.
+
+        Returns:
+            - stats: List of dictionaries with keys 'name', 'category', 'calls',
+                'total_time', 'self_time', 'mean_time', 'bytes' (mean bytes left
+                allocated per call) and 'peak_bytes' (highest peak of a call)
+        """
+        stats = OrderedDict()
+        for event in self.events:
+            key = (event['name'], event['category'])
+            entry = stats.get(key)
+            if entry is None:
+                entry = stats[key] = {'name': event['name'], 'category': event['category'],
+                                      'calls': 0, 'total_time': 0.0, 'self_time': 0.0,
+                                      'bytes': 0, 'peak_bytes': None}
+            entry['calls'] += 1
+            entry['total_time'] += event['duration']
+            entry['self_time'] += event['self_time']
+            if event['bytes'] is not None:
+                entry['bytes'] += event['bytes']
+                entry['peak_bytes'] = max(entry['peak_bytes'] or 0, event['peak_bytes'])
+        stats = list(stats.values())
+        for entry in stats:
+            entry['mean_time'] = entry['total_time'] / entry['calls']
+            entry['bytes'] = entry['bytes'] / entry['calls'] if self.memory else None
+        stats.sort(key=lambda entry: entry['self_time'], reverse=True)
+        return stats
+
+    def summary(self, top=20):
+        """
+        Table of the top ops by self time, the time per category and the
+        throughput of the iterations, as a string.
+        """
+        stats = self.op_stats()
+        total = sum(entry['self_time'] for entry in stats) or 1.0
+        lines = ['{:<36} {:<9} {:>6} {:>10} {:>10} {:>6} {:>9} {:>9} {:>9}'.format(
+            'op', 'category', 'calls', 'total ms', 'self ms', 'self%', 'mean ms', 'alloc MB', 'peak MB')]
+        for entry in stats[:top]:
+            if self.memory:
+                memory = '{:>9.2f} {:>9.2f}'.format(entry['bytes'] / 2.0 ** 20, entry['peak_bytes'] / 2.0 ** 20)
+            else:
+                memory = '{:>9} {:>9}'.format('-', '-')
+            lines.append('{:<36} {:<9} {:>6} {:>10.2f} {:>10.2f} {:>6.1f} {:>9.3f} {}'.format(
+                entry['name'][:36], entry['category'], entry['calls'], entry['total_time'] * 1e3,
+                entry['self_time'] * 1e3, 100 * entry['self_time'] / total, entry['mean_time'] * 1e3,
+                memory))
+
+        categories = OrderedDict()
+        for entry in stats:
+            categories[entry['category']] = categories.get(entry['category'], 0.0) + entry['self_time']
+        lines.append('Self time by category: ' + ', '.join(
+            '{} {:.1f}%'.format(category, 100 * t / total) for category, t in categories.items()))
+
+        if self.iterations:
+            rates = np.array([it['images_per_sec'] for it in self.iterations])
+            durations = np.array([it['duration'] for it in self.iterations])
+            lines.append('{} iterations: {:.2f} ms per iteration, images/sec mean {:.1f}, '
+                         'median {:.1f}, min {:.1f}, max {:.1f}'.format(
+                             len(self.iterations), durations.mean() * 1e3, rates.mean(),
+                             np.median(rates), rates.min(), rates.max()))
+        return '\n'.join(lines)
+
+    def write_csv(self, path):
+        """
+        Write the events as CSV, one row per event.
+        """
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=_EVENT_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.events)
+
+    def write_json(self, path):
+        """
+        Write the events, the iterations and the per-op statistics as JSON.
+        """
+        with open(path, 'w') as f:
+            json.dump({'events': self.events, 'iterations': self.iterations,
+                       'ops': self.op_stats()}, f)
+
+    def write_chrome_trace(self, path):
+        """
+        Write the events and the iterations in the Chrome trace event format,
+        with the images per second as a counter track.
+        """
+        pid = os.getpid()
+        trace = []
+        for event in self.events:
+            trace.append({
+                'name': event['name'], 'cat': event['category'], 'ph': 'X', 'pid': pid,
+                'tid': event['thread'], 'ts': event['start'] * 1e6, 'dur': event['duration'] * 1e6,
+                'args': {'iteration': event['iteration'], 'bytes': event['bytes'],
+                         'peak_bytes': event['peak_bytes']},
+            })
+        for it in self.iterations:
+            trace.append({
+                'name': 'iteration {}'.format(it['iteration']), 'cat': 'iteration', 'ph': 'X',
+                'pid': pid, 'tid': 'iterations', 'ts': it['start'] * 1e6, 'dur': it['duration'] * 1e6,
+                'args': {'num_images': it['num_images'], 'images_per_sec': it['images_per_sec']},
+            })
+            trace.append({
+                'name': 'images/sec', 'ph': 'C', 'pid': pid, 'ts': it['start'] * 1e6,
+                'args': {'images/sec': it['images_per_sec']},
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,216 @@
+"""
+Post-training int8 quantization of a FullyConnectedNet for inference.
+
+quantize_fc_net folds batchnorm into the affine layers (see
+FullyConnectedNet.compile_for_inference) and runs the float network on a
+calibration sample, usually part of X_val, to find the range of the input of
+every affine layer. The result is a QuantizedNet in which
+
+- every weight matrix is int8, with one scale per output unit (column)
+- every layer input is int8, with one scale per layer from the calibration
+- every bias is int32 at the scale of the products it is added to
+- x.W + b is accumulated in int32, and the ReLU of a hidden layer is folded
+  into requantizing its output to the int8 input of the next layer
+
+so the stored model is about 4x smaller than float32 and 8x smaller than
+float64, and the activations passed between layers are int8.
+
+NumPy has no integer matrix product kernels; its int32 matmul is a plain loop,
+hundreds of times slower than BLAS. The int8 products are instead summed by
+float32 BLAS over chunks of at most _CHUNK inputs, for which every partial sum
+is an integer of magnitude below 2**24 and therefore exact, and the chunks are
+added in int32. Each chunk of weights is converted to float32 just before its
+product, so no float32 copy of a whole weight matrix is kept; the conversions
+cost about a tenth of the products at the default batch_size of predict, and
+less for larger ones.
+
+Example usage:
+
+    qmodel = quantize_fc_net(model, X_val[:1000])
+    y_pred = qmodel.predict(X_test)
+    print(qmodel.nbytes, 'bytes instead of', sum(v.nbytes for v in model.params.values()))
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+_QMAX = 127
+# Largest number of int8 x int8 products whose sum is exact in float32:
+# _CHUNK * 127 * 127 < 2**24
+_CHUNK = 1024
+
+
+def _quantize(x, scale, low=-_QMAX):
+    """
+    round(x / scale) clipped to [low, 127] as int8.
+    """
+    q = np.rint(x / scale)
+    np.clip(q, low, _QMAX, out=q)
+    return q.astype(np.int8)
+
+
+def _int_matmul(a, W, out):
+    """
+    Exact a.W into the int32 array out, for int8 arrays a of shape (N, K) and
+    W of shape (K, M).
+    """
+    out[...] = 0
+    for k in range(0, a.shape[1], _CHUNK):
+        product = np.dot(a[:, k:k + _CHUNK].astype(np.float32), W[k:k + _CHUNK].astype(np.float32))
+        np.add(out, product, out=out, casting='unsafe')
+    return out
+
+
+def calibrate_ranges(weights, biases, X, percentile=100.0, batch_size=100):
+    """
+    Range of the input of every affine layer of the float network
+    (affine - relu) x (L - 1) - affine on X.
+
+    Inputs:
+        - weights, biases: Lists of the L weight matrices and bias vectors
+        - X: Calibration data of shape (N, d_1, ..., d_k)
+        - percentile: Percentile of the absolute values taken as the range.
+            The default of 100 takes the maximum; lower values such as 99.99
+            clip rare outliers for a finer scale
+        - batch_size: Number of samples per forward pass
+
+    Returns:
+        - ranges: List of L positive floats
+    """
+    N = X.shape[0]
+    X = X.reshape(N, -1)
+    inputs = [[] for _ in weights]
+    for start in range(0, N, batch_size):
+        h = X[start:start + batch_size].astype(np.float64)
+        for lay, (W, b) in enumerate(zip(weights, biases)):
+            inputs[lay].append(np.abs(h).ravel())
+            if lay < len(weights) - 1:
+                h = np.maximum(h.dot(W) + b, 0)
+    ranges = []
+    for values in inputs:
+        r = np.percentile(np.concatenate(values), percentile)
+        ranges.append(float(r) if r > 0 else 1.0)
+    return ranges
+
+
+def quantize_fc_net(model, X_calib, percentile=100.0, batch_size=100):
+    """
+    int8 post-training quantization of a trained FullyConnectedNet.
+
+    Inputs:
+        - model: A FullyConnectedNet
+        - X_calib: Calibration data, e.g. a few hundred to a few thousand
+            samples of X_val
+        - percentile, batch_size: As for calibrate_ranges
+
+    Returns:
+        - qmodel: A QuantizedNet
+    """
+    compiled = model.compile_for_inference()
+    weights = [compiled.params['W{}'.format(lay+1)].astype(np.float64) for lay in range(compiled.num_layers)]
+    biases = [compiled.params['b{}'.format(lay+1)].astype(np.float64) for lay in range(compiled.num_layers)]
+    ranges = calibrate_ranges(weights, biases, X_calib, percentile, batch_size)
+    input_scales = [r / _QMAX for r in ranges]
+
+    qweights, weight_scales, qbiases = [], [], []
+    for W, b, input_scale in zip(weights, biases, input_scales):
+        weight_scale = np.abs(W).max(axis=0) / _QMAX
+        weight_scale[weight_scale == 0] = 1.0
+        qweights.append(_quantize(W, weight_scale))
+        weight_scales.append(weight_scale)
+        qbiases.append(np.rint(b / (input_scale * weight_scale)).astype(np.int32))
+    return QuantizedNet(qweights, weight_scales, qbiases, input_scales, dtype=model.dtype)
+
+
+class QuantizedNet:
+    """
+    int8 form of a FullyConnectedNet, as returned by quantize_fc_net:
+
+    (affine - relu) x (L - 1) - affine
+
+    Like an InferenceNet it only supports the test-time call loss(X), so it
+    works with Solver.check_accuracy but cannot be trained.
+
+    Attributes:
+        - params: Dictionary holding, for every layer i, the int8 weights
+            'W{i}', the int32 bias 'b{i}', the float64 per-unit weight scales
+            'w_scale{i}' and the input scale 'x_scale{i}'
+        - nbytes: Size of params in bytes
+    """
+    def __init__(self, weights, weight_scales, biases, input_scales, dtype=np.float32):
+        """
+        Inputs:
+            - weights: List of the L int8 weight matrices
+            - weight_scales: List of the L vectors of scales of their columns
+            - biases: List of the L int32 bias vectors
+            - input_scales: List of the L scales of the layer inputs
+            - dtype: A numpy datatype object for the scores
+        """
+        self.num_layers = len(weights)
+        self.dtype = dtype
+        self.params = {}
+        for lay in range(self.num_layers):
+            for name, value, value_dtype in (('W', weights[lay], np.int8), ('b', biases[lay], np.int32),
+                                             ('w_scale', weight_scales[lay], np.float64),
+                                             ('x_scale', input_scales[lay], np.float64)):
+                value = np.array(value, dtype=value_dtype)
+                value.flags.writeable = False
+                self.params['{}{}'.format(name, lay+1)] = value
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes for v in self.params.values())
+
+    def loss(self, X, y=None):
+        """
+        Scores of X, of shape (N, C). Only the test-time call is supported.
+        """
+        if y is not None:
+            raise ValueError('A QuantizedNet cannot be trained')
+        return self.predict(X, batch_size=max(1, X.shape[0]), return_scores=True)
+
+    def predict(self, X, batch_size=100, num_threads=1, return_scores=False):
+        """
+        Same as FullyConnectedNet.predict.
+        """
+        layers = []
+        for lay in range(self.num_layers):
+            # Scale of the int32 accumulator, and for a hidden layer the factor
+            # that requantizes it to the input scale of the next layer
+            acc_scale = self.params['x_scale{}'.format(lay+1)] * self.params['w_scale{}'.format(lay+1)]
+            if lay < self.num_layers - 1:
+                acc_scale = acc_scale / self.params['x_scale{}'.format(lay+2)]
+            layers.append((self.params['W{}'.format(lay+1)], self.params['b{}'.format(lay+1)], acc_scale))
+        x_scale = float(self.params['x_scale1'])
+
+        N = X.shape[0]
+        X = X.reshape(N, -1)
+        scores = np.empty((N, layers[-1][0].shape[1]), dtype=self.dtype)
+
+        def run(starts):
+            accs = [np.empty((batch_size, W.shape[1]), dtype=np.int32) for W, _, _ in layers]
+            buffers = [np.empty((batch_size, W.shape[1]), dtype=np.int8) for W, _, _ in layers[:-1]]
+            for start in starts:
+                stop = min(start + batch_size, N)
+                h = _quantize(X[start:stop], x_scale)
+                for (W, b, scale), acc, buf in zip(layers, accs, buffers + [None]):
+                    acc = _int_matmul(h, W, acc[:stop - start])
+                    acc += b
+                    if buf is None:
+                        np.multiply(acc, scale, out=scores[start:stop], casting='unsafe')
+                    else:
+                        # Clipping at 0 is the ReLU
+                        h = buf[:stop - start]
+                        h[...] = _quantize(acc, 1.0 / scale, low=0)
+
+        starts = range(0, N, batch_size)
+        if num_threads > 1:
+            with ThreadPoolExecutor(num_threads) as pool:
+                list(pool.map(run, [starts[k::num_threads] for k in range(num_threads)]))
+        else:
+            run(starts)
+
+        if return_scores:
+            return scores
+        return np.argmax(scores, axis=1)
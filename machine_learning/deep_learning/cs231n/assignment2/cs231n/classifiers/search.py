@@ -0,0 +1,307 @@
+"""
+Hyperparameter search with successive halving and Hyperband.
+
+A HyperparameterSearch trains many Solver configurations in a pool of worker
+processes. The data arrays are copied once into shared memory, which every
+worker maps instead of holding its own copy.
+
+Successive halving starts all configurations with a small number of epochs,
+keeps the best 1 / eta of them by validation accuracy, trains the survivors
+eta times as long, and so on until max_epochs. A surviving configuration
+continues from where its previous round stopped, with its optimizer state,
+rather than starting over. Hyperband runs several such brackets that trade
+the number of configurations against the epochs they start with, for when it
+is not clear how early weak configurations can be told apart.
+
+Example usage:
+
+    def build(config):
+        model = FullyConnectedNet([100, 100], weight_scale=config['weight_scale'])
+        return model, {'update_rule': 'adam', 'batch_size': 100,
+                       'optim_config': {'learning_rate': config['learning_rate']}}
+
+    configs = [{'learning_rate': 10 ** np.random.uniform(-5, -2),
+                'weight_scale': 10 ** np.random.uniform(-3, -1)} for _ in range(27)]
+    with HyperparameterSearch(build, data, num_processes=4) as search:
+        result = search.successive_halving(configs, min_epochs=1, max_epochs=9)
+    print(result.summary())
+
+build must be picklable, i.e. a module-level function, when the pool does not
+fork.
+"""
+
+import math
+import multiprocessing
+from time import time
+
+import numpy as np
+
+from .data_parallel import _shared_array
+from .solver import Solver
+
+# State of a pool worker, set by _init_worker
+_worker = {}
+
+
+def _init_worker(build, specs):
+    shms, data = [], {}
+    for key, (name, shape, dtype) in specs.items():
+        shm, data[key] = _shared_array(shape, dtype, name)
+        shms.append(shm)
+    _worker.update(build=build, data=data, shms=shms)
+
+
+def _run_trial(task):
+    """
+    Train one configuration for a number of epochs in a pool worker, starting
+    from the state returned by its previous round, if any.
+
+    Returns a tuple (trial_id, state, seconds).
+    """
+    trial_id, config, state, num_epochs, seed = task
+    t0 = time()
+    np.random.seed(seed)
+    model, solver_kwargs = _worker['build'](config)
+    solver_kwargs = dict(solver_kwargs, num_epochs=num_epochs, verbose=False, num_workers=0)
+    if state is not None:
+        model.params = state['params']
+        # Batchnorm running averages continue too
+        if state['bn_params'] is not None:
+            model.bn_params = state['bn_params']
+    solver = Solver(model, _worker['data'], **solver_kwargs)
+    if state is not None:
+        for key in ('epoch', 'best_val_acc', 'best_train_acc', 'best_params', 'loss_history',
+                    'train_acc_history', 'val_acc_history'):
+            setattr(solver, key, state[key])
+        if solver.flat is not None:
+            solver.flat_config = state['optim_config']
+        else:
+            solver.optim_configs = state['optim_config']
+    # Without flat_params the update rule replaces the entries of this
+    # dictionary, which train() swaps out for the best parameters at the end
+    last_params = solver.model.params
+    solver.train()
+
+    # Continue the next round from the last iterate, not from the best
+    # parameters that train() put into the model
+    if solver.flat is not None:
+        params = solver.flat.copy_params()
+        optim_config = solver.flat_config
+        optim_config.pop('scratch', None)
+    else:
+        params = {k: v.copy() for k, v in last_params.items()}
+        optim_config = solver.optim_configs
+        for config in optim_config.values():
+            config.pop('scratch', None)
+    state = {
+        'params': params,
+        'optim_config': optim_config,
+        'bn_params': getattr(solver.model, 'bn_params', None),
+        'epoch': solver.epoch,
+        'best_val_acc': solver.best_val_acc,
+        'best_train_acc': solver.best_train_acc,
+        'best_params': solver.best_params,
+        'loss_history': solver.loss_history,
+        'train_acc_history': solver.train_acc_history,
+        'val_acc_history': solver.val_acc_history,
+    }
+    return trial_id, state, time() - t0
+
+
+class SearchResult:
+    """
+    Outcome of a search.
+
+    Attributes:
+        - best_config: Configuration with the highest validation accuracy among
+            those trained for max_epochs
+        - best_params: Parameters of best_config with that accuracy
+        - best_val_acc: That validation accuracy
+        - leaderboard: List of one dictionary per configuration with keys
+            'trial', 'config', 'epochs', 'val_acc', 'train_acc' and 'seconds',
+            sorted by epochs reached and then by validation accuracy, best first
+        - elapsed: Wall-clock seconds of the search
+        - epochs_trained: Epochs trained over all configurations
+        - exhaustive_epochs: Epochs needed to train every configuration for
+            max_epochs
+        - exhaustive_estimate: Estimated wall-clock seconds of that exhaustive
+            sweep on the same pool, from the measured seconds per epoch
+    """
+    def __init__(self, leaderboard, states, elapsed, exhaustive_epochs, num_processes):
+        self.leaderboard = leaderboard
+        best = leaderboard[0]
+        self.best_config = best['config']
+        self.best_val_acc = best['val_acc']
+        self.best_params = states[best['trial']]['best_params']
+        self.elapsed = elapsed
+        self.epochs_trained = sum(entry['epochs'] for entry in leaderboard)
+        self.exhaustive_epochs = exhaustive_epochs
+        seconds_per_epoch = sum(entry['seconds'] for entry in leaderboard) / self.epochs_trained
+        self.exhaustive_estimate = seconds_per_epoch * exhaustive_epochs / num_processes
+
+    def summary(self, top=10):
+        """
+        Leaderboard of the top configurations and the time saved, as a string.
+        """
+        lines = ['{:>5} {:>6} {:>8} {:>9}  {}'.format('trial', 'epochs', 'val_acc', 'train_acc', 'config')]
+        for entry in self.leaderboard[:top]:
+            lines.append('{trial:>5} {epochs:>6} {val_acc:>8.3f} {train_acc:>9.3f}  {config}'.format(**entry))
+        lines.append('{} of {} epochs trained in {:.1f}s; exhaustive sweep estimated at {:.1f}s ({:.1f}x)'.format(
+            self.epochs_trained, self.exhaustive_epochs, self.elapsed, self.exhaustive_estimate,
+            self.exhaustive_estimate / self.elapsed))
+        return '\n'.join(lines)
+
+
+class HyperparameterSearch:
+    """
+    Pool of worker processes training Solver configurations on shared data.
+    """
+    def __init__(self, build, data, num_processes=None, seed=None, verbose=True):
+        """
+        Copy the data into shared memory and start the pool.
+
+        Inputs:
+            - build: Function build(config) returning a tuple (model, solver_kwargs)
+                for a configuration. num_epochs, verbose and num_workers in
+                solver_kwargs are set by the search.
+            - data: Dictionary of data arrays as taken by Solver
+            - num_processes: Number of worker processes, default the number of cores
+            - seed: Seed of the workers' np.random for every round of every
+                configuration. Defaults to a seed drawn from np.random.
+            - verbose: Whether to print progress after every round
+        """
+        if num_processes is None:
+            num_processes = multiprocessing.cpu_count()
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+        self.num_processes = num_processes
+        self.seed = seed
+        self.verbose = verbose
+        self._num_trials = 0
+        self._configs = {}
+
+        self._shms = []
+        specs = {}
+        for key, value in data.items():
+            shm, array = _shared_array(value.shape, value.dtype)
+            array[...] = value
+            self._shms.append(shm)
+            specs[key] = (shm.name, value.shape, value.dtype)
+        self._pool = multiprocessing.Pool(num_processes, initializer=_init_worker,
+                                          initargs=(build, specs))
+
+    def _train(self, trials, states, num_epochs, seconds):
+        """
+        Continue training every trial for num_epochs more epochs in the pool.
+        """
+        tasks = [(trial_id, config, states.get(trial_id), num_epochs,
+                  [self.seed, trial_id, states[trial_id]['epoch'] if trial_id in states else 0])
+                 for trial_id, config in trials]
+        for trial_id, state, elapsed in self._pool.imap_unordered(_run_trial, tasks):
+            states[trial_id] = state
+            seconds[trial_id] = seconds.get(trial_id, 0.0) + elapsed
+
+    def successive_halving(self, configs, min_epochs=1, max_epochs=9, eta=3):
+        """
+        Search over a list of configurations with successive halving.
+
+        Inputs:
+            - configs: List of configurations, passed to build
+            - min_epochs: Epochs every configuration is trained for first
+            - max_epochs: Epochs the last survivors are trained for
+            - eta: Only the best 1 / eta configurations of a round are trained
+                further, for eta times as many epochs in total
+
+        Returns:
+            - result: A SearchResult
+        """
+        t0 = time()
+        states, seconds = {}, {}
+        self._halving(configs, min_epochs, max_epochs, eta, states, seconds)
+        return self._result(states, seconds, time() - t0, len(configs) * max_epochs)
+
+    def hyperband(self, sample_config, max_epochs=27, eta=3, min_epochs=1):
+        """
+        Search with Hyperband: successive halving brackets from many
+        configurations starting at min_epochs down to a few trained for
+        max_epochs from the start.
+
+        Inputs:
+            - sample_config: Function returning a new random configuration
+            - max_epochs, eta, min_epochs: As for successive_halving
+
+        Returns:
+            - result: A SearchResult over the configurations of all brackets
+        """
+        t0 = time()
+        states, seconds = {}, {}
+        num_configs = 0
+        s_max = int(math.floor(math.log(max_epochs / min_epochs, eta) + 1e-9))
+        for s in range(s_max, -1, -1):
+            n = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+            start_epochs = max(min_epochs, int(round(max_epochs / eta ** s)))
+            configs = [sample_config() for _ in range(n)]
+            num_configs += n
+            if self.verbose:
+                print('Hyperband bracket s={}: {} configurations from {} epochs'.format(
+                    s, n, start_epochs))
+            self._halving(configs, start_epochs, max_epochs, eta, states, seconds)
+        return self._result(states, seconds, time() - t0, num_configs * max_epochs)
+
+    def _halving(self, configs, min_epochs, max_epochs, eta, states, seconds):
+        if not 1 <= min_epochs <= max_epochs:
+            raise ValueError('Need 1 <= min_epochs <= max_epochs, got {} and {}'.format(
+                min_epochs, max_epochs))
+        if eta < 2:
+            raise ValueError('eta must be at least 2, got {}'.format(eta))
+        trials = [(self._num_trials + i, config) for i, config in enumerate(configs)]
+        self._num_trials += len(configs)
+        self._configs.update(trials)
+
+        trained, num_epochs = 0, min_epochs
+        while True:
+            self._train(trials, states, num_epochs - trained, seconds)
+            trained = num_epochs
+            if self.verbose:
+                best = max(states[trial_id]['best_val_acc'] for trial_id, _ in trials)
+                print('  {} configurations at {} epochs, best val_acc {:.3f}'.format(
+                    len(trials), num_epochs, best))
+            if num_epochs >= max_epochs or len(trials) == 1:
+                break
+            trials.sort(key=lambda trial: states[trial[0]]['best_val_acc'], reverse=True)
+            trials = trials[:max(1, len(trials) // eta)]
+            num_epochs = min(num_epochs * eta, max_epochs)
+
+    def _result(self, states, seconds, elapsed, exhaustive_epochs):
+        leaderboard = []
+        for trial_id, state in states.items():
+            leaderboard.append({
+                'trial': trial_id,
+                'config': self._configs[trial_id],
+                'epochs': state['epoch'],
+                'val_acc': state['best_val_acc'],
+                'train_acc': state['best_train_acc'],
+                'seconds': seconds[trial_id],
+            })
+        leaderboard.sort(key=lambda entry: (entry['epochs'], entry['val_acc']), reverse=True)
+        return SearchResult(leaderboard, states, elapsed, exhaustive_epochs, self.num_processes)
+
+    def close(self):
+        """
+        Stop the pool and free the shared memory.
+        """
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,6 +1,14 @@
+from collections import OrderedDict
+from contextlib import nullcontext
+
 import numpy as np
 
+from . import checkpoint
 from . import optim
+from .flat_params import FlatParams
+from .batch_loader import BatchLoader
+from .data_parallel import DataParallel
+from .async_validation import AsyncValidator
 
 class Solver:
     """
@@ -68,6 +76,10 @@ class Solver:
         - loss: Scalar giving the loss
         - grads: Dictionary with the same keys as self.params mapping parameter
         names to gradients of the loss with respect to those parameters.
+
+    - model.predict(X, batch_size, num_threads) is optional. If present it must
+        return the predicted labels of X, of shape (N,), and check_accuracy uses
+        it instead of model.loss(X).
     """
     def __init__(self, model, data, **kwargs):
         """
@@ -91,12 +103,43 @@ class Solver:
         - lr_decay: A scalar for learning rate decay; after each epoch the learning
         rate is multiplied by this value.
         - batch_size: Size of minibatches used to compute loss and gradient during
-        training.
+        training. Every epoch visits the training set once in a new random order;
+        the last minibatch of an epoch holds the remainder if batch_size does not
+        divide the number of training samples.
+        - num_prefetch: Number of minibatches gathered ahead of time on a
+        background thread (see batch_loader.py), default 2. 0 gathers every
+        minibatch on the training thread.
+        - augment: Optional function augment(X_batch, rng) applied in place to every
+        training minibatch, e.g. an augmentation.BatchAugmenter. It runs on the
+        prefetch thread along with the gather.
         - num_epochs: The number of epochs to run for during training.
+        - num_eval_threads: Number of threads check_accuracy scores with, if the
+        model has a predict method (see FullyConnectedNet.predict). Default is 1.
         - print_every: Integer; training losses will be printed every print_every
         iterations.
         - verbose: Boolean; if set to false then no output will be printed during
         training.
+        - flat_params: Boolean; if true (the default) the model parameters are
+        packed into a FlatParams and the update rule is applied once per step to
+        the whole flat buffer instead of once per parameter. model.params then
+        holds views into that buffer. This needs an elementwise update rule, which
+        all of optim.py are; set it to false for anything else.
+        - num_workers: Integer; if positive, every minibatch is split over this
+        many worker processes that compute the loss and gradients of their shard
+        (see data_parallel.py). Needs flat_params. Default is 0, which computes
+        them in this process.
+        - async_validation: Boolean; if true, the accuracy checks run on parameter
+        snapshots in a side process (see async_validation.py) while training
+        continues, and their results are recorded as they arrive. Needs
+        flat_params. Default is false.
+        - profiler: Optional profiler.Profiler. train() starts it if it is not
+        running yet and stops it at the end. Every iteration is recorded with its
+        images per second, and its steps and layer calls as events.
+        - checkpoint_path: Optional file; if given, train() writes a checkpoint
+        (see save_checkpoint) to it every checkpoint_period epochs. The arrays are
+        copied into reused staging buffers and the file is written on a
+        background thread while training goes on.
+        - checkpoint_period: Number of epochs between checkpoints, default 1.
         """
         self.model = model
         self.X_train = data['X_train']
@@ -110,15 +153,31 @@ class Solver:
         self.lr_decay = kwargs.pop('lr_decay', 0.82)
         self.batch_size = kwargs.pop('batch_size', 100)
         self.num_epochs = kwargs.pop('num_epochs', 10)
+        self.num_prefetch = kwargs.pop('num_prefetch', 2)
+        self.augment = kwargs.pop('augment', None)
+        self.num_eval_threads = kwargs.pop('num_eval_threads', 1)
 
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.flat_params = kwargs.pop('flat_params', True)
+        self.num_workers = kwargs.pop('num_workers', 0)
+        self.async_validation = kwargs.pop('async_validation', False)
+        self.profiler = kwargs.pop('profiler', None)
+        self.checkpoint_path = kwargs.pop('checkpoint_path', None)
+        self.checkpoint_period = kwargs.pop('checkpoint_period', 1)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
             extra = ','.join(["%s" % k for k in kwargs.keys()])
             raise ValueError("Unrecognized arguments {}".format(extra))
 
+        if self.num_workers > 0 and not self.flat_params:
+            raise ValueError('num_workers > 0 needs flat_params')
+        if self.async_validation and not self.flat_params:
+            raise ValueError('async_validation needs flat_params')
+        if self.checkpoint_period < 1:
+            raise ValueError('checkpoint_period must be positive, got {}'.format(self.checkpoint_period))
+
         # Make sure the update rule exists, then replace the string name with the actual function
         if not hasattr(optim, self.update_rule):
             raise ValueError('Invalid update rule {}'.format(update_rule))
@@ -139,31 +198,78 @@ class Solver:
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
-
+        # Buffer behind best_params with flat_params, and the number of epochs
+        # left to the next train() after resume_from
+        self._best_data = None
+        self._remaining_epochs = None
+
+        self.loader = None
+        self.parallel = None
+        self.validator = None
+        self.checkpoint_writer = None
+        self.flat = None
+        self.flat_config = None
         self.optim_configs = {}
-        for p in self.model.params:
-            d = {k: v for k, v in self.optim_config.items()}
-            self.optim_configs[p] = d
+        if self.flat_params:
+            self._flatten_params()
+            self.flat_config = {k: v for k, v in self.optim_config.items()}
+            # The flat buffer belongs to this Solver, so the update rule can
+            # write into it
+            self.flat_config['inplace'] = True
+        else:
+            for p in self.model.params:
+                d = {k: v for k, v in self.optim_config.items()}
+                self.optim_configs[p] = d
+
+    def _flatten_params(self):
+        """
+        Pack the model parameters into a FlatParams, unless model.params already
+        are its views.
+        """
+        if self.flat is None or self.model.params is not self.flat.params:
+            self.flat = FlatParams(self.model.params)
+            self.model.params = self.flat.params
+
+    def _span(self, name, category):
+        """
+        Context manager recording the code it wraps in the profiler, if any.
+        """
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.span(name, category)
 
     def _step(self):
         """
         Make a single gradient update. This is called by train() and should not
         be called manually.
         """
-        num_train = self.X_train.shape[0]
-        batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
-
-        loss, grads = self.model.loss(X_batch, y_batch)
+        with self._span('next_batch', 'data'):
+            X_batch, y_batch = self.loader.next_batch()
+        if self.profiler is not None:
+            self.profiler.add_images(X_batch.shape[0])
+
+        with self._span('model.loss', 'step'):
+            if self.parallel is not None:
+                loss = self.parallel.loss(X_batch, y_batch)
+            else:
+                loss, grads = self.model.loss(X_batch, y_batch)
         self.loss_history.append(loss)
 
-        for p, w in self.model.params.items():
-            dw = grads[p]
-            config = self.optim_configs[p]
-            next_w, next_config = self.update_rule(w, dw, config)
-            self.model.params[p] = next_w
-            self.optim_config[p] = next_config
+        with self._span('parameter_update', 'step'):
+            if self.flat is not None:
+                if self.parallel is None:
+                    self.flat.set_grads(grads)
+                next_w, self.flat_config = self.update_rule(self.flat.data, self.flat.grad, self.flat_config)
+                if next_w is not self.flat.data:
+                    self.flat.data[...] = next_w
+                return
+
+            for p, w in self.model.params.items():
+                dw = grads[p]
+                config = self.optim_configs[p]
+                next_w, next_config = self.update_rule(w, dw, config)
+                self.model.params[p] = next_w
+                self.optim_configs[p] = next_config
 
     def check_accuracy(self, X, y, num_samples=None, batch_size=100):
         """
@@ -181,6 +287,10 @@ class Solver:
         - acc: Scalar giving the fraction of instances that were correctly
         classified by the model.
         """
+        with self._span('check_accuracy', 'eval'):
+            return self._check_accuracy(X, y, num_samples, batch_size)
+
+    def _check_accuracy(self, X, y, num_samples, batch_size):
         N = X.shape[0]
         if num_samples is not None and N > num_samples:
             mask = np.random.choice(N, num_samples)
@@ -188,6 +298,11 @@ class Solver:
             X = X[mask]
             y = y[mask]
 
+        # Models with an inference-only path batch and thread it themselves
+        if hasattr(self.model, 'predict'):
+            y_pred = self.model.predict(X, batch_size=batch_size, num_threads=self.num_eval_threads)
+            return np.mean(y_pred == y)
+
         # Compute predictions in batches
         num_batches = int(N / batch_size)
         if N % batch_size != 0:
@@ -205,47 +320,262 @@ class Solver:
 
         return acc
 
+    def _record_accuracy(self, epoch, train_acc, val_acc):
+        """
+        Record the accuracies checked at the given epoch. Returns whether
+        val_acc is the best so far.
+        """
+        self.train_acc_history.append(train_acc)
+        self.val_acc_history.append(val_acc)
+
+        if self.verbose:
+            print("(Epoch {} / {}) train acc: {}, val_acc: {}".format(epoch, self.num_epochs, train_acc, val_acc))
+
+        if train_acc > self.best_train_acc:
+            self.best_train_acc = train_acc
+        if val_acc > self.best_val_acc:
+            self.best_val_acc = val_acc
+            return True
+        return False
+
+    def _keep_best_params(self, params=None):
+        """
+        Copy params, by default the current model parameters, into best_params.
+        With flat_params they are copied into a buffer that is allocated once
+        and reused for every later improvement, so a best_params dictionary
+        taken from an earlier call changes along with it.
+        """
+        if self.flat is None:
+            params = self.model.params if params is None else params
+            self.best_params = {}
+            for k, v in params.items():
+                self.best_params[k] = np.array(v)
+            return
+
+        data = self.flat.data
+        if self._best_data is None or self._best_data.shape != data.shape or self._best_data.dtype != data.dtype:
+            self._best_data = np.empty_like(data)
+        best_params = OrderedDict((name, self._best_data[s].reshape(self.flat.params[name].shape))
+                                  for name, s in self.flat.slices.items())
+        if params is None:
+            np.copyto(self._best_data, data)
+        else:
+            for name, view in best_params.items():
+                np.copyto(view, params[name])
+        self.best_params = best_params
+
+    def _collect_validation(self, block=False, wait_all=False):
+        """
+        Record the finished asynchronous accuracy checks, keeping the snapshot
+        of the best one.
+        """
+        for slot, epoch, train_acc, val_acc in self.validator.results(block, wait_all):
+            if self._record_accuracy(epoch, train_acc, val_acc):
+                self.validator.keep(slot)
+            else:
+                self.validator.release(slot)
+
+    def _checkpoint_state(self):
+        """
+        Arrays and metadata of a checkpoint of the current training state.
+        Array names are 'params/<name>', 'best_params/<name>', and 'optim/<key>'
+        with flat_params or 'optim/<name>/<key>' without; the scalars of the
+        optimizer configs go into the metadata.
+        """
+        arrays = OrderedDict()
+        for name, value in self.model.params.items():
+            arrays['params/' + name] = value
+        best_params = self.best_params
+        if self.validator is not None:
+            best_params = self.validator.kept_params() or best_params
+        for name, value in best_params.items():
+            arrays['best_params/' + name] = value
+
+        def split(config, prefix):
+            scalars = {}
+            for key, value in config.items():
+                if key == 'scratch':
+                    continue
+                if isinstance(value, np.ndarray):
+                    arrays[prefix + key] = value
+                else:
+                    scalars[key] = value
+            return scalars
+
+        if self.flat is not None:
+            optim_config = split(self.flat_config, 'optim/')
+        else:
+            optim_config = {p: split(config, 'optim/{}/'.format(p)) for p, config in self.optim_configs.items()}
+
+        meta = {
+            'update_rule': self.update_rule.__name__,
+            'flat_params': self.flat is not None,
+            'optim_config': optim_config,
+            'epoch': self.epoch,
+            'best_val_acc': self.best_val_acc,
+            'best_train_acc': self.best_train_acc,
+            'loss_history': self.loss_history,
+            'train_acc_history': self.train_acc_history,
+            'val_acc_history': self.val_acc_history,
+        }
+        return arrays, meta
+
+    def save_checkpoint(self, path):
+        """
+        Write the model parameters, the best parameters, the optimizer state
+        and the training history to path (see checkpoint.py), for resume_from.
+        The parameters can also be loaded on their own as memory-mapped arrays:
+
+            arrays, _ = checkpoint.load_checkpoint(path)
+            model.params = {name[len('params/'):]: a for name, a in arrays.items()
+                            if name.startswith('params/')}
+
+        During a train() with async_validation, the accuracies and best
+        parameters of the epochs still being validated are not in it yet.
+        """
+        checkpoint.save_checkpoint(path, *self._checkpoint_state())
+
+    def resume_from(self, path):
+        """
+        Restore the state written by save_checkpoint into this Solver, which
+        must have the same update rule, flat_params setting and parameter names.
+        The next train() then runs the epochs left to num_epochs, with a new
+        shuffling of the batches.
+        """
+        arrays, meta = checkpoint.load_checkpoint(path)
+        if meta['update_rule'] != self.update_rule.__name__:
+            raise ValueError('Checkpoint was written with update rule {}, not {}'.format(
+                meta['update_rule'], self.update_rule.__name__))
+        if meta['flat_params'] != self.flat_params:
+            raise ValueError('Checkpoint was written with flat_params={}'.format(meta['flat_params']))
+
+        def subset(prefix):
+            return OrderedDict((name[len(prefix):], a) for name, a in arrays.items()
+                               if name.startswith(prefix) and '/' not in name[len(prefix):])
+
+        params = subset('params/')
+        if set(params) != set(self.model.params):
+            raise ValueError('Checkpoint has parameters {}, the model {}'.format(
+                ', '.join(sorted(params)), ', '.join(sorted(self.model.params))))
+
+        # Everything is copied out of the read-only mapping, since training
+        # updates the parameters and optimizer state in place
+        if self.flat is not None:
+            self._flatten_params()
+            for name, value in params.items():
+                np.copyto(self.model.params[name], value)
+            self.flat_config = dict(meta['optim_config'])
+            self.flat_config.update((k, np.array(v)) for k, v in subset('optim/').items())
+            self.flat_config['inplace'] = True
+        else:
+            self.optim_configs = {}
+            for p, value in params.items():
+                self.model.params[p] = np.array(value)
+                config = dict(meta['optim_config'][p])
+                config.update((k, np.array(v)) for k, v in subset('optim/{}/'.format(p)).items())
+                self.optim_configs[p] = config
+
+        best_params = subset('best_params/')
+        if best_params:
+            self._keep_best_params(best_params)
+        else:
+            self.best_params = {}
+        self.epoch = meta['epoch']
+        self.best_val_acc = meta['best_val_acc']
+        self.best_train_acc = meta['best_train_acc']
+        self.loss_history = meta['loss_history']
+        self.train_acc_history = meta['train_acc_history']
+        self.val_acc_history = meta['val_acc_history']
+        self._remaining_epochs = max(self.num_epochs - self.epoch, 0)
+
     def train(self):
         """
         Run optimization to train the model.
         """
-        num_train = self.X_train.shape[0]
-        iterations_per_epoch = int(max(num_train / self.batch_size, 1))
-        num_iterations = self.num_epochs * iterations_per_epoch
-
-        for t in range(num_iterations):
-            self._step()
-
-            if self.verbose and t % self.print_every == 0:
-                print("(Iteration {} / {}) loss: {}".format(t+1, num_iterations, self.loss_history[-1]))
-
-            # At hte end of every epoch, increment the epoch counter and decay the learning rate
-            epoch_end = (t + 1) % iterations_per_epoch == 0
-            if epoch_end:
-                self.epoch += 1
-                for k in self.optim_configs.keys():
-                    self.optim_configs[k]['learning_rate'] *= self.lr_decay
-
-            # Check train and val accuracy at the first iteration, the last
-            # iteration, and at the end of each epoch.
-            first_it = (t == 0)
-            last_it = (t == num_iterations + 1)
-            if first_it or last_it or epoch_end:
-                train_acc = self.check_accuracy(self.X_train, self.y_train, num_samples=1000)
-                val_acc = self.check_accuracy(self.X_val, self.y_val)
-                self.train_acc_history.append(train_acc)
-                self.val_acc_history.append(val_acc)
-
-                if self.verbose:
-                    print("(Epoch {} / {}) train acc: {}, val_acc: {}".format(self.epoch, self.num_epochs, train_acc, val_acc))
-
-                if val_acc > self.best_val_acc:
-                    self.best_val_acc = val_acc
-                    self.best_params = {}
-                    for k, v in self.model.params.items():
-                        self.best_params[k] = v.copy()
-                if train_acc > self.best_train_acc:
-                    self.best_train_acc = train_acc
+        # model.params may have been replaced since the last call, e.g. by the
+        # best parameters at the end of a previous train()
+        if self.flat is not None:
+            self._flatten_params()
+
+        # Draw the shuffling seed first so the batches do not depend on
+        # num_workers, and start the workers before the prefetch thread so they
+        # are not forked while it runs
+        seed = np.random.randint(2**31 - 1)
+        if self.num_workers > 0:
+            self.parallel = DataParallel(self.model, self.flat, self.X_train, self.y_train,
+                                         self.batch_size, self.num_workers)
+        if self.async_validation:
+            self.validator = AsyncValidator(self.model, self.flat, self.X_train, self.y_train,
+                                            self.X_val, self.y_val)
+        self.loader = BatchLoader(self.X_train, self.y_train, self.batch_size,
+                                  num_prefetch=self.num_prefetch, seed=seed, transform=self.augment)
+        if self.checkpoint_path is not None:
+            self.checkpoint_writer = checkpoint.CheckpointWriter()
+        # After resume_from, run the remaining epochs, without the accuracy
+        # check of the first iteration that an uninterrupted run does not have
+        resuming = self._remaining_epochs is not None
+        num_epochs = self._remaining_epochs if resuming else self.num_epochs
+        self._remaining_epochs = None
+        iterations_per_epoch = self.loader.batches_per_epoch
+        num_iterations = num_epochs * iterations_per_epoch
+        started_profiler = self.profiler is not None and self.profiler.start()
+
+        try:
+            for t in range(num_iterations):
+                if self.profiler is not None:
+                    with self.profiler.iteration():
+                        self._step()
+                else:
+                    self._step()
+
+                if self.verbose and t % self.print_every == 0:
+                    print("(Iteration {} / {}) loss: {}".format(t+1, num_iterations, self.loss_history[-1]))
+
+                # At hte end of every epoch, increment the epoch counter and decay the learning rate
+                epoch_end = (t + 1) % iterations_per_epoch == 0
+                if epoch_end:
+                    self.epoch += 1
+                    for k in self.optim_configs.keys():
+                        self.optim_configs[k]['learning_rate'] *= self.lr_decay
+                    if self.flat_config is not None:
+                        self.flat_config['learning_rate'] *= self.lr_decay
+
+                # Check train and val accuracy at the first iteration, the last
+                # iteration, and at the end of each epoch.
+                first_it = (t == 0) and not resuming
+                last_it = (t == num_iterations + 1)
+                if (first_it or last_it or epoch_end) and self.validator is not None:
+                    # Only wait for the side process if every snapshot buffer is busy
+                    self._collect_validation(block=self.validator.num_free == 0)
+                    self.validator.submit(self.epoch)
+                elif first_it or last_it or epoch_end:
+                    train_acc = self.check_accuracy(self.X_train, self.y_train, num_samples=1000)
+                    val_acc = self.check_accuracy(self.X_val, self.y_val)
+                    if self._record_accuracy(self.epoch, train_acc, val_acc):
+                        self._keep_best_params()
+
+                if epoch_end and self.checkpoint_writer is not None and self.epoch % self.checkpoint_period == 0:
+                    with self._span('checkpoint', 'io'):
+                        self.checkpoint_writer.submit(self.checkpoint_path, *self._checkpoint_state())
+
+            if self.validator is not None:
+                self._collect_validation(wait_all=True)
+                kept = self.validator.copy_kept()
+                if kept is not None:
+                    self.best_params = kept
+        finally:
+            if started_profiler:
+                self.profiler.stop()
+            self.loader.close()
+            if self.checkpoint_writer is not None:
+                self.checkpoint_writer.close()
+                self.checkpoint_writer = None
+            if self.validator is not None:
+                self.validator.close()
+                self.validator = None
+            if self.parallel is not None:
+                self.parallel.close()
+                self.parallel = None
 
         # At the end of the training swap the best params into the model
         self.model.params = self.best_params
\ No newline at end of file
@@ -1,3 +1,6 @@
+import multiprocessing
+from collections import OrderedDict
+
 import numpy as np
 from random import randrange
 
@@ -47,4 +50,130 @@ def eval_numerical_gradient_array(f, x, df, h=1e-5):
         grad[ix] = np.sum((pos - neg) * df) / (2 * h)
         it.iternext()
 
-    return grad
\ No newline at end of file
+    return grad
+
+# State of a pool worker of grad_check_sampled, set by _init_worker
+_worker = {}
+
+
+def _init_worker(f, params, df):
+    _worker.update(f=f, params=params, df=df)
+
+
+def _numerical_partial(f, params, df, name, ix, h):
+    """
+    Centered difference of f with respect to params[name][ix], perturbed in
+    place. With df, f returns an array whose dot product with df is
+    differentiated, as in eval_numerical_gradient_array.
+    """
+    x = params[name]
+    oldval = x[ix]
+    x[ix] = oldval + h
+    pos = np.array(f())
+    x[ix] = oldval - h
+    neg = np.array(f())
+    x[ix] = oldval
+
+    if df is None:
+        return (pos - neg) / (2 * h)
+    return np.sum((pos - neg) * df) / (2 * h)
+
+
+def _pool_partial(task):
+    name, ix, h = task
+    return _numerical_partial(_worker['f'], _worker['params'], _worker['df'], name, ix, h)
+
+
+def sample_indices(size, num_samples, rng):
+    """
+    Flat indices of num_samples coordinates of an array of the given size,
+    one drawn uniformly from each of num_samples equal strata, or all of
+    them if size <= num_samples.
+    """
+    if size <= num_samples:
+        return np.arange(size)
+    edges = np.linspace(0, size, num_samples + 1).astype(np.int64)
+    return edges[:-1] + (rng.random(num_samples) * (edges[1:] - edges[:-1])).astype(np.int64)
+
+
+def grad_check_sampled(f, params, grads, df=None, num_samples=10, h=1e-5, num_processes=None, seed=0):
+    """
+    Compare analytic gradients to numerical ones on a sample of coordinates
+    of every parameter, evaluated in a pool of worker processes.
+
+    Every parameter gets its own num_samples coordinates, spread over it by
+    sample_indices, so small tensors such as biases are checked as well as
+    large weights. The workers are forked, so f can be a lambda; each perturbs
+    its own copy of params. Where fork is not available, or with
+    num_processes <= 1, the points are evaluated in this process.
+
+    Inputs:
+    - f: Function of no arguments evaluated at the current values of the
+      arrays in params, which it must read rather than copy; it returns a
+      scalar, or an array if df is given. It must be deterministic, e.g. with
+      a fixed dropout seed, and float64 is needed for meaningful errors.
+    - params: Dictionary mapping names to the arrays to check, e.g.
+      model.params or {'x': x, 'w': w, 'b': b}
+    - grads: Dictionary of the analytic gradients of the names in params
+    - df: Optional upstream gradient of the output of f
+    - num_samples: Number of coordinates to check per parameter
+    - h: Step of the centered differences
+    - num_processes: Number of worker processes; defaults to the CPU count
+    - seed: Seed of the sampling
+
+    Returns an OrderedDict mapping every name to a dictionary with keys
+    - 'indices': Tuple of index arrays of the checked coordinates
+    - 'numeric', 'analytic': Gradients at those coordinates
+    - 'rel_error': Relative error per coordinate
+    - 'max', 'mean', 'median': Statistics of rel_error
+    """
+    rng = np.random.default_rng(seed)
+    samples = OrderedDict()
+    tasks = []
+    for name in params:
+        shape = np.shape(params[name])
+        indices = np.unravel_index(sample_indices(int(np.prod(shape)), num_samples, rng), shape)
+        samples[name] = indices
+        tasks.extend((name, ix, h) for ix in zip(*(i.tolist() for i in indices)))
+
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+    num_processes = min(num_processes, len(tasks))
+    if num_processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        chunksize = max(1, len(tasks) // (4 * num_processes))
+        with context.Pool(num_processes, initializer=_init_worker, initargs=(f, params, df)) as pool:
+            values = pool.map(_pool_partial, tasks, chunksize)
+    else:
+        values = [_numerical_partial(f, params, df, name, ix, h) for name, ix, h in tasks]
+
+    results = OrderedDict()
+    start = 0
+    for name, indices in samples.items():
+        count = len(indices[0])
+        numeric = np.array(values[start:start + count], dtype=np.float64)
+        analytic = np.asarray(grads[name], dtype=np.float64)[indices]
+        rel_error = np.abs(numeric - analytic) / np.maximum(1e-8, np.abs(numeric) + np.abs(analytic))
+        results[name] = {
+            'indices': indices,
+            'numeric': numeric,
+            'analytic': analytic,
+            'rel_error': rel_error,
+            'max': rel_error.max(),
+            'mean': rel_error.mean(),
+            'median': np.median(rel_error),
+        }
+        start += count
+    return results
+
+
+def format_grad_check(results):
+    """
+    Table of the relative error statistics per parameter returned by
+    grad_check_sampled, as a string.
+    """
+    lines = ['{:<12} {:>8} {:>12} {:>12} {:>12}'.format('param', 'checked', 'max', 'mean', 'median')]
+    for name, r in results.items():
+        lines.append('{:<12} {:>8} {:>12.3e} {:>12.3e} {:>12.3e}'.format(
+            name, len(r['rel_error']), r['max'], r['mean'], r['median']))
+    return '\n'.join(lines)
@@ -1,3 +1,19 @@
+"""
+im2col and col2im kernels, in serial versions and in multithreaded *_parallel
+versions. The multithreaded ones release the GIL and split the work with
+OpenMP, so the extension has to be built with -fopenmp (see setup.py).
+
+The parallel col2im kernels split over (batch, channel) pairs: every (n, c)
+plane of the output is owned by exactly one thread and is accumulated in the
+same order as in the serial kernels, so the results are bit-identical to
+col2im_cython and col2im_6d_cython. im2col only copies, and is bit-identical by
+construction.
+
+Rows of cols are ordered by channel, then kernel row, then kernel column, so
+the row of (c, ii, jj) is (c * field_height + ii) * field_width + jj for
+rectangular fields as well as square ones.
+"""
+
 import numpy as np
 cimport numpy as np
 
@@ -9,6 +25,8 @@ import numpy as np gives you access to NumPy-Python functions, such as np.array,
 """
 
 cimport cython
+from cython.parallel cimport prange
+cimport openmp
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
@@ -55,7 +73,7 @@ cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
             for xx in range(WW):
                 for ii in range(field_height):
                     for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
+                        row = c * field_width * field_height + ii * field_width + jj
                         for i in range(N):
                             col = yy * WW * N + xx * N + i
                             cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
@@ -89,7 +107,7 @@ cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
     for c in range(C):
         for ii in range(field_height):
             for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
+                row = c * field_width * field_height + ii * field_width + jj
                 for yy in range(HH):
                     for xx in range(WW):
                         for i in range(N):
@@ -127,3 +145,133 @@ def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int
     if pad > 0:
         return x_padded[:, :, pad:-pad, pad:-pad]
     return x_padded 
+
+
+cdef int _num_threads = openmp.omp_get_max_threads()
+
+
+def set_num_threads(int num_threads):
+    """
+    Set the default number of threads used by the *_parallel kernels.
+    """
+    global _num_threads
+    if num_threads < 1:
+        raise ValueError('num_threads must be positive, got {}'.format(num_threads))
+    _num_threads = num_threads
+
+
+def get_num_threads():
+    return _num_threads
+
+
+def im2col_cython_parallel(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
+                           int field_width, int padding, int stride,
+                           int num_threads=0):
+    cdef int N = x.shape[0]
+    cdef int C = x.shape[1]
+    cdef int H = x.shape[2]
+    cdef int W = x.shape[3]
+
+    cdef int HH = (H + 2 * padding - field_height) // stride + 1
+    cdef int WW = (W + 2 * padding - field_width) // stride + 1
+
+    cdef int p = padding
+    x_padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+    cols = np.zeros((C * field_height * field_width, N * HH * WW), dtype=x.dtype)
+
+    if num_threads <= 0:
+        num_threads = _num_threads
+    im2col_parallel_inner[DTYPE_t](cols, x_padded, N, C, HH, WW,
+                                   field_height, field_width, stride, num_threads)
+    return cols
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void im2col_parallel_inner(DTYPE_t[:, ::1] cols, DTYPE_t[:, :, :, ::1] x_padded,
+                                int N, int C, int HH, int WW,
+                                int field_height, int field_width, int stride,
+                                int num_threads):
+    cdef int c, ii, jj, row, yy, xx, i, col
+
+    # im2col is a pure gather, so it is split over output rows instead: every
+    # column of cols belongs to a single yy, which keeps the writes of one
+    # thread contiguous along i exactly like the serial loop.
+    for yy in prange(HH, nogil=True, schedule='static', num_threads=num_threads):
+        for c in range(C):
+            for xx in range(WW):
+                for ii in range(field_height):
+                    for jj in range(field_width):
+                        row = c * field_width * field_height + ii * field_width + jj
+                        for i in range(N):
+                            col = yy * WW * N + xx * N + i
+                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
+
+
+def col2im_cython_parallel(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
+                           int field_height, int field_width, int padding, int stride,
+                           int num_threads=0):
+    cdef int HH = (H + 2 * padding - field_height) // stride + 1
+    cdef int WW = (W + 2 * padding - field_width) // stride + 1
+    x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding), dtype=cols.dtype)
+
+    if num_threads <= 0:
+        num_threads = _num_threads
+    col2im_parallel_inner[DTYPE_t](np.ascontiguousarray(cols), x_padded, N, C, HH, WW,
+                                   field_height, field_width, stride, num_threads)
+    if padding > 0:
+        return x_padded[:, :, padding:-padding, padding:-padding]
+    return x_padded
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void col2im_parallel_inner(DTYPE_t[:, ::1] cols, DTYPE_t[:, :, :, ::1] x_padded,
+                                int N, int C, int HH, int WW,
+                                int field_height, int field_width, int stride,
+                                int num_threads):
+    cdef int nc, c, ii, jj, row, yy, xx, i
+
+    for nc in prange(N * C, nogil=True, schedule='static', num_threads=num_threads):
+        c = nc // N
+        i = nc % N
+        for ii in range(field_height):
+            for jj in range(field_width):
+                row = c * field_width * field_height + ii * field_width + jj
+                for yy in range(HH):
+                    for xx in range(WW):
+                        x_padded[i, c, stride * yy + ii, stride * xx + jj] += \
+                            cols[row, yy * WW * N + xx * N + i]
+
+
+def col2im_6d_cython_parallel(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
+                              int HH, int WW, int pad, int stride, int num_threads=0):
+    cdef int out_h = (H + 2 * pad - HH) // stride + 1
+    cdef int out_w = (W + 2 * pad - WW) // stride + 1
+    x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad), dtype=cols.dtype)
+
+    if num_threads <= 0:
+        num_threads = _num_threads
+    col2im_6d_parallel_inner[DTYPE_t](np.ascontiguousarray(cols), x_padded, N, C, HH, WW,
+                                      out_h, out_w, stride, num_threads)
+    if pad > 0:
+        return x_padded[:, :, pad:-pad, pad:-pad]
+    return x_padded
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void col2im_6d_parallel_inner(DTYPE_t[:, :, :, :, :, ::1] cols,
+                                   DTYPE_t[:, :, :, ::1] x_padded,
+                                   int N, int C, int HH, int WW, int out_h, int out_w,
+                                   int stride, int num_threads):
+    cdef int nc, n, c, hh, ww, h, w
+
+    for nc in prange(N * C, nogil=True, schedule='static', num_threads=num_threads):
+        n = nc // C
+        c = nc % C
+        for hh in range(HH):
+            for ww in range(WW):
+                for h in range(out_h):
+                    for w in range(out_w):
+                        x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
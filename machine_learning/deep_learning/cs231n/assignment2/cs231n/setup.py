@@ -5,7 +5,9 @@ import numpy
 
 extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
-            include_dirs = [numpy.get_include()]
+            include_dirs = [numpy.get_include()],
+            extra_compile_args = ['-fopenmp'],
+            extra_link_args = ['-fopenmp'],
   ),
 ]
 